@@ -0,0 +1,198 @@
+"""Асинхронные представления для горячих путей чтения.
+
+Работают только в режиме ASGI (foodgram/asgi_urls.py) и повторяют
+ответы вьюсетов из api/views.py: берут у них queryset, фильтры и
+сериализаторы, а запросы к базе и кэшу выполняют через асинхронный API
+Django. Сериализация и всё, что асинхронно не обслуживается (запись,
+курсорная пагинация), идут в потоке через sync_to_async.
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.contrib.auth.models import AnonymousUser
+from django.http import Http404, HttpResponse
+from django.shortcuts import aget_object_or_404
+from django.urls import resolve
+from django.utils.translation import gettext_lazy as _
+from django.views.decorators.csrf import csrf_exempt
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import (APIException, AuthenticationFailed,
+                                       NotFound)
+from rest_framework.renderers import JSONRenderer
+from rest_framework.request import Request
+
+from recipes.search import acheck_search_index
+
+from .cache import recipe_cache
+from .filters import NameSearchFilter
+from .indexes import ingredient_index
+from .pagination import AsyncPageLimitPagination
+from .replicas import achoose_replica, reset_replica, use_replica
+from .serializers import FollowUserSerializer
+from .views import CustomUserViewSet, IngredientViewSet, RecipeViewSet
+
+# Синхронные представления тех же маршрутов
+SYNC_URLCONF = 'foodgram.urls'
+
+
+def render(data, status=200):
+    """Ответ в том же формате, что у JSONRenderer DRF."""
+    response = HttpResponse(JSONRenderer().render(data), status=status,
+                            content_type='application/json')
+    response['Vary'] = 'Accept'
+    return response
+
+
+def error_response(exc):
+    """Ответ на ошибку, как у обработчика исключений DRF."""
+    if isinstance(exc, Http404):
+        exc = NotFound(*exc.args)
+    if isinstance(exc.detail, (list, dict)):
+        data = exc.detail
+    else:
+        data = {'detail': exc.detail}
+    response = render(data, exc.status_code)
+    if isinstance(exc, AuthenticationFailed):
+        response['WWW-Authenticate'] = 'Token'
+    return response
+
+
+async def authenticate(request):
+    """TokenAuthentication DRF через асинхронный ORM."""
+    auth = request.headers.get('Authorization', '').split()
+    if not auth or auth[0].lower() != 'token':
+        return AnonymousUser(), None
+    if len(auth) == 1:
+        raise AuthenticationFailed(
+            _('Invalid token header. No credentials provided.'))
+    if len(auth) > 2:
+        raise AuthenticationFailed(
+            _('Invalid token header. Token string should not contain '
+              'spaces.'))
+    try:
+        token = await Token.objects.select_related('user').aget(key=auth[1])
+    except Token.DoesNotExist:
+        raise AuthenticationFailed(_('Invalid token.'))
+    if not token.user.is_active:
+        raise AuthenticationFailed(_('User inactive or deleted.'))
+    return token.user, token
+
+
+async def make_view(viewset_class, request, action, **kwargs):
+    """Вьюсет с авторизованным запросом DRF, как после initial().
+
+    Как и ReplicaReadMixin, после аутентификации выбирает реплику для
+    чтения; сбрасывает её async_api_view.
+    """
+    user, token = await authenticate(request)
+    drf_request = Request(request)
+    drf_request.user, drf_request.auth = user, token
+    use_replica(await achoose_replica(drf_request))
+    return viewset_class(request=drf_request, action=action, args=(),
+                         kwargs=kwargs, format_kwarg=None)
+
+
+async def serialize(serializer_class, *args, **kwargs):
+    """Сериализует в потоке.
+
+    Сериализация занимает процессор, а ленивый запрос к базе, если он
+    случится, в цикле событий запрещён.
+    """
+    return await sync_to_async(
+        lambda: serializer_class(*args, **kwargs).data)()
+
+
+async def call_sync_view(request):
+    match = resolve(request.path_info, urlconf=SYNC_URLCONF)
+    request.resolver_match = match
+    return await sync_to_async(match.func)(
+        request, *match.args, **match.kwargs)
+
+
+def async_api_view(function):
+    """Асинхронное представление GET-запросов маршрута API.
+
+    Другие методы и запросы, для которых function вернула None, отдаёт
+    синхронное представление того же маршрута.
+    """
+    @csrf_exempt
+    @wraps(function)
+    async def view(request, *args, **kwargs):
+        if request.method != 'GET':
+            return await call_sync_view(request)
+        replica_token = use_replica(None)
+        try:
+            response = await function(request, *args, **kwargs)
+        except (APIException, Http404) as exc:
+            response = error_response(exc)
+        finally:
+            reset_replica(replica_token)
+        if response is None:
+            return await call_sync_view(request)
+        return response
+    return view
+
+
+async def list_recipes(view):
+    queryset = view.get_queryset()
+    if 'search' in view.request.query_params:
+        await acheck_search_index(queryset.db)
+    queryset = view.filter_queryset(queryset)
+    paginator = AsyncPageLimitPagination()
+    page = await paginator.apaginate_queryset(queryset, view.request)
+    data = await serialize(view.get_serializer, page, many=True)
+    return paginator.get_paginated_response(data).data
+
+
+async def retrieve_recipe(view):
+    recipe = await aget_object_or_404(
+        view.filter_queryset(view.get_queryset()), pk=view.kwargs['pk'])
+    return await serialize(view.get_serializer, recipe)
+
+
+async def recipe_response(view, handler):
+    data, cache_status = await recipe_cache.aget_data(
+        view, view.request, handler)
+    response = render(data)
+    if cache_status:
+        response['X-Cache'] = cache_status
+    return response
+
+
+@async_api_view
+async def recipe_list(request):
+    view = await make_view(RecipeViewSet, request, 'list')
+    if view.use_cursor_pagination():
+        return None
+    return await recipe_response(view, list_recipes)
+
+
+@async_api_view
+async def recipe_detail(request, pk):
+    view = await make_view(RecipeViewSet, request, 'retrieve', pk=pk)
+    return await recipe_response(view, retrieve_recipe)
+
+
+@async_api_view
+async def ingredient_list(request):
+    view = await make_view(IngredientViewSet, request, 'list')
+    snapshot = await ingredient_index.aget()
+    terms = NameSearchFilter().get_search_terms(view.request)
+    if not terms:
+        return ingredient_index.catalog_response(request, snapshot)
+    return render(snapshot.search(
+        terms, view.get_search_limit(view.request)))
+
+
+@async_api_view
+async def subscriptions(request):
+    view = await make_view(CustomUserViewSet, request, 'follow_list')
+    if (not view.request.user.is_authenticated
+            or view.use_cursor_pagination()):
+        return None
+    queryset = view.get_subscriptions(view.request)
+    paginator = AsyncPageLimitPagination()
+    page = await paginator.apaginate_queryset(queryset, view.request)
+    data = await serialize(FollowUserSerializer, page, many=True,
+                           context={'request': view.request})
+    return render(paginator.get_paginated_response(data).data)
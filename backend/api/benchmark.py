@@ -0,0 +1,561 @@
+"""Бенчмарк API: синтетические данные, сценарии по всем маршрутам и бюджет.
+
+Используется командой benchmark_api и тестами в api/tests.py.
+"""
+import base64
+import gc
+import io
+import itertools
+import json
+import math
+import os
+import random
+import tempfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Callable, Optional
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test import Client
+from django.test.utils import (CaptureQueriesContext, override_settings,
+                               setup_databases, setup_test_environment,
+                               teardown_databases,
+                               teardown_test_environment)
+from PIL import Image, PngImagePlugin
+from rest_framework.authtoken.models import Token
+
+from recipes.counters import reconcile_counters
+from recipes.importers import (default_ingredients_path, import_ingredients,
+                               read_rows)
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList)
+
+from .cache import recipe_cache
+from .indexes import ingredient_index
+
+User = get_user_model()
+
+BUDGET_PATH = Path(__file__).resolve().parent / 'benchmark_budget.json'
+PASSWORD = 'benchmark-Passw0rd'
+NEW_PASSWORD = 'benchmark-N3w-Passw0rd'
+
+
+def make_image(padding=0):
+    """PNG 1x1 в base64; padding байт текстового блока делают файл
+    большим, не меняя стоимость уменьшенных копий."""
+    info = PngImagePlugin.PngInfo()
+    if padding:
+        info.add_text('Comment', os.urandom(padding // 2).hex())
+    buffer = io.BytesIO()
+    Image.new('RGB', (1, 1)).save(buffer, format='PNG', pnginfo=info)
+    return ('data:image/png;base64,'
+            + base64.b64encode(buffer.getvalue()).decode())
+
+
+IMAGE = make_image()
+# Почти предел тела запроса Django (DATA_UPLOAD_MAX_MEMORY_SIZE, 2,5 МБ
+# в base64): раскодирование, проверка и sha256 идут в запросе
+LARGE_IMAGE = make_image(padding=1_500_000)
+
+# Маршруты djoser для подтверждения по почте: рассылка писем в проекте
+# не настроена (нет PASSWORD_RESET_CONFIRM_URL и активации).
+EXCLUDED_ROUTES = {
+    'users-activation',
+    'users-resend-activation',
+    'users-reset-password',
+    'users-reset-password-confirm',
+    'users-reset-username',
+    'users-reset-username-confirm',
+}
+
+
+@dataclass
+class Dataset:
+    viewer: User
+    token: str
+    author: User
+    other: User
+    own_recipe: int
+    recipe: int
+    ingredient: int
+    ingredients: list
+
+
+@contextmanager
+def benchmark_environment():
+    """Отдельная тестовая база того же движка и временный MEDIA_ROOT.
+
+    SQLite при DB_ENGINE=sqlite, иначе PostgreSQL из настроек.
+    Тестовые базы создаются для всех соединений, как в manage.py test:
+    реплики из DB_REPLICAS становятся зеркалами тестовой default, а не
+    читают настоящие базы. Чтения при этом всё равно идут в default
+    (DATABASE_REPLICAS пуст), иначе запросы к репликам не попали бы в
+    подсчёт и бюджет зависел бы от окружения.
+    Изображения обрабатываются в запросе: так замеры повторяемы,
+    а потоки пула не конкурируют с замерами за базу.
+    """
+    setup_test_environment()
+    old_config = setup_databases(
+        verbosity=0, interactive=False, serialized_aliases=set())
+    try:
+        with tempfile.TemporaryDirectory() as media_root, \
+                override_settings(MEDIA_ROOT=media_root,
+                                  IMAGE_TASKS_EAGER=True,
+                                  DATABASE_REPLICAS=[]):
+            yield
+    finally:
+        teardown_databases(old_config, verbosity=0)
+        teardown_test_environment()
+
+
+def seed_dataset(users=2000, recipes=20000, ingredients_path=None,
+                 batch_size=2000, seed=0):
+    """Заполняет базу синтетическими данными и возвращает Dataset.
+
+    Первые пользователи играют роли: viewer — зритель с корзиной,
+    избранным и подписками, author — автор, на которого он не подписан,
+    other — пользователь для входа и выхода.
+    """
+    rng = random.Random(seed)
+    import_ingredients(read_rows(
+        ingredients_path or default_ingredients_path()),
+        batch_size=batch_size)
+    ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+
+    password = make_password(PASSWORD)
+    created_users = User.objects.bulk_create(
+        (User(email=f'user{index}@example.com', username=f'user{index}',
+              first_name='Имя', last_name=f'Фамилия {index}',
+              password=password)
+         for index in range(max(users, 3))),
+        batch_size=batch_size)
+    viewer, author, other = created_users[:3]
+
+    created_recipes = Recipe.objects.bulk_create(
+        (Recipe(author=viewer if index == 0 else rng.choice(created_users),
+                name=f'Рецепт {index}',
+                text=f'Описание приготовления рецепта {index}',
+                cooking_time=rng.randint(1, 180))
+         for index in range(max(recipes, 2))),
+        batch_size=batch_size)
+    RecipeIngredient.objects.bulk_create(
+        (RecipeIngredient(recipe=recipe, ingredient_id=ingredient_id,
+                          amount=rng.randint(1, 500))
+         for recipe in created_recipes
+         for ingredient_id in rng.sample(ingredient_ids, rng.randint(3, 8))),
+        batch_size=batch_size)
+
+    sample = rng.sample(created_recipes[1:], min(30, len(created_recipes) - 1))
+    Favorite.objects.bulk_create(
+        Favorite(user=viewer, recipe=recipe) for recipe in sample)
+    ShoppingList.objects.bulk_create(
+        ShoppingList(user=viewer, recipe=recipe) for recipe in sample)
+    Follow.objects.bulk_create(
+        Follow(user=viewer, following=user)
+        for user in created_users[3:23])
+    Favorite.objects.bulk_create(
+        (Favorite(user=user, recipe=recipe)
+         for user in created_users[3:]
+         for recipe in rng.sample(created_recipes, min(
+             5, len(created_recipes)))),
+        batch_size=batch_size, ignore_conflicts=True)
+
+    # bulk_create не отправляет сигналы
+    ingredient_index.invalidate()
+    recipe_cache.invalidate_all()
+    reconcile_counters()
+    return Dataset(
+        viewer=viewer,
+        token=Token.objects.create(user=viewer).key,
+        author=author,
+        other=other,
+        own_recipe=created_recipes[0].id,
+        recipe=created_recipes[1].id,
+        ingredient=ingredient_ids[0],
+        ingredients=ingredient_ids[:5],
+    )
+
+
+@dataclass
+class Scenario:
+    """Один запрос к API.
+
+    setup получает Dataset и возвращает параметры для path и data,
+    teardown откатывает изменения после запроса, чтобы следующая
+    итерация шла по тем же данным.
+    """
+
+    name: str
+    route: str
+    method: str
+    path: str
+    status: int = 200
+    auth: bool = True
+    data: Optional[Callable] = None
+    setup: Optional[Callable] = None
+    teardown: Optional[Callable] = None
+
+
+def recipe_data(dataset, context):
+    return {
+        'name': 'Рецепт бенчмарка',
+        'text': 'Описание',
+        'cooking_time': 15,
+        'image': IMAGE,
+        'ingredients': [{'id': ingredient_id, 'amount': 10}
+                        for ingredient_id in dataset.ingredients],
+    }
+
+
+def create_recipe(dataset):
+    recipe = Recipe.objects.create(
+        author=dataset.viewer, name='Удаляемый рецепт', text='Описание',
+        cooking_time=5)
+    return {'id': recipe.id}
+
+
+def create_relation(model, **fields):
+    def setup(dataset):
+        model.objects.get_or_create(**{
+            key: getattr(dataset, value) if isinstance(value, str) else value
+            for key, value in fields.items()
+        })
+        return {}
+    return setup
+
+
+def delete_relation(model, **fields):
+    def teardown(dataset, context, response):
+        model.objects.filter(**{
+            key: getattr(dataset, value) for key, value in fields.items()
+        }).delete()
+    return teardown
+
+
+def delete_created(model):
+    def teardown(dataset, context, response):
+        model.objects.filter(id=response.json()['id']).delete()
+    return teardown
+
+
+def week_of_recipes(model=None):
+    """Семь рецептов автора для пакетных сценариев.
+
+    С model рецепты заранее добавляются в избранное или список покупок.
+    """
+    def setup(dataset):
+        recipe_ids = list(Recipe.objects.filter(
+            author=dataset.author).order_by('id').values_list(
+                'id', flat=True)[:7])
+        if model is not None:
+            model.objects.bulk_create(
+                [model(user=dataset.viewer, recipe_id=pk)
+                 for pk in recipe_ids], ignore_conflicts=True)
+        return {'batch': recipe_ids}
+    return setup
+
+
+def delete_batch(model):
+    def teardown(dataset, context, response):
+        model.objects.filter(
+            user=dataset.viewer, recipe_id__in=context['batch']).delete()
+    return teardown
+
+
+def batch_data(dataset, context):
+    return {'recipes': context['batch']}
+
+
+def restore_password(dataset, context, response):
+    User.objects.filter(id=dataset.viewer.id).update(
+        password=dataset.viewer.password)
+
+
+def restore_email(dataset, context, response):
+    User.objects.filter(id=dataset.viewer.id).update(
+        email=dataset.viewer.email)
+
+
+def create_other_token(dataset):
+    token, _ = Token.objects.get_or_create(user=dataset.other)
+    return {'token': token.key}
+
+
+def pantry_ingredients(dataset):
+    """Продукты: состав рецепта и ещё несколько ингредиентов."""
+    ingredient_ids = list(RecipeIngredient.objects.filter(
+        recipe_id=dataset.recipe).values_list('ingredient_id', flat=True))
+    return {'pantry': ','.join(
+        str(pk) for pk in dict.fromkeys(ingredient_ids + dataset.ingredients))}
+
+
+_user_counter = itertools.count()
+
+
+def new_user(dataset):
+    index = next(_user_counter)
+    return {'index': index}
+
+
+SCENARIOS = [
+    Scenario('api-root', 'api-root', 'get', '/api/', auth=False),
+    Scenario('ingredients-list', 'ingredients-list', 'get',
+             '/api/ingredients/', auth=False),
+    Scenario('ingredients-list:search', 'ingredients-list', 'get',
+             '/api/ingredients/?name=аб', auth=False),
+    Scenario('ingredients-detail', 'ingredients-detail', 'get',
+             '/api/ingredients/{ingredient}/', auth=False),
+    Scenario('recipes-list', 'recipes-list', 'get', '/api/recipes/',
+             auth=False),
+    Scenario('recipes-list:auth', 'recipes-list', 'get',
+             '/api/recipes/?limit=30'),
+    Scenario('recipes-list:is_favorited', 'recipes-list', 'get',
+             '/api/recipes/?is_favorited=1'),
+    Scenario('recipes-list:is_in_shopping_cart', 'recipes-list', 'get',
+             '/api/recipes/?is_in_shopping_cart=1'),
+    Scenario('recipes-list:author', 'recipes-list', 'get',
+             '/api/recipes/?author={author_id}', auth=False),
+    Scenario('recipes-list:search', 'recipes-list', 'get',
+             '/api/recipes/?search=рецепт 1234', auth=False),
+    Scenario('recipes-list:cursor', 'recipes-list', 'get',
+             '/api/recipes/?pagination=cursor&with_count=1', auth=False),
+    Scenario('recipes-list:post', 'recipes-list', 'post', '/api/recipes/',
+             status=201, data=recipe_data,
+             teardown=delete_created(Recipe)),
+    Scenario('recipes-pantry', 'recipes-pantry', 'get',
+             '/api/recipes/pantry/?ingredients={pantry}', auth=False,
+             setup=pantry_ingredients),
+    Scenario('recipes-detail', 'recipes-detail', 'get',
+             '/api/recipes/{recipe}/', auth=False),
+    Scenario('recipes-detail:patch', 'recipes-detail', 'patch',
+             '/api/recipes/{own_recipe}/', data=recipe_data),
+    Scenario('recipes-detail:delete', 'recipes-detail', 'delete',
+             '/api/recipes/{id}/', status=204, setup=create_recipe),
+    Scenario('recipes-get-short-url', 'recipes-get-short-url', 'get',
+             '/api/recipes/{recipe}/get-link/', auth=False),
+    Scenario('recipes-add-to-favorite', 'recipes-add-to-favorite', 'post',
+             '/api/recipes/{own_recipe}/favorite/', status=201,
+             teardown=delete_relation(
+                 Favorite, user='viewer', recipe_id='own_recipe')),
+    Scenario('recipes-add-to-favorite:delete', 'recipes-add-to-favorite',
+             'delete', '/api/recipes/{own_recipe}/favorite/', status=204,
+             setup=create_relation(
+                 Favorite, user='viewer', recipe_id='own_recipe')),
+    Scenario('recipes-add-to-shopping-list', 'recipes-add-to-shopping-list',
+             'post', '/api/recipes/{own_recipe}/shopping_cart/', status=201,
+             teardown=delete_relation(
+                 ShoppingList, user='viewer', recipe_id='own_recipe')),
+    Scenario('recipes-add-to-shopping-list:delete',
+             'recipes-add-to-shopping-list', 'delete',
+             '/api/recipes/{own_recipe}/shopping_cart/', status=204,
+             setup=create_relation(
+                 ShoppingList, user='viewer', recipe_id='own_recipe')),
+    Scenario('recipes-add-many-to-favorite', 'recipes-add-many-to-favorite',
+             'post', '/api/recipes/batch/favorite/', data=batch_data,
+             setup=week_of_recipes(), teardown=delete_batch(Favorite)),
+    Scenario('recipes-add-many-to-favorite:delete',
+             'recipes-add-many-to-favorite', 'delete',
+             '/api/recipes/batch/favorite/', data=batch_data,
+             setup=week_of_recipes(Favorite)),
+    Scenario('recipes-add-many-to-shopping-list',
+             'recipes-add-many-to-shopping-list', 'post',
+             '/api/recipes/batch/shopping_cart/', data=batch_data,
+             setup=week_of_recipes(), teardown=delete_batch(ShoppingList)),
+    Scenario('recipes-add-many-to-shopping-list:delete',
+             'recipes-add-many-to-shopping-list', 'delete',
+             '/api/recipes/batch/shopping_cart/', data=batch_data,
+             setup=week_of_recipes(ShoppingList)),
+    Scenario('recipes-download-shopping-list',
+             'recipes-download-shopping-list', 'get',
+             '/api/recipes/download_shopping_cart/'),
+    Scenario('users-list', 'users-list', 'get', '/api/users/'),
+    Scenario('users-list:post', 'users-list', 'post', '/api/users/',
+             status=201, auth=False, setup=new_user,
+             data=lambda dataset, context: {
+                 'email': f'new{context["index"]}@example.com',
+                 'username': f'new{context["index"]}',
+                 'first_name': 'Новый', 'last_name': 'Пользователь',
+                 'password': PASSWORD,
+             },
+             teardown=lambda dataset, context, response: User.objects.filter(
+                 email=f'new{context["index"]}@example.com').delete()),
+    Scenario('users-detail', 'users-detail', 'get',
+             '/api/users/{author_id}/', auth=False),
+    Scenario('users-me', 'users-me', 'get', '/api/users/me/'),
+    Scenario('users-set-avatar', 'users-set-avatar', 'put',
+             '/api/users/me/avatar/',
+             data=lambda dataset, context: {'avatar': IMAGE}),
+    Scenario('users-set-avatar:large', 'users-set-avatar', 'put',
+             '/api/users/me/avatar/',
+             data=lambda dataset, context: {'avatar': LARGE_IMAGE}),
+    Scenario('users-set-avatar:delete', 'users-set-avatar', 'delete',
+             '/api/users/me/avatar/', status=204),
+    Scenario('users-set-password', 'users-set-password', 'post',
+             '/api/users/set_password/', status=204,
+             data=lambda dataset, context: {
+                 'current_password': PASSWORD,
+                 'new_password': NEW_PASSWORD,
+             },
+             teardown=restore_password),
+    # Логин в проекте — email, поэтому set_username меняет почту
+    Scenario('users-set-username', 'users-set-username', 'post',
+             '/api/users/set_email/', status=204,
+             data=lambda dataset, context: {
+                 'current_password': PASSWORD,
+                 'new_email': 'renamed@example.com',
+             },
+             teardown=restore_email),
+    Scenario('users-follow', 'users-follow', 'post',
+             '/api/users/{author_id}/subscribe/', status=201,
+             teardown=delete_relation(
+                 Follow, user='viewer', following='author')),
+    Scenario('users-follow:delete', 'users-follow', 'delete',
+             '/api/users/{author_id}/subscribe/', status=204,
+             setup=create_relation(
+                 Follow, user='viewer', following='author')),
+    Scenario('users-follow-list', 'users-follow-list', 'get',
+             '/api/users/subscriptions/?recipes_limit=3'),
+    Scenario('login', 'login', 'post', '/api/auth/token/login/',
+             auth=False,
+             data=lambda dataset, context: {
+                 'email': dataset.other.email, 'password': PASSWORD,
+             }),
+    Scenario('logout', 'logout', 'post', '/api/auth/token/logout/',
+             status=204, setup=create_other_token),
+    Scenario('short-link', 'short-link', 'get', '/s/{recipe}/',
+             status=302, auth=False),
+]
+
+
+@dataclass
+class Measurement:
+    name: str
+    durations: list = field(default_factory=list)
+    queries: int = 0
+    bytes: int = 0
+
+    @property
+    def p50_ms(self):
+        return percentile(self.durations, 50) * 1000
+
+    @property
+    def p95_ms(self):
+        return percentile(self.durations, 95) * 1000
+
+    def as_dict(self):
+        return {
+            'queries': self.queries,
+            'p50_ms': round(self.p50_ms, 2),
+            'p95_ms': round(self.p95_ms, 2),
+            'bytes': self.bytes,
+        }
+
+
+def percentile(values, percent):
+    """Перцентиль методом ближайшего ранга."""
+    ordered = sorted(values)
+    index = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[index]
+
+
+def prepare_request(scenario, dataset):
+    """Контекст сценария, путь запроса и аргументы для тестового клиента."""
+    context = {
+        'author_id': dataset.author.id,
+        'own_recipe': dataset.own_recipe,
+        'recipe': dataset.recipe,
+        'ingredient': dataset.ingredient,
+    }
+    if scenario.setup:
+        context.update(scenario.setup(dataset))
+    kwargs = {}
+    if 'token' in context:
+        kwargs['HTTP_AUTHORIZATION'] = f'Token {context["token"]}'
+    elif scenario.auth:
+        kwargs['HTTP_AUTHORIZATION'] = f'Token {dataset.token}'
+    if scenario.data:
+        kwargs['data'] = json.dumps(scenario.data(dataset, context))
+        kwargs['content_type'] = 'application/json'
+    return context, scenario.path.format(**context), kwargs
+
+
+def run_scenario(client, scenario, dataset):
+    context, path, kwargs = prepare_request(scenario, dataset)
+    with CaptureQueriesContext(connection) as queries:
+        start = time.perf_counter()
+        response = getattr(client, scenario.method)(path, **kwargs)
+        if response.streaming:
+            size = sum(len(chunk) for chunk in response.streaming_content)
+        else:
+            size = len(response.content)
+        duration = time.perf_counter() - start
+    if response.status_code != scenario.status:
+        raise AssertionError(
+            f'{scenario.name}: {scenario.method.upper()} {path} вернул '
+            f'{response.status_code}, ожидался {scenario.status}')
+    if scenario.teardown:
+        scenario.teardown(dataset, context, response)
+    return duration, len(queries), size
+
+
+def run_scenarios(dataset, iterations=20, scenarios=SCENARIOS):
+    # Как и воркер при старте, строим индексы до замеров
+    ingredient_index.warm()
+    client = Client()
+    results = {}
+    for scenario in scenarios:
+        measurement = Measurement(scenario.name)
+        # Полная сборка мусора на таком наборе данных идёт десятки мс:
+        # запускаем её сами, иначе она попадёт в замеры случайного
+        # сценария
+        gc.collect()
+        for _ in range(iterations):
+            duration, queries, size = run_scenario(client, scenario, dataset)
+            measurement.durations.append(duration)
+            measurement.queries = max(measurement.queries, queries)
+            measurement.bytes = max(measurement.bytes, size)
+        results[scenario.name] = measurement
+    return results
+
+
+def load_budget(path=BUDGET_PATH):
+    with open(path, encoding='utf-8') as file:
+        return json.load(file)
+
+
+def check_budget(results, budget, metrics=('queries', 'p95_ms', 'bytes')):
+    """Возвращает список нарушений бюджета."""
+    failures = []
+    for name, measurement in results.items():
+        limits = budget.get(name)
+        if limits is None:
+            failures.append(f'{name}: нет бюджета')
+            continue
+        measured = measurement.as_dict()
+        for metric in metrics:
+            if metric in limits and measured[metric] > limits[metric]:
+                failures.append(
+                    f'{name}: {metric} = {measured[metric]} '
+                    f'> {limits[metric]}')
+    return failures
+
+
+def make_budget(results, headroom=1.5, min_headroom_ms=5):
+    """Бюджет по замерам: запросы точно, время и размер с запасом.
+
+    Для быстрых маршрутов запас по времени не меньше min_headroom_ms,
+    иначе бюджет будет срабатывать на шуме.
+    """
+    return {
+        name: {
+            'queries': measurement.queries,
+            'p95_ms': round(max(measurement.p95_ms * headroom,
+                                measurement.p95_ms + min_headroom_ms), 1),
+            'bytes': math.ceil(measurement.bytes * headroom),
+        }
+        for name, measurement in results.items()
+    }
@@ -0,0 +1,254 @@
+import hashlib
+import threading
+import time
+from collections import Counter
+from urllib.parse import urlencode
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db.models import CharField, Value
+from rest_framework.response import Response
+
+from foodgram.metrics import CACHE_REQUESTS
+from recipes.models import Favorite, Follow, ShoppingList
+
+from .replicas import changed_recently, primary_reads
+
+# Фильтры, результат которых зависит от пользователя: такие списки
+# собираются без кэша
+USER_FILTERS = ('is_favorited', 'is_in_shopping_cart')
+
+
+class RecipeResponseCache:
+    """Кэш ответов списка и карточки рецептов.
+
+    В кэше лежит ответ для анонимного пользователя. Для авторизованного
+    поверх него накладываются флаги is_favorited, is_in_shopping_cart и
+    is_subscribed из множеств id, которые тоже кэшируются отдельно
+    для каждого пользователя.
+
+    Ключи содержат версии: общую (epoch), версию списков и версию
+    каждого рецепта. Сигналы меняют только версии, затронутые
+    изменением, а старые записи вытесняет сам бэкенд кэша (LRU).
+    """
+
+    prefix = 'recipes'
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stats = Counter()
+
+    @property
+    def cache(self):
+        return caches[settings.RECIPE_CACHE_ALIAS]
+
+    @property
+    def enabled(self):
+        return settings.RECIPE_CACHE_TIMEOUT != 0
+
+    def get_versions(self, *names):
+        keys = self.get_version_keys(names)
+        versions = self.cache.get_many(keys)
+        for key in keys:
+            if key not in versions:
+                # Новая версия не совпадёт ни с одним старым ключом, даже
+                # если прежнюю версию вытеснили из кэша
+                versions[key] = self.cache.get_or_set(
+                    key, time.time_ns(), None)
+        return ':'.join(str(versions[key]) for key in keys)
+
+    async def aget_versions(self, *names):
+        keys = self.get_version_keys(names)
+        versions = await self.cache.aget_many(keys)
+        for key in keys:
+            if key not in versions:
+                versions[key] = await self.cache.aget_or_set(
+                    key, time.time_ns(), None)
+        return ':'.join(str(versions[key]) for key in keys)
+
+    def get_version_keys(self, names):
+        return [f'{self.prefix}:version:{name}' for name in names]
+
+    def changed_recently(self, versions):
+        """Реплика могла ещё не получить изменение, сбросившее кэш:
+        такой ответ строится по основной базе, иначе в кэш попадут
+        старые данные."""
+        return changed_recently(max(
+            int(version) for version in versions.split(':')))
+
+    def bump(self, *names):
+        self.cache.set_many(
+            {f'{self.prefix}:version:{name}': time.time_ns()
+             for name in names}, None)
+
+    def invalidate_recipes(self, recipe_ids):
+        """Сбрасывает карточки рецептов и все страницы списков."""
+        self.bump('list', *(f'recipe-{pk}' for pk in recipe_ids))
+
+    def invalidate_all(self):
+        """Сбрасывает весь кэш рецептов, например после bulk_create."""
+        self.bump('epoch')
+
+    def invalidate_viewer(self, user_id):
+        self.cache.delete(f'{self.prefix}:viewer:{user_id}')
+
+    def get_version_names(self, view):
+        if view.action == 'list':
+            return ('epoch', 'list')
+        return ('epoch', f'recipe-{view.kwargs[view.lookup_field]}')
+
+    def get_key(self, view, request, versions=None):
+        if versions is None:
+            versions = self.get_versions(*self.get_version_names(view))
+        params = urlencode(sorted(
+            (name, value)
+            for name, values in request.query_params.lists()
+            for value in values))
+        # Ссылки на страницы и картинки абсолютные, поэтому важен и хост
+        url = f'{request.scheme}://{request.get_host()}{request.path}'
+        digest = hashlib.sha1(f'{url}?{params}'.encode()).hexdigest()
+        return f'{self.prefix}:{view.action}:{versions}:{digest}'
+
+    def is_cacheable(self, request):
+        if not self.enabled:
+            return False
+        if request.user.is_authenticated:
+            return not any(request.query_params.get(name)
+                           for name in USER_FILTERS)
+        return True
+
+    def get_viewer_flags_key(self, user):
+        return f'{self.prefix}:viewer:{user.pk}'
+
+    def get_viewer_flags_query(self, user):
+        """Все три множества одним запросом."""
+        return Favorite.objects.filter(user=user).values_list(
+            Value('favorites', output_field=CharField()), 'recipe_id'
+        ).union(
+            ShoppingList.objects.filter(user=user).values_list(
+                Value('shopping_cart', output_field=CharField()),
+                'recipe_id'),
+            Follow.objects.filter(user=user).values_list(
+                Value('followings', output_field=CharField()),
+                'following_id'),
+            all=True)
+
+    def make_viewer_flags(self, rows):
+        flags = {'favorites': set(), 'shopping_cart': set(),
+                 'followings': set()}
+        for kind, pk in rows:
+            flags[kind].add(pk)
+        return flags
+
+    def get_viewer_flags(self, user):
+        key = self.get_viewer_flags_key(user)
+        flags = self.cache.get(key)
+        if flags is None:
+            flags = self.make_viewer_flags(self.get_viewer_flags_query(user))
+            self.cache.set(key, flags, settings.RECIPE_CACHE_TIMEOUT)
+        return flags
+
+    async def aget_viewer_flags(self, user):
+        key = self.get_viewer_flags_key(user)
+        flags = await self.cache.aget(key)
+        if flags is None:
+            flags = self.make_viewer_flags(
+                [row async for row in self.get_viewer_flags_query(user)])
+            await self.cache.aset(key, flags, settings.RECIPE_CACHE_TIMEOUT)
+        return flags
+
+    def apply_viewer_flags(self, data, user, flags=None):
+        if flags is None:
+            flags = self.get_viewer_flags(user)
+        recipes = data['results'] if 'results' in data else [data]
+        for recipe in recipes:
+            recipe['is_favorited'] = recipe['id'] in flags['favorites']
+            recipe['is_in_shopping_cart'] = (
+                recipe['id'] in flags['shopping_cart'])
+            recipe['author']['is_subscribed'] = (
+                recipe['author']['id'] in flags['followings'])
+        return data
+
+    def get_response(self, view, request, handler, *args, **kwargs):
+        """Отдаёт ответ view из кэша или строит и сохраняет его.
+
+        handler строит ответ для анонимного пользователя: пока он
+        работает, view.anonymous_base равен True.
+        """
+        if not self.is_cacheable(request):
+            self.count('bypass')
+            return handler(request, *args, **kwargs)
+        versions = self.get_versions(*self.get_version_names(view))
+        key = self.get_key(view, request, versions)
+        response = self.cache.get(key)
+        if response is None:
+            self.count('miss')
+            view.anonymous_base = True
+            try:
+                with primary_reads(self.changed_recently(versions)):
+                    response = handler(request, *args, **kwargs)
+            finally:
+                view.anonymous_base = False
+            if response.status_code != 200:
+                return response
+            # Бэкенд сериализует значение, поэтому флаги ниже можно
+            # накладывать прямо на response.data
+            self.cache.set(key, response.data, settings.RECIPE_CACHE_TIMEOUT)
+            cache_status = 'MISS'
+        else:
+            self.count('hit')
+            response = Response(response)
+            cache_status = 'HIT'
+        if request.user.is_authenticated:
+            self.apply_viewer_flags(response.data, request.user)
+        response['X-Cache'] = cache_status
+        return response
+
+    async def aget_data(self, view, request, handler):
+        """get_response для асинхронных представлений (api.async_views).
+
+        handler — корутина, которая принимает view и возвращает данные
+        ответа; кэш читается и пишется через асинхронный API бэкенда.
+        Возвращает данные и значение заголовка X-Cache.
+        """
+        if not self.is_cacheable(request):
+            self.count('bypass')
+            return await handler(view), None
+        versions = await self.aget_versions(*self.get_version_names(view))
+        key = self.get_key(view, request, versions)
+        data = await self.cache.aget(key)
+        if data is None:
+            self.count('miss')
+            view.anonymous_base = True
+            try:
+                with primary_reads(self.changed_recently(versions)):
+                    data = await handler(view)
+            finally:
+                view.anonymous_base = False
+            await self.cache.aset(key, data, settings.RECIPE_CACHE_TIMEOUT)
+            cache_status = 'MISS'
+        else:
+            self.count('hit')
+            cache_status = 'HIT'
+        if request.user.is_authenticated:
+            self.apply_viewer_flags(
+                data, request.user,
+                await self.aget_viewer_flags(request.user))
+        return data, cache_status
+
+    def count(self, event):
+        CACHE_REQUESTS.labels(self.prefix, event).inc()
+        with self._lock:
+            self._stats[event] += 1
+
+    def stats(self):
+        """Попадания и промахи в этом процессе."""
+        with self._lock:
+            stats = dict(self._stats)
+        requests = stats.get('hit', 0) + stats.get('miss', 0)
+        stats['hit_ratio'] = (
+            round(stats.get('hit', 0) / requests, 3) if requests else None)
+        return stats
+
+
+recipe_cache = RecipeResponseCache()
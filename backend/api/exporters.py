@@ -0,0 +1,220 @@
+import csv
+import io
+import json
+
+from django.conf import settings
+from django.http import StreamingHttpResponse
+from django.utils.http import content_disposition_header
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFError, TTFont
+from reportlab.pdfgen import canvas
+
+from .shopping_list import get_users_shopping_list_ingredients
+
+CHUNK_SIZE = 8 * 1024
+
+SHOPPING_LIST_RENDERERS = {}
+
+
+def register_renderer(renderer_class):
+    SHOPPING_LIST_RENDERERS[renderer_class.file_format] = renderer_class
+    return renderer_class
+
+
+class ShoppingListRenderer:
+    """Базовый рендерер: отдаёт файл кусками из генератора render()."""
+
+    file_format = None
+    content_type = None
+    filename = 'shopping_list'
+
+    def __init__(self, shopping_list):
+        self.shopping_list = shopping_list
+
+    def render(self):
+        raise NotImplementedError
+
+    def stream(self):
+        """Склеивает мелкие части в блоки по CHUNK_SIZE байт."""
+        buffer = []
+        size = 0
+        for part in self.render():
+            if isinstance(part, str):
+                part = part.encode('utf-8')
+            buffer.append(part)
+            size += len(part)
+            if size >= CHUNK_SIZE:
+                yield b''.join(buffer)
+                buffer = []
+                size = 0
+        if buffer:
+            yield b''.join(buffer)
+
+    def etag(self):
+        return self.shopping_list.etag(self.file_format)
+
+    def get_response(self):
+        response = StreamingHttpResponse(
+            self.stream(), content_type=self.content_type)
+        response['Content-Disposition'] = content_disposition_header(
+            True, f'{self.filename}.{self.file_format}')
+        etag = self.etag()
+        if etag:
+            response['ETag'] = etag
+        return response
+
+    @property
+    def created(self):
+        return self.shopping_list.created.strftime('%Y-%m-%d %H:%M')
+
+
+@register_renderer
+class TextRenderer(ShoppingListRenderer):
+    file_format = 'txt'
+    content_type = 'text/plain; charset=utf-8'
+
+    def render(self):
+        yield f'Список покупок от {self.created}:\n'
+        yield 'Продукты:\n\n'
+        for item in self.shopping_list.ingredients:
+            yield (f"{item['name'].capitalize()} - {item['total_amount']} "
+                   f"{item['measurement_unit']}\n")
+        yield '\n\nДля рецептов:\n\n'
+        for name in self.shopping_list.recipes:
+            yield f'{name}\n'
+
+
+class Echo:
+    """Псевдо-файл для csv.writer: возвращает строку вместо записи."""
+
+    def write(self, value):
+        return value
+
+
+@register_renderer
+class CsvRenderer(ShoppingListRenderer):
+    file_format = 'csv'
+    content_type = 'text/csv; charset=utf-8'
+
+    def render(self):
+        writer = csv.writer(Echo())
+        # BOM нужен, чтобы Excel правильно открыл кириллицу.
+        yield '\ufeff'
+        yield writer.writerow(('Ингредиент', 'Количество',
+                               'Единица измерения'))
+        for item in self.shopping_list.ingredients:
+            yield writer.writerow((item['name'], item['total_amount'],
+                                   item['measurement_unit']))
+        # Рецепты отдельной таблицей после пустой строки, как в TXT и PDF
+        yield writer.writerow(())
+        yield writer.writerow(('Рецепт',))
+        for name in self.shopping_list.recipes:
+            yield writer.writerow((name,))
+
+
+class UsersCsvRenderer(ShoppingListRenderer):
+    """Списки покупок нескольких пользователей одним CSV для админки.
+
+    Суммы считает база, а строки читаются итератором порциями, поэтому
+    память не зависит от числа пользователей и размера их корзин.
+    """
+
+    file_format = 'csv'
+    content_type = 'text/csv; charset=utf-8'
+    filename = 'shopping_lists'
+    chunk_size = 2000
+
+    def __init__(self, users):
+        self.users = users
+
+    def etag(self):
+        return None
+
+    def render(self):
+        writer = csv.writer(Echo())
+        yield '\ufeff'
+        yield writer.writerow(('Email', 'Ингредиент', 'Количество',
+                               'Единица измерения'))
+        rows = get_users_shopping_list_ingredients(self.users)
+        for item in rows.iterator(chunk_size=self.chunk_size):
+            yield writer.writerow((item['email'], item['name'],
+                                   item['total_amount'],
+                                   item['measurement_unit']))
+
+
+@register_renderer
+class JsonRenderer(ShoppingListRenderer):
+    file_format = 'json'
+    content_type = 'application/json'
+
+    def render(self):
+        yield f'{{"created": {json.dumps(self.created)}, "ingredients": ['
+        for index, item in enumerate(self.shopping_list.ingredients):
+            yield (',' if index else '') + json.dumps({
+                'name': item['name'],
+                'amount': item['total_amount'],
+                'measurement_unit': item['measurement_unit'],
+            }, ensure_ascii=False)
+        yield '], "recipes": '
+        yield json.dumps(self.shopping_list.recipes, ensure_ascii=False)
+        yield '}'
+
+
+@register_renderer
+class PdfRenderer(ShoppingListRenderer):
+    """Версия для печати.
+
+    reportlab собирает документ целиком при save(), поэтому PDF
+    формируется в памяти и уже затем отдаётся кусками.
+    """
+
+    file_format = 'pdf'
+    content_type = 'application/pdf'
+    font_name = 'ShoppingListFont'
+    font_size = 12
+    line_height = 7 * mm
+    margin = 20 * mm
+
+    def get_font(self):
+        if self.font_name in pdfmetrics.getRegisteredFontNames():
+            return self.font_name
+        try:
+            pdfmetrics.registerFont(
+                TTFont(self.font_name, settings.SHOPPING_LIST_PDF_FONT))
+        except (OSError, TTFError):
+            # Без TTF-шрифта кириллица не отобразится, но файл соберётся.
+            return 'Helvetica'
+        return self.font_name
+
+    def get_lines(self):
+        yield f'Список покупок от {self.created}'
+        yield ''
+        for item in self.shopping_list.ingredients:
+            yield (f"□ {item['name'].capitalize()} — "
+                   f"{item['total_amount']} {item['measurement_unit']}")
+        yield ''
+        yield 'Для рецептов:'
+        for name in self.shopping_list.recipes:
+            yield f'• {name}'
+
+    def render(self):
+        buffer = io.BytesIO()
+        font = self.get_font()
+        _, height = A4
+        document = canvas.Canvas(buffer, pagesize=A4)
+        document.setTitle('Список покупок')
+        document.setFont(font, self.font_size)
+        y = height - self.margin
+        for line in self.get_lines():
+            if y < self.margin:
+                document.showPage()
+                document.setFont(font, self.font_size)
+                y = height - self.margin
+            document.drawString(self.margin, y, line)
+            y -= self.line_height
+        document.save()
+        buffer.seek(0)
+        while chunk := buffer.read(CHUNK_SIZE):
+            yield chunk
@@ -1,6 +1,7 @@
 from rest_framework.filters import SearchFilter
 import django_filters
 from recipes.models import Recipe
+from recipes.search import search_recipes
 
 class NameSearchFilter(SearchFilter):
     search_param = 'name'
@@ -12,10 +13,11 @@ class RecipeShoppingListFilter(django_filters.FilterSet):
         )
     is_favorited = django_filters.NumberFilter(method='filter_is_favorited')
     author = django_filters.NumberFilter(field_name='author__id')
+    search = django_filters.CharFilter(method='filter_search')
 
     class Meta:
         model = Recipe
-        fields = ('is_in_shopping_cart', 'is_favorited')
+        fields = ('is_in_shopping_cart', 'is_favorited', 'search')
 
     def filter_in_shopping_cart(self, queryset, name, value):
         # return queryset.filter(recipe_in_list__user=user)
@@ -31,3 +33,9 @@ class RecipeShoppingListFilter(django_filters.FilterSet):
             if self.request.user.is_authenticated:
                 return queryset.filter(favorites__user=self.request.user)
             # Не фильтровать по автору, если пользователь неавторизован
+            return queryset
+        return queryset
+
+    def filter_search(self, queryset, name, value):
+        # Полнотекстовый поиск по названию и описанию, лучшие первыми
+        return search_recipes(queryset, value)
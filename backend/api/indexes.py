@@ -0,0 +1,355 @@
+import bisect
+import hashlib
+import itertools
+import json
+import logging
+import threading
+import time
+from array import array
+from collections import Counter, namedtuple
+
+from asgiref.sync import sync_to_async
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, transaction
+from django.http import HttpResponse
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import http_date
+
+from recipes.models import Ingredient, RecipeIngredient
+
+logger = logging.getLogger(__name__)
+
+
+class InMemoryIndex:
+    """Индекс в памяти процесса, который лениво перестраивается.
+
+    Версия индекса хранится в кэше Django: invalidate() увеличивает её,
+    и каждый процесс, заметив новую версию, строит индекс заново.
+    С общим бэкендом кэша версия видна всем воркерам, с локальным —
+    только тому процессу, где случилось изменение.
+    """
+
+    version_key = None
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._version = None
+
+    def build(self):
+        raise NotImplementedError
+
+    def refresh(self, version):
+        """Индекс для новой версии; по умолчанию строится заново."""
+        return self.build()
+
+    def get(self):
+        version = cache.get(self.version_key, 0)
+        data = self._data
+        if data is None or self._version != version:
+            with self._lock:
+                if self._data is None or self._version != version:
+                    self._data = self.refresh(version)
+                    self._version = version
+                data = self._data
+        return data
+
+    async def aget(self):
+        """get() для асинхронных представлений.
+
+        Версия читается через асинхронный API кэша; если индекс нужно
+        перестроить, запрос к базе идёт в потоке.
+        """
+        version = await cache.aget(self.version_key, 0)
+        data = self._data
+        if data is not None and self._version == version:
+            return data
+        return await sync_to_async(self.get)()
+
+    def warm(self):
+        """Строит индекс заранее; без готовой базы он построится позже."""
+        try:
+            self.get()
+        except DatabaseError:
+            logger.warning('Индекс %s не построен при старте',
+                           type(self).__name__, exc_info=True)
+
+    def invalidate(self):
+        try:
+            cache.incr(self.version_key)
+        except ValueError:
+            # Версию вытеснили из кэша: новая не должна совпасть с той,
+            # под которой процесс уже построил индекс
+            cache.set(self.version_key, time.time_ns(), None)
+
+
+class IngredientSnapshot:
+    """Отсортированные по названию в нижнем регистре ингредиенты.
+
+    Кроме массивов для поиска хранит весь справочник, заранее
+    сериализованный в компактный JSON, и его хэш для ETag.
+    """
+
+    def __init__(self, ingredients):
+        rows = sorted(
+            (name.lower(), name, measurement_unit, ingredient_id)
+            for ingredient_id, name, measurement_unit in ingredients
+        )
+        self.keys = [row[0] for row in rows]
+        self.items = [
+            {'id': ingredient_id, 'name': name,
+             'measurement_unit': measurement_unit}
+            for _, name, measurement_unit, ingredient_id in rows
+        ]
+        # Тот же формат, что у JSONRenderer DRF с настройками по умолчанию
+        self.catalog = json.dumps(
+            self.items, ensure_ascii=False, separators=(',', ':')
+        ).encode('utf-8')
+        self.etag = f'"{hashlib.sha256(self.catalog).hexdigest()[:32]}"'
+        self.last_modified = int(time.time())
+
+    def search(self, terms, limit=None):
+        """Ингредиенты, название которых начинается с каждого из terms.
+
+        Так же работает NameSearchFilter с '^name': условия istartswith
+        объединяются через AND. Все термины могут быть префиксами одного
+        названия, только если они префиксы самого длинного из них.
+        """
+        terms = [term.lower() for term in terms]
+        prefix = max(terms, key=len)
+        if not all(prefix.startswith(term) for term in terms):
+            return []
+        start = bisect.bisect_left(self.keys, prefix)
+        end = len(self.keys) if limit is None else start + limit
+        result = []
+        for index in range(start, min(end, len(self.keys))):
+            if not self.keys[index].startswith(prefix):
+                break
+            result.append(self.items[index])
+        return result
+
+
+class IngredientIndex(InMemoryIndex):
+    version_key = 'ingredient-index-version'
+
+    def build(self):
+        # Индекс перестраивается сразу после изменения, которое реплика
+        # могла ещё не получить, а живёт до следующего: читаем из
+        # основной базы
+        return IngredientSnapshot(
+            Ingredient.objects.using(DEFAULT_DB_ALIAS).values_list(
+                'id', 'name', 'measurement_unit'))
+
+    def search(self, terms, limit=None):
+        return self.get().search(terms, limit)
+
+    def catalog_response(self, request, snapshot=None):
+        """Весь справочник готовыми байтами или 304 Not Modified."""
+        if snapshot is None:
+            snapshot = self.get()
+        response = HttpResponse(snapshot.catalog,
+                                content_type='application/json')
+        response['ETag'] = snapshot.etag
+        response['Last-Modified'] = http_date(snapshot.last_modified)
+        # Клиент может хранить ответ, но обязан его перепроверять
+        patch_cache_control(response, no_cache=True)
+        return get_conditional_response(
+            request, etag=snapshot.etag,
+            last_modified=snapshot.last_modified, response=response)
+
+
+ingredient_index = IngredientIndex()
+
+
+PantryMatch = namedtuple('PantryMatch', 'recipe_id matched missing')
+
+
+class PantrySnapshot:
+    """Обратный индекс: ингредиент -> рецепты, в которых он есть.
+
+    Рецепты пронумерованы; для каждого ингредиента хранится массив
+    номеров его рецептов, для каждого рецепта — его ингредиенты и их
+    число. Подбор по продуктам — подсчёт номеров в массивах выбранных
+    ингредиентов, без GROUP BY по RecipeIngredient.
+    """
+
+    def __init__(self, rows=()):
+        """rows — пары (recipe_id, ingredient_id) по возрастанию
+        recipe_id."""
+        self.recipe_ids = array('q')
+        self.sizes = array('H')
+        self.ingredients = []
+        self.positions = {}
+        self.postings = {}
+        for recipe_id, group in itertools.groupby(
+                rows, key=lambda row: row[0]):
+            self.add_recipe(recipe_id)
+            self.set_ingredients(
+                self.positions[recipe_id],
+                [ingredient_id for _, ingredient_id in group])
+
+    def add_recipe(self, recipe_id):
+        self.positions[recipe_id] = len(self.recipe_ids)
+        self.recipe_ids.append(recipe_id)
+        self.sizes.append(0)
+        self.ingredients.append(())
+
+    def set_ingredients(self, position, ingredient_ids):
+        for ingredient_id in self.ingredients[position]:
+            self.postings[ingredient_id].remove(position)
+        for ingredient_id in ingredient_ids:
+            self.postings.setdefault(ingredient_id, array('I')).append(
+                position)
+        self.ingredients[position] = tuple(ingredient_ids)
+        self.sizes[position] = len(ingredient_ids)
+
+    def replace(self, compositions):
+        """Копия индекса с новым составом рецептов.
+
+        compositions — словарь recipe_id -> ингредиенты; у удалённого
+        рецепта их нет, и он больше не находится. Копируются списки
+        рецептов и массивы затронутых ингредиентов, а не весь индекс:
+        запросы, которые ещё читают старый снимок, его не заметят.
+        """
+        snapshot = PantrySnapshot()
+        snapshot.recipe_ids = array('q', self.recipe_ids)
+        snapshot.sizes = array('H', self.sizes)
+        snapshot.ingredients = list(self.ingredients)
+        snapshot.positions = dict(self.positions)
+        snapshot.postings = dict(self.postings)
+        changed = set()
+        for recipe_id, ingredient_ids in compositions.items():
+            changed.update(ingredient_ids)
+            if recipe_id in self.positions:
+                changed.update(
+                    self.ingredients[self.positions[recipe_id]])
+        for ingredient_id in changed:
+            snapshot.postings[ingredient_id] = array(
+                'I', self.postings.get(ingredient_id, ()))
+        for recipe_id, ingredient_ids in compositions.items():
+            if recipe_id not in snapshot.positions:
+                if not ingredient_ids:
+                    continue
+                snapshot.add_recipe(recipe_id)
+            snapshot.set_ingredients(
+                snapshot.positions[recipe_id], ingredient_ids)
+        return snapshot
+
+    def match(self, ingredient_ids, max_missing=None):
+        """Рецепты, где есть хотя бы один из ingredient_ids.
+
+        Первыми идут рецепты с большей долей имеющихся ингредиентов,
+        при равной доле — с меньшим числом недостающих, затем новые.
+        """
+        counts = Counter()
+        for ingredient_id in set(ingredient_ids):
+            counts.update(self.postings.get(ingredient_id, ()))
+        matches = []
+        for position, matched in counts.items():
+            missing = self.sizes[position] - matched
+            if max_missing is None or missing <= max_missing:
+                matches.append(PantryMatch(
+                    self.recipe_ids[position], matched, missing))
+        matches.sort(key=lambda match: (
+            -match.matched / (match.matched + match.missing),
+            match.missing, -match.recipe_id))
+        return matches
+
+
+class PantryUpdate:
+    """Обновление индекса продуктов после фиксации транзакции.
+
+    Одно на транзакцию: каскадное удаление рецепта или замена состава
+    меняет много строк RecipeIngredient, а обновить нужно один рецепт.
+    """
+
+    def __init__(self, index):
+        self.index = index
+        self.recipe_ids = set()
+        self.done = False
+
+    def __call__(self):
+        self.done = True
+        self.index.invalidate(self.recipe_ids)
+
+
+class PantryIndex(InMemoryIndex):
+    """Индекс продуктов, который обновляется по изменённым рецептам.
+
+    invalidate(recipe_ids) кроме новой версии кладёт в кэш список
+    изменённых рецептов. Процесс со старой версией читает из базы
+    только их состав и применяет к своему снимку. Заново индекс
+    строится при первом запросе процесса, после invalidate() без
+    рецептов (загрузка через bulk_create) и если список изменений
+    вытеснен из кэша или их накопилось больше MAX_CHANGES.
+    """
+
+    version_key = 'pantry-index-version'
+    MAX_CHANGES = 100
+    CHANGES_TIMEOUT = 60 * 60
+
+    def build(self):
+        # Как и IngredientIndex, читаем из основной базы
+        return PantrySnapshot(
+            RecipeIngredient.objects.using(DEFAULT_DB_ALIAS)
+            .order_by('recipe_id')
+            .values_list('recipe_id', 'ingredient_id')
+            .iterator(chunk_size=10000))
+
+    def get_changes_key(self, version):
+        return f'{self.version_key}:{version}'
+
+    def invalidate(self, recipe_ids=None):
+        if not recipe_ids:
+            return super().invalidate()
+        try:
+            version = cache.incr(self.version_key)
+        except ValueError:
+            return super().invalidate()
+        cache.set(self.get_changes_key(version), list(recipe_ids),
+                  self.CHANGES_TIMEOUT)
+
+    def invalidate_on_commit(self, recipe_id, using=None):
+        """invalidate() рецепта после фиксации текущей транзакции."""
+        connection = transaction.get_connection(using)
+        # Обновление из того же блока atomic: при откате точки сохранения
+        # оно пропадёт вместе с изменениями
+        savepoint_ids = set(connection.savepoint_ids)
+        for callback_savepoint_ids, callback, _ in connection.run_on_commit:
+            if (isinstance(callback, PantryUpdate) and not callback.done
+                    and callback_savepoint_ids == savepoint_ids):
+                callback.recipe_ids.add(recipe_id)
+                return
+        update = PantryUpdate(self)
+        update.recipe_ids.add(recipe_id)
+        transaction.on_commit(update, using=using)
+
+    def get_changes(self, version):
+        """Рецепты, изменённые после версии снимка, или None."""
+        if not 0 < version - self._version <= self.MAX_CHANGES:
+            return None
+        keys = [self.get_changes_key(number)
+                for number in range(self._version + 1, version + 1)]
+        changes = cache.get_many(keys)
+        if len(changes) != len(keys):
+            return None
+        return set(itertools.chain.from_iterable(changes.values()))
+
+    def refresh(self, version):
+        recipe_ids = (None if self._data is None
+                      else self.get_changes(version))
+        if recipe_ids is None:
+            return self.build()
+        compositions = {recipe_id: [] for recipe_id in recipe_ids}
+        for recipe_id, ingredient_id in (
+                RecipeIngredient.objects.using(DEFAULT_DB_ALIAS)
+                .filter(recipe_id__in=recipe_ids)
+                .values_list('recipe_id', 'ingredient_id')):
+            compositions[recipe_id].append(ingredient_id)
+        return self._data.replace(compositions)
+
+    def match(self, ingredient_ids, max_missing=None):
+        return self.get().match(ingredient_ids, max_missing)
+
+
+pantry_index = PantryIndex()
@@ -0,0 +1,322 @@
+"""Нагрузочное сравнение режимов WSGI и ASGI на горячих путях чтения.
+
+Запросы идут прямо в обработчики Django (WSGIHandler и ASGIHandler) без
+сетевого сервера. В режиме WSGI их параллельно выполняют потоки, как
+воркер gunicorn с --threads; в режимах ASGI — задачи одного цикла
+событий, как воркер uvicorn. Используется командами benchmark_load и
+benchmark_connections.
+"""
+import asyncio
+import io
+import sys
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from urllib.parse import quote
+
+from django.core.handlers.asgi import ASGIHandler
+from django.core.handlers.wsgi import WSGIHandler
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.test.utils import override_settings
+
+from .benchmark import SCENARIOS, percentile, prepare_request
+from .indexes import ingredient_index
+
+# Сценарии из api/benchmark.py, которые обслуживают асинхронные
+# представления
+LOAD_SCENARIOS = (
+    'recipes-list',
+    'recipes-list:auth',
+    'recipes-detail',
+    'ingredients-list:search',
+    'users-follow-list',
+    'short-link',
+)
+
+# Режим: (обработчик, urlconf)
+MODES = {
+    'wsgi': ('wsgi', 'foodgram.urls'),
+    # Синхронные представления под ASGI: каждое в своём потоке
+    'asgi:sync': ('asgi', 'foodgram.urls'),
+    'asgi': ('asgi', 'foodgram.asgi_urls'),
+}
+
+
+@dataclass
+class LoadResult:
+    scenario: str
+    mode: str
+    durations: list = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    elapsed: float = 0
+    expected_status: int = 200
+
+    @property
+    def errors(self):
+        return sum(count for status, count in self.statuses.items()
+                   if status != self.expected_status)
+
+    @property
+    def rps(self):
+        return len(self.durations) / self.elapsed if self.elapsed else 0
+
+    def add_responses(self, responses):
+        for duration, status in responses:
+            self.durations.append(duration)
+            self.statuses[status] += 1
+
+    def percentile_ms(self, percent):
+        return percentile(self.durations, percent) * 1000
+
+    def as_dict(self):
+        return {
+            'requests': len(self.durations),
+            'errors': self.errors,
+            'rps': round(self.rps, 1),
+            'p50_ms': round(self.percentile_ms(50), 2),
+            'p95_ms': round(self.percentile_ms(95), 2),
+            'p99_ms': round(self.percentile_ms(99), 2),
+        }
+
+
+def split_path(path):
+    """Путь и строка запроса в ASCII, как их передаёт HTTP-клиент."""
+    path, _, query = path.partition('?')
+    return quote(path), quote(query, safe='=&')
+
+
+def wsgi_request(handler, path, headers, method='GET', body=b''):
+    path, query = split_path(path)
+    environ = {
+        'REQUEST_METHOD': method,
+        'SCRIPT_NAME': '',
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'REMOTE_ADDR': '127.0.0.1',
+        'HTTP_HOST': 'testserver',
+        'wsgi.version': (1, 0),
+        'wsgi.url_scheme': 'http',
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+        **headers,
+    }
+    if body:
+        environ.update(CONTENT_TYPE='application/json',
+                       CONTENT_LENGTH=str(len(body)))
+    statuses = []
+    response = handler(
+        environ, lambda status, response_headers, exc_info=None:
+        statuses.append(int(status.split()[0])))
+    try:
+        for _ in response:
+            pass
+    finally:
+        # close() отправляет request_finished
+        response.close()
+    return statuses[0]
+
+
+async def asgi_request(application, path, headers):
+    path, query = split_path(path)
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': 'GET',
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'root_path': '',
+        'headers': [(b'host', b'testserver'), *(
+            (name[5:].replace('_', '-').lower().encode(), value.encode())
+            for name, value in headers.items())],
+        'client': ('127.0.0.1', 0),
+        'server': ('testserver', 80),
+    }
+    body_sent = False
+    finished = asyncio.Event()
+    statuses = []
+
+    async def receive():
+        nonlocal body_sent
+        if not body_sent:
+            body_sent = True
+            return {'type': 'http.request', 'body': b'', 'more_body': False}
+        # Клиент не отключается, пока ответ не отправлен
+        await finished.wait()
+        return {'type': 'http.disconnect'}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            statuses.append(message['status'])
+
+    try:
+        await application(scope, receive, send)
+    finally:
+        finished.set()
+    return statuses[0]
+
+
+def run_wsgi(path, headers, requests, concurrency):
+    handler = WSGIHandler()
+
+    def request(_):
+        start = time.perf_counter()
+        status = wsgi_request(handler, path, headers)
+        return time.perf_counter() - start, status
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        start = time.perf_counter()
+        results = list(executor.map(request, range(requests)))
+        elapsed = time.perf_counter() - start
+    return results, elapsed
+
+
+def run_asgi(path, headers, requests, concurrency):
+    application = ASGIHandler()
+    results = []
+
+    async def worker(remaining):
+        while remaining:
+            remaining.pop()
+            start = time.perf_counter()
+            status = await asgi_request(application, path, headers)
+            results.append((time.perf_counter() - start, status))
+
+    async def run():
+        remaining = list(range(requests))
+        start = time.perf_counter()
+        await asyncio.gather(*(worker(remaining)
+                               for _ in range(concurrency)))
+        return time.perf_counter() - start
+
+    elapsed = asyncio.run(run())
+    return results, elapsed
+
+
+RUNNERS = {'wsgi': run_wsgi, 'asgi': run_asgi}
+
+
+def run_load(dataset, scenarios=LOAD_SCENARIOS, modes=tuple(MODES),
+             requests=1000, concurrency=64, warmup=20):
+    """Гоняет каждый сценарий в каждом режиме и возвращает LoadResult.
+
+    Перед замером выполняется warmup запросов: так кэши рецептов и
+    индексы одинаково прогреты во всех режимах.
+    """
+    ingredient_index.warm()
+    by_name = {scenario.name: scenario for scenario in SCENARIOS}
+    results = []
+    for name in scenarios:
+        scenario = by_name[name]
+        _, path, headers = prepare_request(scenario, dataset)
+        for mode in modes:
+            handler, urlconf = MODES[mode]
+            runner = RUNNERS[handler]
+            with override_settings(ROOT_URLCONF=urlconf):
+                if warmup:
+                    runner(path, headers, warmup, min(warmup, concurrency))
+                responses, elapsed = runner(
+                    path, headers, requests, concurrency)
+            result = LoadResult(name, mode, elapsed=elapsed,
+                                expected_status=scenario.status)
+            result.add_responses(responses)
+            results.append(result)
+    return results
+
+
+def get_connection_modes():
+    """Способы работы с соединениями, доступные для текущей базы.
+
+    Пул есть только у PostgreSQL с psycopg 3.
+    """
+    modes = ['per-request', 'persistent']
+    if connection.vendor == 'postgresql':
+        from django.db.backends.postgresql.psycopg_any import is_psycopg3
+        if is_psycopg3:
+            modes.append('pool')
+    return modes
+
+
+@contextmanager
+def connection_mode(mode, pool_size):
+    """Временно меняет настройки соединения default для всех потоков.
+
+    Обёртки соединений в потоках создаются из того же settings_dict,
+    поэтому изменения видны и им.
+    """
+    settings_dict = connection.settings_dict
+    saved = {key: settings_dict[key]
+             for key in ('CONN_MAX_AGE', 'CONN_HEALTH_CHECKS', 'OPTIONS')}
+    options = {key: value for key, value in settings_dict['OPTIONS'].items()
+               if key != 'pool'}
+    connection.close()
+    if mode == 'per-request':
+        settings_dict.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False,
+                             OPTIONS=options)
+    elif mode == 'persistent':
+        settings_dict.update(CONN_MAX_AGE=None, CONN_HEALTH_CHECKS=True,
+                             OPTIONS=options)
+    else:
+        settings_dict.update(CONN_MAX_AGE=0, CONN_HEALTH_CHECKS=False,
+                             OPTIONS={**options, 'pool': {
+                                 'min_size': 1, 'max_size': pool_size}})
+    try:
+        yield
+    finally:
+        connection.close()
+        if mode == 'pool':
+            connection.close_pool()
+        settings_dict.update(saved)
+
+
+@dataclass
+class ConnectionResult(LoadResult):
+    # Сколько раз открывалось новое соединение с базой
+    connects: int = 0
+
+    def as_dict(self):
+        return {**super().as_dict(), 'connects': self.connects}
+
+
+def run_connections(dataset, scenario='short-link', modes=None,
+                    requests=500, concurrency=1):
+    """Задержка дешёвого маршрута при разных способах работы с
+    соединениями.
+
+    Запросы идут через WSGIHandler: он, как сервер, закрывает устаревшие
+    соединения в начале и в конце запроса. Новые физические соединения
+    считаются по объектам DB-API: из пула приходят уже открытые.
+    """
+    scenario = {item.name: item for item in SCENARIOS}[scenario]
+    _, path, headers = prepare_request(scenario, dataset)
+    results = []
+    for mode in modes or get_connection_modes():
+        opened = {}
+
+        def count(connection, **kwargs):
+            opened[id(connection.connection)] = connection.connection
+
+        with connection_mode(mode, pool_size=concurrency):
+            connection_created.connect(count)
+            try:
+                responses, elapsed = run_wsgi(
+                    path, headers, requests, concurrency)
+            finally:
+                connection_created.disconnect(count)
+        result = ConnectionResult(
+            scenario.name, mode, elapsed=elapsed,
+            expected_status=scenario.status, connects=len(opened))
+        result.add_responses(responses)
+        results.append(result)
+    return results
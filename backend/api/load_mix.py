@@ -0,0 +1,399 @@
+"""Синтетическая нагрузка смесью запросов API.
+
+Смесь — взвешенный список операций из docs/openapi-schema.yml: просмотр
+и фильтры рецептов, избранное, список покупок и его скачивание,
+подписки и загрузка аватара. Запросы идут от пользователей нагрузки,
+у каждого свой токен. Их выполняют потоки либо прямо в WSGIHandler
+(как в api/load_benchmark.py), либо по HTTP к запущенному серверу,
+например gunicorn на localhost. Итог — RPS, перцентили и гистограмма
+задержек по каждой операции. Используется командой load_test.
+"""
+import http.client
+import json
+import math
+import random
+import threading
+import time
+from bisect import bisect_left
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Callable, Optional
+from urllib.parse import urlencode, urlsplit
+
+import yaml
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.contrib.auth.hashers import make_password
+from django.core.handlers.wsgi import WSGIHandler
+from rest_framework.authtoken.models import Token
+
+from recipes.models import Ingredient, Recipe
+
+from .benchmark import IMAGE, PASSWORD, percentile
+from .load_benchmark import split_path, wsgi_request
+from .pagination import PageLimitPagination
+
+User = get_user_model()
+
+# Границы корзин гистограммы задержек, мс; последняя корзина — больше
+# наибольшей границы
+BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500)
+
+# Сколько последних рецептов и ингредиентов попадает в смесь
+SAMPLE_SIZE = 1000
+
+# Просмотр идёт по первым страницам списка рецептов
+MAX_PAGE = 20
+
+# Статус 0 — запрос не дошёл до сервера
+CONNECTION_ERROR = 0
+
+# Так обрывается соединение keep-alive, которое сервер закрыл, пока оно
+# простаивало (RemoteDisconnected — подкласс ConnectionResetError).
+# Таймаут сюда не входит: сервер мог получить запрос и ещё работать.
+STALE_CONNECTION_ERRORS = (BrokenPipeError, ConnectionResetError)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+
+def default_schema_path():
+    return settings.BASE_DIR.parent / 'docs' / 'openapi-schema.yml'
+
+
+@dataclass
+class LoadContext:
+    """Данные, из которых собираются запросы смеси."""
+    tokens: list
+    recipes: list
+    authors: list
+    words: list
+    prefixes: list
+    # Страниц в списке рецептов, не больше MAX_PAGE
+    pages: int = 1
+
+
+@dataclass
+class Operation:
+    """Операция схемы API с долей в смеси.
+
+    path — шаблон пути из схемы; params строит по контексту и генератору
+    случайных чисел подстановки в путь и строку запроса, body — тело
+    JSON. Статусы из statuses ошибками не считаются: повторное
+    добавление в избранное или удаление отсутствующего — обычная часть
+    смеси.
+    """
+    name: str
+    method: str
+    path: str
+    weight: int
+    params: Optional[Callable] = None
+    body: Optional[Callable] = None
+    statuses: tuple = (200,)
+    anonymous: bool = False
+
+    def build(self, context, rng):
+        """Метод, путь, заголовки и тело запроса."""
+        params = self.params(context, rng) if self.params else {}
+        path = self.path.format(**params)
+        query = {key: value for key, value in params.items()
+                 if f'{{{key}}}' not in self.path}
+        if query:
+            path = f'{path}?{urlencode(query)}'
+        headers = {}
+        if not self.anonymous:
+            headers['Authorization'] = f'Token {rng.choice(context.tokens)}'
+        body = b''
+        if self.body:
+            body = json.dumps(self.body(context, rng)).encode()
+        return self.method.upper(), path, headers, body
+
+
+def recipe(context, rng):
+    return {'id': rng.choice(context.recipes)}
+
+
+def author(context, rng):
+    return {'id': rng.choice(context.authors)}
+
+
+def page(context, rng):
+    return {'page': rng.randint(1, context.pages)}
+
+
+def recipe_filter(context, rng):
+    return rng.choice((
+        {'author': rng.choice(context.authors)},
+        {'is_favorited': 1},
+        {'is_in_shopping_cart': 1},
+        {'search': rng.choice(context.words)},
+    ))
+
+
+def ingredient_prefix(context, rng):
+    return {'name': rng.choice(context.prefixes)}
+
+
+MIX = (
+    Operation('browse', 'get', '/api/recipes/', 20, page, anonymous=True),
+    Operation('browse:auth', 'get', '/api/recipes/', 15, page),
+    Operation('filter', 'get', '/api/recipes/', 10, recipe_filter),
+    Operation('recipe', 'get', '/api/recipes/{id}/', 15, recipe),
+    Operation('ingredients', 'get', '/api/ingredients/', 8,
+              ingredient_prefix, anonymous=True),
+    Operation('favorite', 'post', '/api/recipes/{id}/favorite/', 4, recipe,
+              statuses=(201, 400)),
+    Operation('unfavorite', 'delete', '/api/recipes/{id}/favorite/', 3,
+              recipe, statuses=(204, 404)),
+    Operation('cart', 'post', '/api/recipes/{id}/shopping_cart/', 4, recipe,
+              statuses=(201, 400)),
+    Operation('uncart', 'delete', '/api/recipes/{id}/shopping_cart/', 3,
+              recipe, statuses=(204, 404)),
+    Operation('download', 'get', '/api/recipes/download_shopping_cart/', 2),
+    Operation('subscriptions', 'get', '/api/users/subscriptions/', 4),
+    Operation('subscribe', 'post', '/api/users/{id}/subscribe/', 2, author,
+              statuses=(201, 400)),
+    Operation('unsubscribe', 'delete', '/api/users/{id}/subscribe/', 2,
+              author, statuses=(204, 404)),
+    Operation('avatar', 'put', '/api/users/me/avatar/', 1,
+              body=lambda context, rng: {'avatar': IMAGE}),
+)
+
+
+def check_mix(mix, schema_path):
+    """Проверяет, что операции смеси описаны в схеме API.
+
+    Возвращает краткие описания операций из схемы по имени операции.
+    """
+    with open(schema_path, encoding='utf-8') as file:
+        paths = yaml.safe_load(file)['paths']
+    summaries, missing = {}, []
+    for operation in mix:
+        described = paths.get(operation.path, {}).get(operation.method)
+        if described is None:
+            missing.append(
+                f'{operation.method.upper()} {operation.path}')
+        else:
+            summaries[operation.name] = described.get('summary', '')
+    if missing:
+        raise ValueError(
+            'В схеме API нет операций: ' + ', '.join(missing))
+    return summaries
+
+
+def seed_load_users(count, batch_size=1000):
+    """Создаёт пользователей нагрузки load<N> с токенами.
+
+    Повторный вызов берёт уже созданных, поэтому команду можно запускать
+    против одной базы сколько угодно раз. Возвращает ключи токенов.
+    """
+    emails = [f'load{index}@example.com' for index in range(count)]
+    existing = set(User.objects.filter(
+        email__in=emails).values_list('email', flat=True))
+    password = make_password(PASSWORD)
+    User.objects.bulk_create(
+        (User(email=email, username=email.split('@')[0],
+              first_name='Нагрузка', last_name=email.split('@')[0],
+              password=password)
+         for email in emails if email not in existing),
+        batch_size=batch_size, ignore_conflicts=True)
+    users = list(User.objects.filter(email__in=emails).values_list(
+        'id', flat=True))
+    with_token = set(Token.objects.filter(
+        user_id__in=users).values_list('user_id', flat=True))
+    Token.objects.bulk_create(
+        (Token(user_id=user, key=Token.generate_key())
+         for user in users if user not in with_token),
+        batch_size=batch_size)
+    return list(Token.objects.filter(user_id__in=users).values_list(
+        'key', flat=True))
+
+
+def load_context(tokens, sample_size=SAMPLE_SIZE):
+    """Контекст из последних рецептов базы и их авторов."""
+    recipes = list(Recipe.objects.order_by('-id').values_list(
+        'id', 'author_id', 'name')[:sample_size])
+    if not recipes:
+        raise ValueError('В базе нет рецептов для нагрузки')
+    names = Ingredient.objects.order_by('id').values_list(
+        'name', flat=True)[:sample_size]
+    return LoadContext(
+        tokens=tokens,
+        recipes=[pk for pk, _, _ in recipes],
+        authors=sorted({author for _, author, _ in recipes}),
+        words=sorted({word for _, _, name in recipes
+                      for word in name.split() if len(word) > 2})
+        or ['рецепт'],
+        prefixes=sorted({name[:2] for name in names}) or ['а'],
+        pages=min(MAX_PAGE, math.ceil(
+            Recipe.objects.count() / PageLimitPagination.page_size)),
+    )
+
+
+@dataclass
+class MixResult:
+    operation: str
+    method: str
+    path: str
+    expected: tuple
+    durations: list = field(default_factory=list)
+    statuses: Counter = field(default_factory=Counter)
+    elapsed: float = 0
+
+    @property
+    def errors(self):
+        return sum(count for status, count in self.statuses.items()
+                   if status not in self.expected)
+
+    @property
+    def rps(self):
+        return len(self.durations) / self.elapsed if self.elapsed else 0
+
+    def percentile_ms(self, percent):
+        return percentile(self.durations, percent) * 1000
+
+    def histogram(self):
+        """Число запросов в каждой корзине BUCKETS_MS и за последней."""
+        counts = [0] * (len(BUCKETS_MS) + 1)
+        for duration in self.durations:
+            counts[bisect_left(BUCKETS_MS, duration * 1000)] += 1
+        return counts
+
+    def as_dict(self):
+        return {
+            'method': self.method,
+            'path': self.path,
+            'requests': len(self.durations),
+            'errors': self.errors,
+            'statuses': {str(status): count
+                         for status, count in sorted(self.statuses.items())},
+            'rps': round(self.rps, 1),
+            'p50_ms': round(self.percentile_ms(50), 2),
+            'p95_ms': round(self.percentile_ms(95), 2),
+            'p99_ms': round(self.percentile_ms(99), 2),
+            'histogram_ms': dict(zip(
+                [f'<={bound}' for bound in BUCKETS_MS]
+                + [f'>{BUCKETS_MS[-1]}'], self.histogram())),
+        }
+
+
+class InProcessTransport:
+    """Запросы прямо в WSGIHandler текущего процесса."""
+
+    def __init__(self):
+        self.handler = WSGIHandler()
+
+    def request(self, method, path, headers, body):
+        headers = {f'HTTP_{name.upper().replace("-", "_")}': value
+                   for name, value in headers.items()}
+        return wsgi_request(self.handler, path, headers, method, body)
+
+    def close(self):
+        pass
+
+
+class HttpTransport:
+    """Запросы по HTTP; у каждого потока своё соединение keep-alive."""
+
+    def __init__(self, url, timeout=30):
+        url = urlsplit(url)
+        self.connection_class = (http.client.HTTPSConnection
+                                 if url.scheme == 'https'
+                                 else http.client.HTTPConnection)
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.local = threading.local()
+        self.connections = []
+
+    def get_connection(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is None:
+            connection = self.connection_class(
+                self.netloc, timeout=self.timeout)
+            self.local.connection = connection
+            self.connections.append(connection)
+        return connection
+
+    def request(self, method, path, headers, body):
+        path, query = split_path(path)
+        path = self.prefix + path + (f'?{query}' if query else '')
+        headers = {**headers, 'Content-Type': 'application/json'}
+        for _ in range(2):
+            connection = self.get_connection()
+            # Сокет открыт — соединение уже обслужило запрос
+            reused = connection.sock is not None
+            sent = False
+            try:
+                connection.request(method, path, body or None, headers)
+                sent = True
+                response = connection.getresponse()
+                response.read()
+                return response.status
+            except (OSError, http.client.HTTPException) as error:
+                connection.close()
+                if not self.can_retry(method, reused, sent, error):
+                    return CONNECTION_ERROR
+        return CONNECTION_ERROR
+
+    def can_retry(self, method, reused, sent, error):
+        """Повторять ли запрос на новом соединении.
+
+        Повторяется только обрыв переиспользованного соединения. Если
+        запрос уже отправлен, сервер мог его выполнить, поэтому повтор
+        допустим лишь для идемпотентных методов.
+        """
+        return (reused and isinstance(error, STALE_CONNECTION_ERRORS)
+                and (not sent or method in IDEMPOTENT_METHODS))
+
+    def close(self):
+        for connection in self.connections:
+            connection.close()
+
+
+def run_mix(transport, context, mix=MIX, requests=1000, duration=None,
+            concurrency=16, seed=0):
+    """Выполняет смесь в concurrency потоков и возвращает MixResult.
+
+    Нагрузка заканчивается после requests запросов или, если задано,
+    через duration секунд.
+    """
+    results = {operation.name: MixResult(
+        operation.name, operation.method.upper(), operation.path,
+        operation.statuses) for operation in mix}
+    cum_weights = []
+    for operation in mix:
+        cum_weights.append(
+            (cum_weights[-1] if cum_weights else 0) + operation.weight)
+    counter = iter(range(requests)) if duration is None else None
+    lock = threading.Lock()
+
+    def worker(index):
+        rng = random.Random(seed * 1000 + index)
+        while True:
+            if counter is not None:
+                with lock:
+                    if next(counter, None) is None:
+                        return
+            elif time.perf_counter() >= deadline:
+                return
+            operation = rng.choices(mix, cum_weights=cum_weights)[0]
+            request = operation.build(context, rng)
+            start = time.perf_counter()
+            status = transport.request(*request)
+            elapsed = time.perf_counter() - start
+            result = results[operation.name]
+            with lock:
+                result.durations.append(elapsed)
+                result.statuses[status] += 1
+
+    start = time.perf_counter()
+    deadline = start + (duration or 0)
+    try:
+        with ThreadPoolExecutor(concurrency) as executor:
+            list(executor.map(worker, range(concurrency)))
+    finally:
+        transport.close()
+    elapsed = time.perf_counter() - start
+    for result in results.values():
+        result.elapsed = elapsed
+    return [result for result in results.values() if result.durations]
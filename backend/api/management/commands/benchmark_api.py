@@ -0,0 +1,66 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.benchmark import (BUDGET_PATH, benchmark_environment, check_budget,
+                           load_budget, make_budget, run_scenarios,
+                           seed_dataset)
+
+
+class Command(BaseCommand):
+    help = ('Замеряет число запросов, p50/p95 и размер ответов всех '
+            'маршрутов API на синтетических данных и сверяет с бюджетом')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--recipes', type=int, default=20000)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument('--ingredients', help='Путь к ingredients.json')
+        parser.add_argument('--budget', default=str(BUDGET_PATH))
+        parser.add_argument(
+            '--update-budget', action='store_true',
+            help='Записать текущие замеры как новый бюджет')
+        parser.add_argument(
+            '--headroom', type=float, default=1.5,
+            help='Запас для времени и размера при --update-budget')
+        parser.add_argument('--json', help='Сохранить замеры в файл')
+
+    def handle(self, *args, **options):
+        with benchmark_environment():
+            self.stdout.write(
+                f'Заполнение базы ({connection.vendor}): '
+                f'{options["users"]} пользователей, '
+                f'{options["recipes"]} рецептов')
+            dataset = seed_dataset(
+                users=options['users'], recipes=options['recipes'],
+                ingredients_path=options['ingredients'])
+            results = run_scenarios(dataset, options['iterations'])
+
+        self.report(results)
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as file:
+                json.dump({name: measurement.as_dict()
+                           for name, measurement in results.items()},
+                          file, indent=2)
+        if options['update_budget']:
+            with open(options['budget'], 'w', encoding='utf-8') as file:
+                json.dump(make_budget(results, options['headroom']),
+                          file, indent=2)
+                file.write('\n')
+            self.stdout.write(f'Бюджет записан в {options["budget"]}')
+            return
+        failures = check_budget(results, load_budget(options['budget']))
+        if failures:
+            raise CommandError('Превышен бюджет:\n' + '\n'.join(failures))
+        self.stdout.write(self.style.SUCCESS('Бюджет соблюдён'))
+
+    def report(self, results):
+        self.stdout.write(
+            f'{"сценарий":<40}{"запросы":>8}{"p50, мс":>10}'
+            f'{"p95, мс":>10}{"байт":>10}')
+        for name, measurement in results.items():
+            self.stdout.write(
+                f'{name:<40}{measurement.queries:>8}'
+                f'{measurement.p50_ms:>10.1f}{measurement.p95_ms:>10.1f}'
+                f'{measurement.bytes:>10}')
@@ -0,0 +1,64 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.benchmark import benchmark_environment, seed_dataset
+from api.load_benchmark import get_connection_modes, run_connections
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает задержку дешёвого маршрута с новым соединением на '
+            'каждый запрос, с постоянными соединениями и с пулом')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=100)
+        parser.add_argument('--recipes', type=int, default=1000)
+        parser.add_argument('--ingredients', help='Путь к ingredients.json')
+        parser.add_argument(
+            '--scenario', default='short-link',
+            help='Сценарий из api/benchmark.py')
+        parser.add_argument('--requests', type=int, default=500)
+        parser.add_argument(
+            '--concurrency', type=int, default=1,
+            help='Потоков WSGI; это же размер пула')
+        parser.add_argument(
+            '--modes', help='Через запятую: per-request, persistent, pool')
+        parser.add_argument('--json', help='Сохранить замеры в файл')
+
+    def handle(self, *args, **options):
+        with benchmark_environment():
+            modes = get_connection_modes()
+            if options['modes']:
+                requested = options['modes'].split(',')
+                unavailable = set(requested) - set(modes)
+                if unavailable:
+                    raise CommandError(
+                        'Недоступно для этой базы: '
+                        + ', '.join(sorted(unavailable)))
+                modes = requested
+            if connection.vendor != 'postgresql':
+                self.stderr.write(
+                    'Соединение с SQLite почти ничего не стоит, а тестовая '
+                    'база в памяти не закрывается: разница видна только '
+                    'на PostgreSQL')
+            dataset = seed_dataset(
+                users=options['users'], recipes=options['recipes'],
+                ingredients_path=options['ingredients'])
+            results = run_connections(
+                dataset, options['scenario'], modes,
+                requests=options['requests'],
+                concurrency=options['concurrency'])
+
+        self.stdout.write(
+            f'{"режим":<14}{"соединений":>11}{"RPS":>9}{"p50, мс":>10}'
+            f'{"p95, мс":>10}{"ошибки":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result.mode:<14}{result.connects:>11}{result.rps:>9.1f}'
+                f'{result.percentile_ms(50):>10.1f}'
+                f'{result.percentile_ms(95):>10.1f}{result.errors:>8}')
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as file:
+                json.dump({result.mode: result.as_dict()
+                           for result in results}, file, indent=2)
@@ -0,0 +1,74 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import override_settings
+
+from api.benchmark import benchmark_environment, seed_dataset
+from api.load_benchmark import LOAD_SCENARIOS, MODES, run_load
+
+
+class Command(BaseCommand):
+    help = ('Сравнивает пропускную способность и задержки режимов WSGI и '
+            'ASGI на горячих путях чтения при высокой конкурентности')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--recipes', type=int, default=20000)
+        parser.add_argument('--ingredients', help='Путь к ingredients.json')
+        parser.add_argument(
+            '--requests', type=int, default=1000,
+            help='Запросов на сценарий в каждом режиме')
+        parser.add_argument(
+            '--concurrency', type=int, default=64,
+            help='Одновременных запросов: потоков WSGI или задач ASGI')
+        parser.add_argument('--warmup', type=int, default=20)
+        parser.add_argument(
+            '--modes', default=','.join(MODES),
+            help=f'Режимы через запятую: {", ".join(MODES)}')
+        parser.add_argument(
+            '--scenarios', default=','.join(LOAD_SCENARIOS),
+            help='Сценарии из api/benchmark.py через запятую')
+        parser.add_argument(
+            '--no-cache', action='store_true',
+            help='Отключить кэш рецептов, чтобы нагрузить базу')
+        parser.add_argument('--json', help='Сохранить замеры в файл')
+
+    def handle(self, *args, **options):
+        modes = options['modes'].split(',')
+        unknown = set(modes) - set(MODES)
+        if unknown:
+            raise CommandError(f'Неизвестные режимы: {", ".join(unknown)}')
+        cache_timeout = {'RECIPE_CACHE_TIMEOUT': 0} if options[
+            'no_cache'] else {}
+        with benchmark_environment(), override_settings(**cache_timeout):
+            self.stdout.write(
+                f'Заполнение базы ({connection.vendor}): '
+                f'{options["users"]} пользователей, '
+                f'{options["recipes"]} рецептов')
+            dataset = seed_dataset(
+                users=options['users'], recipes=options['recipes'],
+                ingredients_path=options['ingredients'])
+            results = run_load(
+                dataset, scenarios=options['scenarios'].split(','),
+                modes=modes, requests=options['requests'],
+                concurrency=options['concurrency'],
+                warmup=options['warmup'])
+
+        self.report(results)
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as file:
+                json.dump({f'{result.scenario} {result.mode}':
+                           result.as_dict() for result in results},
+                          file, indent=2)
+
+    def report(self, results):
+        self.stdout.write(
+            f'{"сценарий":<28}{"режим":<11}{"RPS":>9}{"p50, мс":>10}'
+            f'{"p95, мс":>10}{"p99, мс":>10}{"ошибки":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result.scenario:<28}{result.mode:<11}{result.rps:>9.1f}'
+                f'{result.percentile_ms(50):>10.1f}'
+                f'{result.percentile_ms(95):>10.1f}'
+                f'{result.percentile_ms(99):>10.1f}{result.errors:>8}')
@@ -0,0 +1,136 @@
+import json
+from contextlib import nullcontext
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+
+from api.benchmark import benchmark_environment, percentile, seed_dataset
+from api.load_mix import (BUCKETS_MS, MIX, HttpTransport, InProcessTransport,
+                          check_mix, default_schema_path, load_context,
+                          run_mix, seed_load_users)
+
+
+class Command(BaseCommand):
+    help = ('Нагружает API взвешенной смесью запросов из схемы и выводит '
+            'RPS и гистограммы задержек по операциям')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--url',
+            help='Адрес запущенного сервера, например http://localhost:8000; '
+                 'без него запросы идут в процессе на тестовой базе')
+        parser.add_argument('--users', type=int, default=2000)
+        parser.add_argument('--recipes', type=int, default=20000)
+        parser.add_argument('--ingredients', help='Путь к ingredients.json')
+        parser.add_argument(
+            '--load-users', type=int, default=100,
+            help='Пользователей нагрузки с токенами')
+        parser.add_argument('--requests', type=int, default=2000)
+        parser.add_argument(
+            '--duration', type=float,
+            help='Длительность нагрузки в секундах вместо --requests')
+        parser.add_argument(
+            '--concurrency', type=int, default=16,
+            help='Одновременных запросов (потоков клиента)')
+        parser.add_argument(
+            '--operations',
+            help='Операции смеси через запятую: '
+                 + ', '.join(operation.name for operation in MIX))
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument(
+            '--schema', help='Схема API для проверки смеси')
+        parser.add_argument('--json', help='Сохранить замеры в файл')
+
+    def handle(self, *args, **options):
+        mix = MIX
+        if options['operations']:
+            names = options['operations'].split(',')
+            unknown = set(names) - {operation.name for operation in MIX}
+            if unknown:
+                raise CommandError(
+                    f'Неизвестные операции: {", ".join(sorted(unknown))}')
+            mix = tuple(
+                operation for operation in MIX if operation.name in names)
+        schema_path = options['schema'] or default_schema_path()
+        try:
+            check_mix(mix, schema_path)
+        except FileNotFoundError:
+            if options['schema']:
+                raise CommandError(f'Не найдена схема API {schema_path}')
+            self.stderr.write(
+                f'Схема {schema_path} не найдена, смесь не проверена')
+        except ValueError as error:
+            raise CommandError(error)
+
+        # Против сервера пользователи нагрузки создаются в его базе,
+        # рецепты берутся уже существующие
+        with nullcontext() if options['url'] else benchmark_environment():
+            if options['url']:
+                transport = HttpTransport(options['url'])
+            else:
+                self.stdout.write(
+                    f'Заполнение базы ({connection.vendor}): '
+                    f'{options["users"]} пользователей, '
+                    f'{options["recipes"]} рецептов')
+                seed_dataset(
+                    users=options['users'], recipes=options['recipes'],
+                    ingredients_path=options['ingredients'])
+                transport = InProcessTransport()
+            try:
+                context = load_context(seed_load_users(options['load_users']))
+            except ValueError as error:
+                raise CommandError(error)
+            self.stdout.write(
+                f'Нагрузка: {options["concurrency"]} потоков, '
+                + (f'{options["duration"]} с' if options['duration']
+                   else f'{options["requests"]} запросов'))
+            results = run_mix(
+                transport, context, mix, requests=options['requests'],
+                duration=options['duration'],
+                concurrency=options['concurrency'], seed=options['seed'])
+
+        self.report(results)
+        if options['json']:
+            with open(options['json'], 'w', encoding='utf-8') as file:
+                json.dump({result.operation: result.as_dict()
+                           for result in results}, file, indent=2)
+
+    def report(self, results):
+        self.stdout.write(
+            f'{"операция":<15}{"запросов":>9}{"RPS":>9}{"p50, мс":>10}'
+            f'{"p95, мс":>10}{"p99, мс":>10}{"ошибки":>8}')
+        for result in results:
+            self.stdout.write(
+                f'{result.operation:<15}{len(result.durations):>9}'
+                f'{result.rps:>9.1f}{result.percentile_ms(50):>10.1f}'
+                f'{result.percentile_ms(95):>10.1f}'
+                f'{result.percentile_ms(99):>10.1f}{result.errors:>8}')
+        durations = [duration for result in results
+                     for duration in result.durations]
+        elapsed = results[0].elapsed if results else 0
+        self.stdout.write(
+            f'{"всего":<15}{len(durations):>9}'
+            f'{len(durations) / elapsed if elapsed else 0:>9.1f}'
+            f'{percentile(durations, 50) * 1000:>10.1f}'
+            f'{percentile(durations, 95) * 1000:>10.1f}'
+            f'{percentile(durations, 99) * 1000:>10.1f}'
+            f'{sum(result.errors for result in results):>8}')
+
+        self.stdout.write('\nГистограмма задержек, запросов в корзине (мс):')
+        labels = [f'≤{bound:g}' for bound in BUCKETS_MS]
+        labels.append(f'>{BUCKETS_MS[-1]:g}')
+        self.stdout.write(
+            f'{"операция":<15}' + ''.join(f'{label:>7}' for label in labels))
+        for result in results:
+            self.stdout.write(
+                f'{result.operation:<15}'
+                + ''.join(f'{count:>7}' for count in result.histogram()))
+        for result in results:
+            unexpected = {status: count
+                          for status, count in result.statuses.items()
+                          if status not in result.expected}
+            if unexpected:
+                self.stderr.write(
+                    f'{result.operation}: неожиданные статусы '
+                    + ', '.join(f'{status} × {count}' for status, count
+                                in sorted(unexpected.items())))
@@ -0,0 +1,109 @@
+"""Метрики HTTP-запросов и запросов к базе по маршрутам.
+
+MetricsMiddleware считает каждый запрос: число и время ответов по
+маршруту, методу и статусу, а также число и время запросов к базе
+(через execute_wrapper). Маршрут — имя из urlconf, например
+recipes-list или users-follow-list.
+
+Обёртка count_query ставится один раз на каждое соединение при его
+открытии и находит счётчик запроса через ContextVar. Контекст переходит
+в потоки sync_to_async, поэтому под ASGI запросы из потоков тоже
+учитываются, а middleware не переключается в поток ради установки
+обёрток.
+"""
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from foodgram.metrics import (DB_DURATION, DB_QUERIES, REQUEST_DURATION,
+                              REQUESTS, REQUESTS_IN_PROGRESS, UNMATCHED_ROUTE)
+
+# Счётчик текущего HTTP-запроса или None вне запроса
+_counter = ContextVar('query_counter', default=None)
+
+
+class QueryCounter:
+    """Обёртка execute_wrapper: только число и время запросов."""
+
+    def __init__(self):
+        self.queries = 0
+        self.duration = 0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.queries += 1
+
+
+def count_query(execute, sql, params, many, context):
+    counter = _counter.get()
+    if counter is None:
+        return execute(sql, params, many, context)
+    return counter(execute, sql, params, many, context)
+
+
+@receiver(connection_created)
+def install_query_counter(connection, **kwargs):
+    # Соединение открывается заново на том же объекте после закрытия.
+    # Обёртка встаёт первой: execute_wrapper() снимает последнюю
+    if count_query not in connection.execute_wrappers:
+        connection.execute_wrappers.insert(0, count_query)
+
+
+def get_route(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return UNMATCHED_ROUTE
+    return match.view_name or match.route
+
+
+class MetricsMiddleware:
+    """Метрики запросов; работает и под WSGI, и под ASGI."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        counter = QueryCounter()
+        start = time.perf_counter()
+        token = _counter.set(counter)
+        try:
+            with REQUESTS_IN_PROGRESS.track_inprogress():
+                response = self.get_response(request)
+        finally:
+            _counter.reset(token)
+        self.observe(request, response, counter, start)
+        return response
+
+    async def __acall__(self, request):
+        counter = QueryCounter()
+        start = time.perf_counter()
+        token = _counter.set(counter)
+        try:
+            with REQUESTS_IN_PROGRESS.track_inprogress():
+                response = await self.get_response(request)
+        finally:
+            _counter.reset(token)
+        self.observe(request, response, counter, start)
+        return response
+
+    def observe(self, request, response, counter, start):
+        route = get_route(request)
+        REQUESTS.labels(route, request.method, response.status_code).inc()
+        REQUEST_DURATION.labels(route, request.method).observe(
+            time.perf_counter() - start)
+        DB_QUERIES.labels(route).observe(counter.queries)
+        DB_DURATION.labels(route).observe(counter.duration)
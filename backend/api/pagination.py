@@ -1,4 +1,10 @@
-from rest_framework.pagination import PageNumberPagination
+import json
+
+from django.core.paginator import InvalidPage, Page
+from django.db import connection
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import CursorPagination, PageNumberPagination
+from rest_framework.response import Response
 
 
 class PageLimitPagination(PageNumberPagination):
@@ -6,3 +12,103 @@ class PageLimitPagination(PageNumberPagination):
     page_query_param = 'page'
     page_size_query_param = 'limit'
     # Позволяет задавать размер страницы через limit
+
+
+class AsyncPageLimitPagination(PageLimitPagination):
+    """PageLimitPagination для асинхронных представлений.
+
+    COUNT и выборка страницы идут через асинхронный ORM, ссылки и формат
+    ответа те же, что у синхронной пагинации.
+    """
+
+    async def apaginate_queryset(self, queryset, request):
+        self.request = request
+        page_size = self.get_page_size(request)
+        paginator = self.django_paginator_class(queryset, page_size)
+        paginator.count = await queryset.acount()
+        page_number = self.get_page_number(request, paginator)
+        try:
+            number = paginator.validate_number(page_number)
+        except InvalidPage as exc:
+            raise NotFound(self.invalid_page_message.format(
+                page_number=page_number, message=str(exc)))
+        bottom = (number - 1) * page_size
+        objects = [obj async for obj in queryset[bottom:bottom + page_size]]
+        self.page = Page(objects, number, paginator)
+        return objects
+
+
+def estimate_count(queryset):
+    """Примерное число строк из плана запроса PostgreSQL.
+
+    Оценка планировщика не требует прохода по таблице. На других СУБД
+    (SQLite в разработке) выполняется обычный COUNT.
+    """
+    if connection.vendor != 'postgresql':
+        return queryset.count()
+    plan = json.loads(queryset.order_by().explain(format='json'))
+    if isinstance(plan, list):
+        plan = plan[0]
+    return plan['Plan']['Plan Rows']
+
+
+class IdCursorPagination(CursorPagination):
+    """Постраничный вывод по курсору с упорядочиванием по убыванию id.
+
+    Страница выбирается условием id < курсора без OFFSET и без COUNT,
+    поэтому глубокие страницы так же быстры, как первая. Примерное общее
+    число записей добавляется в ответ, только если передан with_count.
+    """
+
+    ordering = '-id'
+    page_size = 6
+    page_size_query_param = 'limit'
+    max_page_size = 100
+    count_query_param = 'with_count'
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.count = None
+        if request.query_params.get(self.count_query_param) in ('1', 'true'):
+            self.count = estimate_count(queryset)
+        return super().paginate_queryset(queryset, request, view)
+
+    def get_paginated_response(self, data):
+        response = {
+            'next': self.get_next_link(),
+            'previous': self.get_previous_link(),
+            'results': data,
+        }
+        if self.count is not None:
+            response = {'count': self.count, **response}
+        return Response(response)
+
+
+class CursorPaginationMixin:
+    """Включает курсорную пагинацию по запросу клиента.
+
+    По умолчанию работает pagination_class. Параметр pagination=cursor
+    или cursor из ссылки next/previous переключает вьюсет на
+    cursor_pagination_class. С параметрами из ranking_query_params
+    остаётся постраничный вывод: курсор упорядочивает по id и потерял
+    бы их порядок (например, ранг поиска).
+    """
+
+    cursor_pagination_class = IdCursorPagination
+    ranking_query_params = ()
+
+    def use_cursor_pagination(self):
+        query_params = self.request.query_params
+        if any(param in query_params for param in self.ranking_query_params):
+            return False
+        return (query_params.get('pagination') == 'cursor'
+                or self.cursor_pagination_class.cursor_query_param
+                in query_params)
+
+    @property
+    def paginator(self):
+        if not hasattr(self, '_paginator'):
+            if self.use_cursor_pagination():
+                self._paginator = self.cursor_pagination_class()
+            else:
+                self._paginator = super().paginator
+        return self._paginator
@@ -0,0 +1,202 @@
+"""Профилирование запросов: куда уходит время ответа.
+
+PerformanceMiddleware для доли запросов PERF_SAMPLE_RATE считает
+запросы к базе и их время (через execute_wrapper всех соединений),
+время сериализации (SerializerTimingMixin вьюсетов DRF) и размер ответа.
+Итог уходит заголовком Server-Timing и строкой JSON в лог
+foodgram.performance. Одинаковые с точностью до параметров запросы
+группируются по отпечатку; если какой-то повторился
+PERF_N_PLUS_ONE_THRESHOLD раз, в лог пишется предупреждение о N+1.
+Остальные запросы проходят через middleware без накладных расходов.
+"""
+import hashlib
+import json
+import logging
+import random
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+
+from asgiref.sync import (iscoroutinefunction, markcoroutinefunction,
+                          sync_to_async)
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger('foodgram.performance')
+
+# Профиль текущего запроса или None, если запрос не попал в выборку
+_profile = ContextVar('profile', default=None)
+
+# Сколько повторяющихся запросов попадает в лог
+MAX_DUPLICATES = 5
+
+# Списки параметров IN (%s, %s, ...) разной длины — один запрос
+IN_LIST_RE = re.compile(r'\(\s*%s(?:\s*,\s*%s)+\s*\)')
+NUMBER_RE = re.compile(r'\b\d+\b')
+
+
+def fingerprint(sql):
+    """SQL без значений и хэш, по которому сравниваются запросы."""
+    normalized = NUMBER_RE.sub('N', IN_LIST_RE.sub('(%s, ...)', sql))
+    return hashlib.sha1(normalized.encode()).hexdigest()[:12], normalized
+
+
+@dataclass
+class RequestProfile:
+    queries: int = 0
+    db_time: float = 0
+    serializer_time: float = 0
+    fingerprints: Counter = field(default_factory=Counter)
+    statements: dict = field(default_factory=dict)
+
+    def __call__(self, execute, sql, params, many, context):
+        """Обёртка execute_wrapper для соединений с базой."""
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.db_time += time.perf_counter() - start
+            self.queries += 1
+            key, normalized = fingerprint(sql)
+            self.fingerprints[key] += 1
+            self.statements.setdefault(key, normalized)
+
+    def duplicates(self):
+        """Повторявшиеся запросы, самые частые первыми."""
+        return [{'fingerprint': key, 'count': count,
+                 'sql': self.statements[key][:300]}
+                for key, count in self.fingerprints.most_common(
+                    MAX_DUPLICATES) if count > 1]
+
+
+def current_profile():
+    return _profile.get()
+
+
+class SerializerTimingMixin:
+    """Вьюсет DRF, чей сериализатор учитывается в профиле запроса.
+
+    Время считается на to_representation сериализатора верхнего уровня,
+    то есть на весь ответ, включая вложенные сериализаторы.
+    """
+
+    def get_serializer(self, *args, **kwargs):
+        serializer = super().get_serializer(*args, **kwargs)
+        profile = current_profile()
+        if profile is not None:
+            to_representation = serializer.to_representation
+
+            def timed(*args, **kwargs):
+                start = time.perf_counter()
+                try:
+                    return to_representation(*args, **kwargs)
+                finally:
+                    profile.serializer_time += time.perf_counter() - start
+
+            serializer.to_representation = timed
+        return serializer
+
+
+def get_view_name(request):
+    match = getattr(request, 'resolver_match', None)
+    if match is None:
+        return None
+    return match.view_name or match.route
+
+
+def get_response_bytes(response):
+    if response.streaming:
+        length = response.get('Content-Length')
+        return int(length) if length else None
+    return len(response.content)
+
+
+def install_wrappers(stack, profile):
+    # Реплики тоже: чтения могут идти не из default
+    for connection in connections.all():
+        stack.enter_context(connection.execute_wrapper(profile))
+
+
+class PerformanceMiddleware:
+    """Профилирует выборку запросов; работает и под WSGI, и под ASGI."""
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def sampled(self):
+        rate = settings.PERF_SAMPLE_RATE
+        return rate >= 1 or (rate > 0 and random.random() < rate)
+
+    def start(self, stack):
+        profile = RequestProfile()
+        token = _profile.set(profile)
+        stack.callback(_profile.reset, token)
+        return profile, time.perf_counter()
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not self.sampled():
+            return self.get_response(request)
+        with ExitStack() as stack:
+            profile, start = self.start(stack)
+            install_wrappers(stack, profile)
+            response = self.get_response(request)
+        return self.finish(request, response, profile, start)
+
+    async def __acall__(self, request):
+        if not self.sampled():
+            return await self.get_response(request)
+        with ExitStack() as stack:
+            profile, start = self.start(stack)
+            # Соединения свои у каждого потока: обёртки ставятся в потоке,
+            # где синхронный код запроса работает с базой
+            wrappers = ExitStack()
+            await sync_to_async(install_wrappers)(wrappers, profile)
+            try:
+                response = await self.get_response(request)
+            finally:
+                await sync_to_async(wrappers.close)()
+        return self.finish(request, response, profile, start)
+
+    def finish(self, request, response, profile, start):
+        total = time.perf_counter() - start
+        view = get_view_name(request)
+        if settings.PERF_SERVER_TIMING:
+            response['Server-Timing'] = ', '.join((
+                f'db;desc="{profile.queries} queries";'
+                f'dur={profile.db_time * 1000:.1f}',
+                f'serializer;dur={profile.serializer_time * 1000:.1f}',
+                f'total;dur={total * 1000:.1f}',
+            ))
+        duplicates = profile.duplicates()
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'total_ms': round(total * 1000, 2),
+            'queries': profile.queries,
+            'db_ms': round(profile.db_time * 1000, 2),
+            'serializer_ms': round(profile.serializer_time * 1000, 2),
+            'bytes': get_response_bytes(response),
+            'duplicates': duplicates,
+        }
+        logger.info(json.dumps(record, ensure_ascii=False),
+                    extra={'performance': record})
+        threshold = settings.PERF_N_PLUS_ONE_THRESHOLD
+        for duplicate in duplicates:
+            if duplicate['count'] >= threshold:
+                logger.warning(
+                    'Возможен N+1 в %s: запрос повторился %d раз: %s',
+                    view, duplicate['count'], duplicate['sql'],
+                    extra={'performance': record})
+        return response
@@ -0,0 +1,117 @@
+"""Чтение с реплик базы для безопасных запросов API.
+
+Реплики перечислены в settings.DATABASE_REPLICAS. Вьюсет с
+ReplicaReadMixin после аутентификации выбирает реплику для GET, HEAD и
+OPTIONS, и ReplicaRouter направляет туда все чтения запроса. Запись
+всегда идёт в default. После успешной записи пользователь на
+REPLICA_PIN_SECONDS закрепляется за основной базой, чтобы сразу видеть
+свои изменения, даже если реплика отстаёт.
+"""
+import random
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS
+from rest_framework.permissions import SAFE_METHODS
+
+# Реплика текущего запроса; ContextVar работает и в потоках WSGI,
+# и в задачах asyncio
+_replica = ContextVar('replica', default=None)
+
+
+class ReplicaRouter:
+
+    def db_for_read(self, model, **hints):
+        return _replica.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # На репликах те же данные, что и в основной базе
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db not in settings.DATABASE_REPLICAS
+
+
+def get_pin_key(user):
+    return f'replica:pin:{user.pk}'
+
+
+def pin_to_primary(user):
+    cache.set(get_pin_key(user), True, settings.REPLICA_PIN_SECONDS)
+
+
+def choose_replica(request):
+    """Реплика для запроса или None, если читать нужно из default."""
+    if request.method not in SAFE_METHODS or not settings.DATABASE_REPLICAS:
+        return None
+    if request.user.is_authenticated and cache.get(get_pin_key(request.user)):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+async def achoose_replica(request):
+    if request.method not in SAFE_METHODS or not settings.DATABASE_REPLICAS:
+        return None
+    if (request.user.is_authenticated
+            and await cache.aget(get_pin_key(request.user))):
+        return None
+    return random.choice(settings.DATABASE_REPLICAS)
+
+
+def use_replica(alias):
+    """Направляет чтения на alias; возвращает токен для reset_replica."""
+    return _replica.set(alias)
+
+
+def reset_replica(token):
+    _replica.reset(token)
+
+
+@contextmanager
+def primary_reads(enabled=True):
+    """Внутри блока чтения идут в основную базу."""
+    if not enabled:
+        yield
+        return
+    token = _replica.set(None)
+    try:
+        yield
+    finally:
+        _replica.reset(token)
+
+
+def changed_recently(version):
+    """Данные с версией version (time_ns изменения) реплика могла ещё
+    не получить."""
+    return time.time_ns() - version < settings.REPLICA_PIN_SECONDS * 10**9
+
+
+class ReplicaReadMixin:
+    """Чтение безопасных запросов вьюсета с реплики.
+
+    Реплика выбирается после аутентификации: токен только что
+    вошедшего пользователя мог ещё не дойти до реплики.
+    """
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        self.replica_token = use_replica(choose_replica(request))
+
+    def finalize_response(self, request, response, *args, **kwargs):
+        token = getattr(self, 'replica_token', None)
+        if token is not None:
+            reset_replica(token)
+            self.replica_token = None
+        if (settings.DATABASE_REPLICAS
+                and request.method not in SAFE_METHODS
+                and response.status_code < 400
+                and request.user.is_authenticated):
+            pin_to_primary(request.user)
+        return super().finalize_response(
+            request, response, *args, **kwargs)
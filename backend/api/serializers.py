@@ -1,12 +1,59 @@
-from rest_framework import serializers
+import base64
+import binascii
+from collections import namedtuple
+
+import filetype
+from rest_framework import serializers, status
+from rest_framework.exceptions import APIException
 from djoser.serializers import UserSerializer
-from drf_extra_fields.fields import Base64ImageField
 from django.contrib.auth import get_user_model
+from django.db import transaction
+from recipes.images import clear_image, variant_urls
+from recipes.tasks import image_executor, is_valid_image, schedule_image
 from recipes.models import (Ingredient, Recipe, Follow,
                             RecipeIngredient, ShoppingList, Favorite)
 
 User = get_user_model()
 
+PendingImage = namedtuple('PendingImage', ('content', 'extension'))
+
+
+class ImageQueueFull(APIException):
+    status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+    default_detail = ('Слишком много загрузок изображений, '
+                      'повторите запрос позже.')
+    default_code = 'image_queue_full'
+
+
+class DeferredBase64ImageField(serializers.ImageField):
+    """Изображение в base64, которое обрабатывается в фоне.
+
+    В запросе файл раскодируется и проверяется по сигнатуре и Pillow
+    (без декодирования пикселей), чтобы на повреждённый файл ответить
+    400; запись в storage и уменьшенные копии идут в image_executor
+    после сохранения объекта.
+    """
+
+    ALLOWED_TYPES = ('jpg', 'png', 'gif', 'webp')
+
+    def to_internal_value(self, data):
+        if data == '':
+            return None
+        if not isinstance(data, str):
+            self.fail('invalid_image')
+        try:
+            content = base64.b64decode(data.split(';base64,', 1)[-1])
+        except (binascii.Error, ValueError):
+            self.fail('invalid_image')
+        kind = filetype.image_match(content[:262])
+        if kind is None or kind.extension not in self.ALLOWED_TYPES:
+            self.fail('invalid_image')
+        if not is_valid_image(content):
+            self.fail('invalid_image')
+        if image_executor.is_full():
+            raise ImageQueueFull()
+        return PendingImage(content, kind.extension)
+
 
 class IngredientSerializer(serializers.ModelSerializer):
 
@@ -16,6 +63,25 @@ class IngredientSerializer(serializers.ModelSerializer):
         read_only_fields = fields
 
 
+class ImageVariantsField(serializers.Field):
+    """Ссылки на уменьшенные копии: {'thumb': {'jpeg': url, 'webp': url}}."""
+
+    def __init__(self, **kwargs):
+        kwargs['read_only'] = True
+        super().__init__(**kwargs)
+
+    def to_representation(self, value):
+        if not value:
+            return None
+        urls = variant_urls(value.name, value.storage)
+        request = self.context.get('request')
+        if request is None:
+            return urls
+        return {variant: {image_format: request.build_absolute_uri(url)
+                          for image_format, url in formats.items()}
+                for variant, formats in urls.items()}
+
+
 class RecipeIngredientSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source='ingredient.id', read_only=True)
     name = serializers.CharField(source='ingredient.name', read_only=True)
@@ -29,29 +95,27 @@ class RecipeIngredientSerializer(serializers.ModelSerializer):
 
 class IngredientWriteSerializer(serializers.Serializer):
     id = serializers.IntegerField()
-    amount = serializers.IntegerField()
+    amount = serializers.IntegerField(min_value=1)
 
 
 class CustomUserSerializer(UserSerializer):
     is_subscribed = serializers.SerializerMethodField()
+    avatar_variants = ImageVariantsField(source='avatar')
     # password = serializers.CharField(write_only=True, required=True)
 
     class Meta:
         model = User
         fields = ('email', 'id', 'username', 'first_name',
-                  'last_name', 'avatar', 'is_subscribed')
+                  'last_name', 'avatar', 'avatar_variants', 'is_subscribed')
         read_only_fields = fields
 
     def get_is_subscribed(self, obj):
-        author = self.context['request'].user
-        if not author:
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
+        user = self.context['request'].user
+        if not user.is_authenticated:
             return False
-        queryset = Follow.objects.filter(
-            user=author.id
-        ).filter(following=obj.id)
-        if queryset:
-            return True
-        return False
+        return Follow.objects.filter(user=user, following=obj).exists()
 
 
 class UserRegistrationSerializer(UserSerializer):
@@ -65,25 +129,30 @@ class UserRegistrationSerializer(UserSerializer):
         password = validated_data.pop('password')
         user = super().create(validated_data)
         user.set_password(password)
-        user.save()
+        user.save(update_fields=('password',))
         return user
 
 
 class AvatarSerializer(serializers.ModelSerializer):
-    avatar = Base64ImageField(required=False)
+    avatar = DeferredBase64ImageField(required=False)
 
     class Meta:
         model = User
         fields = ('avatar',)
 
     def update(self, instance, validated_data):
-        instance.avatar = validated_data.get('avatar', None)
-        instance.save()
+        avatar = validated_data.get('avatar', None)
+        if avatar is None:
+            clear_image(instance, 'avatar')
+        else:
+            schedule_image(
+                instance, 'avatar', avatar.extension, avatar.content)
         return instance
 
 
 class RecipeSerializer(serializers.ModelSerializer):
-    image = Base64ImageField(required=False)
+    image = DeferredBase64ImageField(required=False)
+    image_variants = ImageVariantsField(source='image')
     author = CustomUserSerializer(
         read_only=True)
     ingredients = IngredientWriteSerializer(many=True, write_only=True)
@@ -93,81 +162,163 @@ class RecipeSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Recipe
-        fields = ('id', 'author', 'ingredients', 'image',
+        fields = ('id', 'author', 'ingredients', 'image', 'image_variants',
                   'name', 'text', 'cooking_time', 'is_in_shopping_cart',
                   'is_favorited')
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         user = self.context['request'].user
         if not user.is_authenticated:
             return False
         return ShoppingList.objects.filter(user=user, recipe=obj).exists()
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         user = self.context['request'].user
         if not user.is_authenticated:
             return False
         return Favorite.objects.filter(user=user, recipe=obj).exists()
 
+    def validate_ingredients(self, value):
+        """Находит все ингредиенты одним запросом."""
+        ids = [item['id'] for item in value]
+        if len(ids) != len(set(ids)):
+            raise serializers.ValidationError(
+                'Ингредиенты в рецепте не должны повторяться.')
+        ingredients = Ingredient.objects.in_bulk(ids)
+        missing = [pk for pk in ids if pk not in ingredients]
+        if missing:
+            raise serializers.ValidationError(
+                'Ингредиенты не найдены: '
+                + ', '.join(str(pk) for pk in missing))
+        return [{'ingredient': ingredients[item['id']],
+                 'amount': item['amount']} for item in value]
+
     def create_recipe_ingredients_list(self, recipe, ingredients):
-        recipe_ingredients = [RecipeIngredient(
+        RecipeIngredient.objects.bulk_create(RecipeIngredient(
             recipe=recipe,
-            ingredient=Ingredient.objects.get(id=ingredient['id']),
+            ingredient=ingredient['ingredient'],
             amount=ingredient['amount']
-        ) for ingredient in ingredients]
-        RecipeIngredient.objects.bulk_create(recipe_ingredients)
-
+        ) for ingredient in ingredients)
+
+    def update_recipe_ingredients_list(self, recipe, ingredients):
+        """Меняет только отличающиеся строки.
+
+        Не больше трёх запросов: вставка новых, обновление количества
+        и удаление убранных ингредиентов.
+        """
+        existing = {item.ingredient_id: item
+                    for item in recipe.ingredients_in_recipes.all()}
+        to_create, to_update = [], []
+        for ingredient in ingredients:
+            item = existing.pop(ingredient['ingredient'].id, None)
+            if item is None:
+                to_create.append(ingredient)
+            elif item.amount != ingredient['amount']:
+                item.amount = ingredient['amount']
+                to_update.append(item)
+        if existing:
+            RecipeIngredient.objects.filter(
+                id__in=[item.id for item in existing.values()]).delete()
+        if to_update:
+            RecipeIngredient.objects.bulk_update(to_update, ['amount'])
+        if to_create:
+            self.create_recipe_ingredients_list(recipe, to_create)
+
+    def attach_image(self, recipe, image):
+        if image is not None:
+            schedule_image(recipe, 'image', image.extension, image.content)
+
+    @transaction.atomic
     def create(self, validated_data):
         ingredients = validated_data.pop('ingredients')
+        image = validated_data.pop('image', None)
         recipe = super().create({**validated_data})
         self.create_recipe_ingredients_list(recipe, ingredients)
+        self.attach_image(recipe, image)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
-        ingredients = validated_data.pop('ingredients')
+        ingredients = validated_data.pop('ingredients', None)
+        image = validated_data.pop('image', None)
         instance = super().update(instance, validated_data)
-        old_ingrs = instance.ingredients_in_recipes.all()
-        old_ingrs.delete()
-        self.create_recipe_ingredients_list(instance, ingredients)
+        # При частичном обновлении без ingredients состав не меняется
+        if ingredients is not None:
+            self.update_recipe_ingredients_list(instance, ingredients)
+        self.attach_image(instance, image)
         return instance
 
     def to_representation(self, instance):
         """Переопределяем метод для корректного отображения ингредиентов."""
+        if hasattr(instance, 'is_author_subscribed'):
+            instance.author.is_subscribed = instance.is_author_subscribed
         representation = super().to_representation(instance)
-        ingredients = RecipeIngredient.objects.filter(recipe=instance)
+        ingredients = instance.ingredients_in_recipes.all()
+        if 'ingredients_in_recipes' not in getattr(
+                instance, '_prefetched_objects_cache', {}):
+            ingredients = ingredients.select_related('ingredient')
         representation['ingredients'] = RecipeIngredientSerializer(
             ingredients, many=True).data
         return representation
 
 
+class RecipeBatchSerializer(serializers.Serializer):
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False, max_length=100)
+
+
+class PantrySerializer(serializers.Serializer):
+    ingredients = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False, max_length=100)
+    max_missing = serializers.IntegerField(min_value=0, required=False)
+
+    def to_internal_value(self, data):
+        """Ингредиенты через запятую и/или повторённым параметром."""
+        values = {'ingredients': [
+            value for item in data.getlist('ingredients')
+            for value in item.split(',') if value]}
+        if 'max_missing' in data:
+            values['max_missing'] = data['max_missing']
+        return super().to_internal_value(values)
+
+
 class ShortRecipeSerializer(serializers.ModelSerializer):
+    image_variants = ImageVariantsField(source='image')
 
     class Meta:
         model = Recipe
-        fields = ('id', 'name', 'image', 'cooking_time')
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
         read_only_fields = fields
 
 
 class FollowUserSerializer(CustomUserSerializer):
-    recipes_count = serializers.IntegerField(source='recipe.count',
-                                             read_only=True)
+    recipes_count = serializers.IntegerField(read_only=True)
     recipes = serializers.SerializerMethodField()
 
     class Meta:
         model = User
         fields = ('email', 'id', 'username', 'first_name', 'last_name',
-                  'avatar', 'is_subscribed', 'recipes_count', 'recipes')
+                  'avatar', 'avatar_variants', 'is_subscribed',
+                  'recipes_count', 'recipes')
         read_only_fields = fields
 
     def get_recipes(self, obj):
-        # recipes = obj.recipe.filter(author=obj).all()
-        recipes = obj.recipes.all()
-
         request = self.context['request']
-        recipes_limit = request.query_params.get('recipes_limit') if request else None
-        if recipes_limit is not None and recipes_limit.isdigit():
-            recipes = recipes[:int(recipes_limit)]
+        if hasattr(obj, 'recent_recipes'):
+            # Последние рецепты уже загружены через Prefetch с лимитом
+            recipes = obj.recent_recipes
+        else:
+            recipes = obj.recipes.order_by('-id')
+            recipes_limit = request.query_params.get('recipes_limit')
+            if recipes_limit is not None and recipes_limit.isdigit():
+                recipes = recipes[:int(recipes_limit)]
         return ShortRecipeSerializer(
             recipes,
             many=True,
-            context={'request': self.context['request']}).data
+            context={'request': request}).data
@@ -0,0 +1,67 @@
+import hashlib
+import json
+
+from django.db.models import F, Sum
+from django.utils import timezone
+
+from recipes.models import Recipe, RecipeIngredient
+
+
+def get_shopping_list_ingredients(user):
+    """Суммирует ингредиенты из корзины одним запросом к базе."""
+    return (
+        RecipeIngredient.objects
+        .filter(recipe__shopping_cart__user=user)
+        .values(name=F('ingredient__name'),
+                measurement_unit=F('ingredient__measurement_unit'))
+        .annotate(total_amount=Sum('amount'))
+        .order_by('name', 'measurement_unit')
+    )
+
+
+def get_users_shopping_list_ingredients(users):
+    """Суммы ингредиентов по корзине каждого из users одним запросом."""
+    return (
+        RecipeIngredient.objects
+        .filter(recipe__shopping_cart__user__in=users)
+        .values(email=F('recipe__shopping_cart__user__email'),
+                name=F('ingredient__name'),
+                measurement_unit=F('ingredient__measurement_unit'))
+        .annotate(total_amount=Sum('amount'))
+        .order_by('email', 'name', 'measurement_unit')
+    )
+
+
+def get_shopping_list_recipes(user):
+    return (
+        Recipe.objects
+        .filter(shopping_cart__user=user)
+        .order_by('name')
+        .values_list('name', flat=True)
+    )
+
+
+class ShoppingListData:
+    """Агрегированные строки списка покупок, общие для всех форматов.
+
+    Строки ингредиентов уже сгруппированы базой, поэтому их не больше,
+    чем различных ингредиентов в справочнике, независимо от размера корзины.
+    """
+
+    def __init__(self, ingredients, recipes, created=None):
+        self.ingredients = list(ingredients)
+        self.recipes = list(recipes)
+        self.created = created or timezone.localtime()
+
+    @classmethod
+    def for_user(cls, user):
+        return cls(get_shopping_list_ingredients(user),
+                   get_shopping_list_recipes(user))
+
+    def etag(self, file_format):
+        """Слабый ETag: содержимое файла зависит и от времени выгрузки."""
+        digest = hashlib.sha1(file_format.encode())
+        digest.update(json.dumps(
+            [self.ingredients, self.recipes], ensure_ascii=False
+        ).encode())
+        return f'W/"{digest.hexdigest()}"'
@@ -0,0 +1,71 @@
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList)
+
+from .cache import recipe_cache
+from .indexes import ingredient_index, pantry_index
+
+User = get_user_model()
+
+# Эти поля пользователя не попадают в ответы с рецептами
+USER_PRIVATE_FIELDS = {'last_login', 'password'}
+
+
+@receiver((post_save, post_delete), sender=Ingredient)
+def invalidate_ingredient_index(using, **kwargs):
+    # Иначе параллельный запрос построит индекс по данным до фиксации
+    # и сохранит его под новой версией
+    transaction.on_commit(ingredient_index.invalidate, using=using)
+    # Название ингредиента есть в каждом рецепте, где он используется
+    transaction.on_commit(recipe_cache.invalidate_all)
+
+
+# Кэш сбрасывается после фиксации транзакции: иначе параллельный запрос
+# успел бы положить в него ещё не изменённые данные
+@receiver((post_save, post_delete), sender=Recipe)
+def invalidate_recipe(instance, **kwargs):
+    transaction.on_commit(
+        partial(recipe_cache.invalidate_recipes, [instance.pk]))
+
+
+@receiver((post_save, post_delete), sender=RecipeIngredient)
+def invalidate_recipe_ingredients(instance, using, **kwargs):
+    transaction.on_commit(
+        partial(recipe_cache.invalidate_recipes, [instance.recipe_id]))
+    pantry_index.invalidate_on_commit(instance.recipe_id, using)
+
+
+# Состав рецепта сериализатор пишет через bulk_create без сигналов, но
+# всегда вместе с сохранением самого рецепта. Сохранение отдельных
+# полей (картинка, счётчики) состав не меняет
+@receiver(post_save, sender=Recipe)
+def invalidate_pantry_index(instance, using, update_fields=None, **kwargs):
+    if update_fields is None or not set(update_fields) <= {
+            'image', *Recipe.counter_fields}:
+        pantry_index.invalidate_on_commit(instance.pk, using)
+
+
+@receiver(post_save, sender=User)
+def invalidate_author_recipes(instance, created, update_fields=None,
+                              **kwargs):
+    if created or (update_fields
+                   and set(update_fields) <= USER_PRIVATE_FIELDS):
+        return
+    recipe_ids = list(instance.recipes.values_list('id', flat=True))
+    if recipe_ids:
+        transaction.on_commit(
+            partial(recipe_cache.invalidate_recipes, recipe_ids))
+
+
+@receiver((post_save, post_delete), sender=Favorite)
+@receiver((post_save, post_delete), sender=ShoppingList)
+@receiver((post_save, post_delete), sender=Follow)
+def invalidate_viewer_flags(instance, **kwargs):
+    transaction.on_commit(
+        partial(recipe_cache.invalidate_viewer, instance.user_id))
@@ -1,2 +1,1325 @@
+import base64
+import hashlib
+import http.client
+import json
+import random
+import shutil
+import tempfile
+from unittest import mock
+from urllib.parse import urlencode
 
-# Create your tests here.
+from asgiref.sync import async_to_sync, iscoroutinefunction
+from django.contrib.auth import get_user_model
+from django.core.cache import cache
+from django.db import connection, transaction
+from django.http import HttpResponse
+from django.test import (RequestFactory, SimpleTestCase, TestCase,
+                         override_settings)
+from django.test.utils import CaptureQueriesContext
+from django.urls import URLPattern, URLResolver, get_resolver, resolve
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api import async_views
+from api.benchmark import (EXCLUDED_ROUTES, IMAGE, SCENARIOS, check_budget,
+                           default_ingredients_path, load_budget,
+                           run_scenarios, seed_dataset)
+from api.indexes import (PantryIndex, PantryUpdate, ingredient_index,
+                         pantry_index)
+from api.load_benchmark import connection_mode
+from api.load_mix import (CONNECTION_ERROR, MIX, HttpTransport,
+                          InProcessTransport, check_mix, default_schema_path,
+                          load_context, run_mix, seed_load_users)
+from api.metrics import MetricsMiddleware
+from api.profiling import PerformanceMiddleware, RequestProfile
+from api.replicas import ReplicaRouter
+
+from foodgram.metrics import REGISTRY
+from recipes import search
+from recipes.images import variant_name
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList,
+                            UserRecipeQuerySet)
+from recipes.tasks import attach_image, image_executor
+
+User = get_user_model()
+
+IMAGE_CONTENT = base64.b64decode(IMAGE.split(';base64,')[1])
+
+
+class DownloadShoppingCartTest(TestCase):
+    url = '/api/recipes/download_shopping_cart/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.buyer = User.objects.create_user(
+            email='buyer@example.com', username='buyer',
+            first_name='Покупатель', last_name='Продуктов', password='pass')
+        cls.salt = Ingredient.objects.create(
+            name='соль', measurement_unit='г')
+        cls.milk = Ingredient.objects.create(
+            name='молоко', measurement_unit='мл')
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.buyer)
+
+    def fill_cart(self, count):
+        recipes = Recipe.objects.bulk_create(
+            Recipe(author=self.author, name=f'Рецепт {index}',
+                   text='Текст', cooking_time=10)
+            for index in range(count))
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=5)
+            for recipe in recipes
+            for ingredient in (self.salt, self.milk))
+        ShoppingList.objects.bulk_create(
+            ShoppingList(user=self.buyer, recipe=recipe)
+            for recipe in recipes)
+
+    def download(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url)
+            content = b''.join(response.streaming_content).decode()
+        return response, content, len(queries)
+
+    def test_ingredients_are_summed(self):
+        self.fill_cart(3)
+        response, content, _ = self.download()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('Соль - 15 г', content)
+        self.assertIn('Молоко - 15 мл', content)
+        self.assertIn('Рецепт 2', content)
+
+    def test_query_count_does_not_grow_with_cart(self):
+        self.fill_cart(1)
+        _, _, small_cart_queries = self.download()
+        self.fill_cart(50)
+        _, content, large_cart_queries = self.download()
+        self.assertIn('Соль - 255 г', content)
+        self.assertEqual(small_cart_queries, large_cart_queries)
+
+    def test_export_formats(self):
+        self.fill_cart(2)
+        for file_format, content_type in (
+                ('txt', 'text/plain'), ('csv', 'text/csv'),
+                ('json', 'application/json'), ('pdf', 'application/pdf')):
+            with self.subTest(file_format=file_format):
+                response = self.client.get(
+                    self.url, {'file_format': file_format})
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(
+                    response['Content-Type'].startswith(content_type))
+                self.assertIn(f'shopping_list.{file_format}',
+                              response['Content-Disposition'])
+                self.assertTrue(b''.join(response.streaming_content))
+
+    def test_csv_lists_recipes(self):
+        self.fill_cart(2)
+        response = self.client.get(self.url, {'file_format': 'csv'})
+        rows = b''.join(response.streaming_content).decode(
+            'utf-8-sig').splitlines()
+        self.assertEqual(rows[1:], [
+            'молоко,10,мл', 'соль,10,г', '', 'Рецепт',
+            'Рецепт 0', 'Рецепт 1'])
+
+    def test_admin_exports_selected_users(self):
+        self.fill_cart(2)
+        other = User.objects.create_user(
+            email='other@example.com', username='other', password='pass')
+        ShoppingList.objects.create(
+            user=other, recipe=Recipe.objects.order_by('id').first())
+        admin = User.objects.create_superuser(
+            email='admin@example.com', username='admin', password='pass')
+        self.client.force_login(admin)
+        response = self.client.post('/admin/recipes/recipeuser/', {
+            'action': 'export_shopping_lists',
+            '_selected_action': [self.buyer.id, other.id],
+        })
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('shopping_lists.csv', response['Content-Disposition'])
+        rows = b''.join(response.streaming_content).decode(
+            'utf-8-sig').splitlines()
+        self.assertEqual(rows, [
+            'Email,Ингредиент,Количество,Единица измерения',
+            'buyer@example.com,молоко,10,мл',
+            'buyer@example.com,соль,10,г',
+            'other@example.com,молоко,5,мл',
+            'other@example.com,соль,5,г',
+        ])
+
+    def test_unknown_format(self):
+        response = self.client.get(self.url, {'file_format': 'xls'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_not_modified_until_cart_changes(self):
+        self.fill_cart(1)
+        etag = self.client.get(self.url)['ETag']
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+        self.fill_cart(1)
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+
+
+class RecipeListQueriesTest(TestCase):
+    url = '/api/recipes/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Зритель', last_name='Рецептов', password='pass')
+        authors = [User.objects.create_user(
+            email=f'author{index}@example.com', username=f'author{index}',
+            first_name='Автор', last_name='Рецептов', password='pass')
+            for index in range(3)]
+        ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {index}', measurement_unit='г')
+            for index in range(3))
+        recipes = Recipe.objects.bulk_create(
+            Recipe(author=authors[index % 3], name=f'Рецепт {index}',
+                   text='Текст', cooking_time=10)
+            for index in range(40))
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=1)
+            for recipe in recipes for ingredient in ingredients)
+        Favorite.objects.create(user=cls.viewer, recipe=recipes[0])
+        ShoppingList.objects.create(user=cls.viewer, recipe=recipes[0])
+        Follow.objects.create(user=cls.viewer, following=authors[0])
+
+    def setUp(self):
+        cache.clear()
+
+    def count_queries(self, client, limit):
+        with CaptureQueriesContext(connection) as queries:
+            response = client.get(self.url, {'limit': limit})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.data['results']), limit)
+        return len(queries), response.data['results']
+
+    @override_settings(RECIPE_CACHE_TIMEOUT=0)
+    def test_query_count_does_not_depend_on_page_size(self):
+        for user in (None, self.viewer):
+            client = APIClient()
+            client.force_authenticate(user)
+            with self.subTest(authenticated=user is not None):
+                small_page_queries, _ = self.count_queries(client, 6)
+                large_page_queries, _ = self.count_queries(client, 30)
+                self.assertEqual(small_page_queries, large_page_queries)
+
+    def test_viewer_flags(self):
+        client = APIClient()
+        client.force_authenticate(self.viewer)
+        _, results = self.count_queries(client, 30)
+        recipe = next(item for item in results if item['name'] == 'Рецепт 0')
+        self.assertTrue(recipe['is_favorited'])
+        self.assertTrue(recipe['is_in_shopping_cart'])
+        self.assertTrue(recipe['author']['is_subscribed'])
+        self.assertEqual(len(recipe['ingredients']), 3)
+        other = next(item for item in results if item['name'] == 'Рецепт 1')
+        self.assertFalse(other['is_favorited'])
+        self.assertFalse(other['author']['is_subscribed'])
+
+
+class RecipeWriteTest(TestCase):
+    url = '/api/recipes/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.ingredients = Ingredient.objects.bulk_create(
+            Ingredient(name=f'ингредиент {index}', measurement_unit='г')
+            for index in range(40))
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+
+    def recipe_data(self, ingredients, amount=10):
+        return {
+            'name': 'Рецепт', 'text': 'Текст', 'cooking_time': 10,
+            'image': IMAGE,
+            'ingredients': [{'id': ingredient.id, 'amount': amount}
+                            for ingredient in ingredients],
+        }
+
+    def amounts(self, recipe_id):
+        return dict(RecipeIngredient.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient_id', 'amount'))
+
+    def test_query_count_does_not_depend_on_ingredients(self):
+        counts = []
+        for ingredients in (self.ingredients[:2], self.ingredients[:30]):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    self.url, self.recipe_data(ingredients), format='json')
+            self.assertEqual(response.status_code, 201)
+            self.assertEqual(len(response.data['ingredients']),
+                             len(ingredients))
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_unknown_ingredients_are_named(self):
+        data = self.recipe_data(self.ingredients[:2])
+        data['ingredients'] += [{'id': 9000, 'amount': 1},
+                                {'id': 9001, 'amount': 1}]
+        response = self.client.post(self.url, data, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('9000, 9001', str(response.data['ingredients']))
+
+    def test_update_applies_diff(self):
+        response = self.client.post(
+            self.url, self.recipe_data(self.ingredients[:30]), format='json')
+        recipe_id = response.data['id']
+        data = self.recipe_data(self.ingredients[10:35])
+        data['ingredients'][0]['amount'] = 99
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.patch(
+                f'{self.url}{recipe_id}/', data, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertLess(len(queries), 20)
+        expected = {ingredient.id: 10
+                    for ingredient in self.ingredients[10:35]}
+        expected[self.ingredients[10].id] = 99
+        self.assertEqual(self.amounts(recipe_id), expected)
+        self.assertEqual(len(response.data['ingredients']), 25)
+
+    def test_partial_update_keeps_ingredients(self):
+        response = self.client.post(
+            self.url, self.recipe_data(self.ingredients[:3]), format='json')
+        recipe_id = response.data['id']
+        response = self.client.patch(
+            f'{self.url}{recipe_id}/', {'name': 'Новое'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(self.amounts(recipe_id)), 3)
+
+
+class DeferredImageTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.ingredient = Ingredient.objects.create(
+            name='мука', measurement_unit='г')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.author)
+
+    def post_recipe(self, image=IMAGE):
+        return self.client.post('/api/recipes/', {
+            'name': 'Рецепт', 'text': 'Текст', 'cooking_time': 10,
+            'image': image,
+            'ingredients': [{'id': self.ingredient.id, 'amount': 1}],
+        }, format='json')
+
+    def test_image_is_queued_after_commit(self):
+        with mock.patch.object(image_executor, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.post_recipe()
+                self.assertEqual(response.status_code, 201)
+                submit.assert_not_called()
+        submit.assert_called_once()
+        function, model, pk, field_name, name, content = (
+            submit.call_args.args)
+        self.assertEqual((function, model, pk, field_name, content),
+                         (attach_image, Recipe, response.data['id'],
+                          'image', IMAGE_CONTENT))
+        self.assertEqual(
+            name, 'recipes/images/'
+            f'{hashlib.sha256(IMAGE_CONTENT).hexdigest()}.png')
+        # Ссылка в ответе указывает на файл, который запишет задача
+        self.assertTrue(response.data['image'].endswith(name))
+        self.assertFalse(Recipe.objects.get(id=pk).image)
+
+    @override_settings(IMAGE_TASKS_EAGER=True)
+    def test_eager_mode_attaches_image_and_variants(self):
+        response = self.post_recipe()
+        recipe = Recipe.objects.get(id=response.data['id'])
+        self.assertTrue(response.data['image'].endswith(recipe.image.name))
+        self.assertTrue(recipe.image.storage.exists(
+            variant_name(recipe.image.name, 'thumb', 'webp')))
+
+    def test_signature_is_checked_before_saving(self):
+        response = self.post_recipe(
+            'data:image/png;base64,' + 'bm90IGFuIGltYWdl' * 8)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+
+    def test_corrupted_image_is_rejected_before_saving(self):
+        content = bytearray(IMAGE_CONTENT)
+        # Сигнатура PNG верна, контрольная сумма блока — нет
+        content[len(content) // 2] ^= 0xFF
+        response = self.post_recipe('data:image/png;base64,'
+                                    + base64.b64encode(content).decode())
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('image', response.data)
+        self.assertFalse(Recipe.objects.exists())
+
+    def test_full_queue_is_rejected_before_saving(self):
+        with mock.patch.object(image_executor, 'is_full', return_value=True):
+            response = self.client.put(
+                '/api/users/me/avatar/', {'avatar': IMAGE}, format='json')
+            self.assertEqual(response.status_code, 503)
+            response = self.post_recipe()
+            self.assertEqual(response.status_code, 503)
+        self.assertFalse(Recipe.objects.exists())
+
+
+class RecipeBatchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Зритель', last_name='Рецептов', password='pass')
+        cls.recipes = [Recipe.objects.create(
+            author=cls.viewer, name=f'Рецепт {index}', text='Текст',
+            cooking_time=10) for index in range(7)]
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def statuses(self, response):
+        self.assertEqual(response.status_code, 200)
+        return {item['id']: item['status']
+                for item in response.data['results']}
+
+    def test_add_and_remove_favorites(self):
+        first, second, *rest = (recipe.id for recipe in self.recipes)
+        Favorite.objects.create(user=self.viewer, recipe_id=first)
+        response = self.client.post(
+            '/api/recipes/batch/favorite/',
+            {'recipes': [first, second, second, 9000]}, format='json')
+        self.assertEqual(self.statuses(response), {
+            first: 'exists', second: 'added', 9000: 'not_found'})
+        self.assertEqual(
+            Recipe.objects.get(id=second).favorites_count, 1)
+        response = self.client.delete(
+            '/api/recipes/batch/favorite/',
+            {'recipes': [first, rest[0]]}, format='json')
+        self.assertEqual(self.statuses(response), {
+            first: 'removed', rest[0]: 'not_found'})
+        self.assertEqual(list(Favorite.objects.values_list(
+            'recipe_id', flat=True)), [second])
+
+    def test_query_count_does_not_depend_on_batch_size(self):
+        counts = []
+        for recipes in (self.recipes[:2], self.recipes[2:]):
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(
+                    '/api/recipes/batch/shopping_cart/',
+                    {'recipes': [recipe.id for recipe in recipes]},
+                    format='json')
+            self.assertEqual(set(self.statuses(response).values()),
+                             {'added'})
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertEqual(ShoppingList.objects.count(), 7)
+
+    def test_recipe_added_concurrently_is_reported_as_existing(self):
+        first, second = (recipe.id for recipe in self.recipes[:2])
+        add_recipes = UserRecipeQuerySet.add_recipes
+
+        def racing_add(queryset, user, recipe_ids):
+            # Параллельный запрос успел между проверкой и вставкой
+            Favorite.objects.create(user=self.viewer, recipe_id=first)
+            return add_recipes(queryset, user, recipe_ids)
+
+        with mock.patch.object(UserRecipeQuerySet, 'add_recipes',
+                               racing_add):
+            response = self.client.post(
+                '/api/recipes/batch/favorite/',
+                {'recipes': [first, second]}, format='json')
+        self.assertEqual(self.statuses(response), {
+            first: 'exists', second: 'added'})
+        self.assertEqual(
+            Recipe.objects.get(id=first).favorites_count, 1)
+        self.assertEqual(
+            Recipe.objects.get(id=second).favorites_count, 1)
+
+    def test_delete_query_count_does_not_depend_on_batch_size(self):
+        counts = []
+        for recipes in (self.recipes[:2], self.recipes[2:]):
+            ids = [recipe.id for recipe in recipes]
+            self.client.post('/api/recipes/batch/favorite/',
+                             {'recipes': ids}, format='json')
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.delete(
+                    '/api/recipes/batch/favorite/',
+                    {'recipes': ids}, format='json')
+            self.assertEqual(set(self.statuses(response).values()),
+                             {'removed'})
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+        self.assertFalse(Favorite.objects.exists())
+        self.assertEqual(set(Recipe.objects.values_list(
+            'favorites_count', flat=True)), {0})
+
+    def test_empty_batch_is_rejected(self):
+        response = self.client.post(
+            '/api/recipes/batch/favorite/', {'recipes': []}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class RecipeCacheTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Зритель', last_name='Рецептов', password='pass')
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='Рецепт', text='Текст', cooking_time=10)
+        cls.other = Recipe.objects.create(
+            author=cls.author, name='Другой', text='Текст', cooking_time=5)
+
+    def setUp(self):
+        cache.clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def get(self, url, client=None):
+        with CaptureQueriesContext(connection) as queries:
+            response = (client or self.client).get(url)
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_repeated_request_is_served_from_cache(self):
+        anonymous = APIClient()
+        response, _ = self.get('/api/recipes/', anonymous)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        response, queries = self.get('/api/recipes/', anonymous)
+        self.assertEqual(response['X-Cache'], 'HIT')
+        self.assertEqual(queries, 0)
+
+    def test_viewer_flags_are_applied_to_shared_response(self):
+        self.get('/api/recipes/', APIClient())
+        with self.captureOnCommitCallbacks(execute=True):
+            self.client.post(f'/api/recipes/{self.recipe.id}/favorite/')
+            Follow.objects.create(user=self.viewer, following=self.author)
+        response, _ = self.get('/api/recipes/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        flags = {recipe['id']: (recipe['is_favorited'],
+                                recipe['author']['is_subscribed'])
+                 for recipe in response.data['results']}
+        self.assertEqual(flags, {self.recipe.id: (True, True),
+                                 self.other.id: (False, True)})
+        response, _ = self.get('/api/recipes/', APIClient())
+        self.assertFalse(any(recipe['is_favorited']
+                             for recipe in response.data['results']))
+
+    def test_recipe_change_invalidates_only_its_detail(self):
+        self.get(f'/api/recipes/{self.recipe.id}/')
+        self.get(f'/api/recipes/{self.other.id}/')
+        self.get('/api/recipes/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.name = 'Новое название'
+            self.recipe.save()
+        response, _ = self.get(f'/api/recipes/{self.recipe.id}/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['name'], 'Новое название')
+        response, _ = self.get(f'/api/recipes/{self.other.id}/')
+        self.assertEqual(response['X-Cache'], 'HIT')
+        response, _ = self.get('/api/recipes/')
+        self.assertEqual(response['X-Cache'], 'MISS')
+
+    def test_user_filters_bypass_cache(self):
+        Favorite.objects.create(user=self.viewer, recipe=self.recipe)
+        response, _ = self.get('/api/recipes/?is_favorited=1')
+        self.assertNotIn('X-Cache', response)
+        self.assertEqual([recipe['id'] for recipe in response.data['results']],
+                         [self.recipe.id])
+
+    def test_search_results_are_cached_per_query(self):
+        anonymous = APIClient()
+        response, _ = self.get('/api/recipes/?search=друг', anonymous)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual([recipe['id'] for recipe in response.data['results']],
+                         [self.other.id])
+        response, _ = self.get('/api/recipes/?search=текст', anonymous)
+        self.assertEqual(response['X-Cache'], 'MISS')
+        self.assertEqual(response.data['count'], 2)
+        response, _ = self.get('/api/recipes/?search=друг', anonymous)
+        self.assertEqual(response['X-Cache'], 'HIT')
+
+
+class CursorPaginationTest(TestCase):
+    url = '/api/recipes/'
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        Recipe.objects.bulk_create(
+            Recipe(author=author, name=f'Рецепт {index}',
+                   text='Текст', cooking_time=10)
+            for index in range(20))
+
+    def setUp(self):
+        cache.clear()
+
+    def walk(self, **params):
+        client = APIClient()
+        ids = []
+        response = client.get(self.url, {'pagination': 'cursor', **params})
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids.extend(recipe['id'] for recipe in response.data['results'])
+            if not response.data['next']:
+                return ids, response
+            with CaptureQueriesContext(connection) as queries:
+                response = client.get(response.data['next'])
+            self.assertFalse(any('COUNT(' in query['sql'].upper()
+                                 for query in queries.captured_queries))
+
+    def test_pages_follow_descending_id(self):
+        ids, response = self.walk(limit=6)
+        self.assertEqual(ids, sorted(
+            Recipe.objects.values_list('id', flat=True), reverse=True))
+        self.assertNotIn('count', response.data)
+
+    def test_count_on_request(self):
+        response = APIClient().get(
+            self.url, {'pagination': 'cursor', 'with_count': 1})
+        self.assertEqual(response.data['count'], 20)
+        self.assertEqual(len(response.data['results']), 6)
+
+    def test_page_number_mode_is_default(self):
+        response = APIClient().get(self.url, {'page': 2})
+        self.assertEqual(response.data['count'], 20)
+
+    def test_search_keeps_rank_order(self):
+        # Совпадение в названии выше по рангу, хотя id у рецепта меньше
+        first, last = Recipe.objects.order_by('id')[::19]
+        first.name = 'Секретный рецепт'
+        first.save()
+        last.text = 'Рецепт с секретом'
+        last.save()
+        response = APIClient().get(
+            self.url, {'pagination': 'cursor', 'search': 'секрет'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['count'], 2)
+        self.assertEqual(
+            [recipe['id'] for recipe in response.data['results']],
+            [first.id, last.id])
+
+
+class SubscriptionsTest(TestCase):
+    url = '/api/users/subscriptions/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Подписчик', last_name='Авторов', password='pass')
+        authors = [User.objects.create_user(
+            email=f'author{index}@example.com', username=f'author{index}',
+            first_name='Автор', last_name='Рецептов', password='pass')
+            for index in range(8)]
+        for author in authors:
+            Follow.objects.create(user=cls.viewer, following=author)
+            for index in range(5):
+                Recipe.objects.create(
+                    author=author, name=f'Рецепт {author.id}-{index}',
+                    text='Текст', cooking_time=10)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.viewer)
+
+    def get(self, **params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, params)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.data['results']
+
+    def test_query_count_does_not_depend_on_page_size(self):
+        small_page_queries, small_page = self.get(limit=2, recipes_limit=3)
+        large_page_queries, large_page = self.get(limit=6, recipes_limit=3)
+        self.assertEqual(len(small_page), 2)
+        self.assertEqual(len(large_page), 6)
+        self.assertEqual(small_page_queries, large_page_queries)
+
+    def test_newest_recipes_per_author(self):
+        _, results = self.get(limit=6, recipes_limit=2)
+        for author in results:
+            expected = list(Recipe.objects.filter(
+                author_id=author['id']).order_by('-id').values_list(
+                    'id', flat=True)[:2])
+            self.assertEqual(
+                [recipe['id'] for recipe in author['recipes']], expected)
+            self.assertEqual(author['recipes_count'], 5)
+            self.assertTrue(author['is_subscribed'])
+
+    def test_without_recipes_limit(self):
+        _, results = self.get(limit=6)
+        self.assertTrue(all(len(author['recipes']) == 5
+                            for author in results))
+
+
+class IngredientIndexTest(TestCase):
+    url = '/api/ingredients/'
+
+    @classmethod
+    def setUpTestData(cls):
+        with open(default_ingredients_path(), encoding='utf-8') as file:
+            Ingredient.objects.bulk_create(
+                Ingredient(**item) for item in json.load(file))
+
+    def setUp(self):
+        ingredient_index.invalidate()
+        ingredient_index.warm()
+
+    def test_search_agrees_with_database(self):
+        for name in ('а', 'аб', 'Аб', 'мол', 'сок', 'ябл', 'x', 'сол пе'):
+            with self.subTest(name=name):
+                queryset = Ingredient.objects.all()
+                # LIKE в SQLite не учитывает регистр только для латиницы,
+                # поэтому кириллицу приводим к нижнему регистру, как в
+                # PostgreSQL
+                for term in name.lower().split():
+                    queryset = queryset.filter(name__istartswith=term)
+                expected = [{'id': item.id, 'name': item.name,
+                             'measurement_unit': item.measurement_unit}
+                            for item in queryset]
+                with self.assertNumQueries(0):
+                    response = self.client.get(self.url, {'name': name})
+                self.assertEqual(response.json(), expected)
+
+    def test_limit(self):
+        response = self.client.get(self.url, {'name': 'а', 'limit': 3})
+        self.assertEqual(len(response.json()), 3)
+
+    def test_catalog_is_served_without_queries(self):
+        with self.assertNumQueries(0):
+            response = self.client.get(self.url)
+        self.assertEqual(len(response.json()), Ingredient.objects.count())
+        self.assertEqual(response.json()[0], {
+            'id': 1, 'name': 'абрикосовое варенье', 'measurement_unit': 'г'})
+        response = self.client.get(
+            self.url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+
+    def test_catalog_etag_changes_with_data(self):
+        etag = self.client.get(self.url)['ETag']
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.filter(id=1).delete()
+        response = self.client.get(self.url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_index_is_refreshed_on_change(self):
+        self.client.get(self.url, {'name': 'я'})
+        with self.captureOnCommitCallbacks(execute=True):
+            Ingredient.objects.create(
+                name='ячменный солод', measurement_unit='г')
+        names = [item['name'] for item in self.client.get(
+            self.url, {'name': 'ячм'}).json()]
+        self.assertIn('ячменный солод', names)
+
+    def test_index_is_invalidated_after_commit(self):
+        version = cache.get(ingredient_index.version_key)
+        with self.captureOnCommitCallbacks() as callbacks:
+            with transaction.atomic():
+                Ingredient.objects.create(
+                    name='ячменный солод', measurement_unit='г')
+                # До фиксации индекс не перестраивается
+                self.assertNotIn('ячменный солод', [
+                    item['name'] for item in self.client.get(
+                        self.url, {'name': 'ячм'}).json()])
+            self.assertEqual(
+                cache.get(ingredient_index.version_key), version)
+        for callback in callbacks:
+            callback()
+        self.assertNotEqual(cache.get(ingredient_index.version_key), version)
+
+
+def route_names(patterns, prefix=''):
+    for pattern in patterns:
+        if isinstance(pattern, URLResolver):
+            yield from route_names(pattern.url_patterns,
+                                   prefix + str(pattern.pattern))
+        elif isinstance(pattern, URLPattern) and pattern.name:
+            yield prefix + str(pattern.pattern), pattern.name
+
+
+class PantryTest(TestCase):
+    url = '/api/recipes/pantry/'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.salt, cls.flour, cls.egg, cls.milk = (
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('Соль', 'Мука', 'Яйцо', 'Молоко'))
+        cls.dough = cls.create_recipe('Тесто', cls.salt, cls.flour)
+        cls.bread = cls.create_recipe('Хлеб', cls.salt, cls.flour, cls.egg)
+        cls.omelette = cls.create_recipe('Омлет', cls.egg, cls.milk)
+        cls.milkshake = cls.create_recipe('Коктейль', cls.milk)
+
+    @classmethod
+    def create_recipe(cls, name, *ingredients):
+        recipe = Recipe.objects.create(
+            author=cls.author, name=name, text='Текст', cooking_time=10)
+        RecipeIngredient.objects.bulk_create(
+            RecipeIngredient(recipe=recipe, ingredient=ingredient, amount=1)
+            for ingredient in ingredients)
+        return recipe
+
+    def setUp(self):
+        cache.clear()
+        pantry_index.invalidate()
+
+    def get_matches(self, query):
+        response = self.client.get(f'{self.url}?{query}')
+        self.assertEqual(response.status_code, 200)
+        return [(recipe['id'], recipe['matched_count'],
+                 recipe['missing_count'])
+                for recipe in response.json()['results']]
+
+    def test_recipes_are_ranked_by_coverage(self):
+        pantry = f'{self.salt.id},{self.flour.id}&ingredients={self.egg.id}'
+        self.assertEqual(self.get_matches(f'ingredients={pantry}'), [
+            (self.bread.id, 3, 0),
+            (self.dough.id, 2, 0),
+            (self.omelette.id, 1, 1),
+        ])
+        self.assertEqual(
+            self.get_matches(f'ingredients={pantry}&max_missing=0'),
+            [(self.bread.id, 3, 0), (self.dough.id, 2, 0)])
+        response = self.client.get(
+            f'{self.url}?ingredients={pantry}&limit=1&page=2')
+        self.assertEqual(response.json()['count'], 3)
+        self.assertEqual(response.json()['results'][0]['name'], 'Тесто')
+
+    def test_index_follows_recipe_changes(self):
+        client = APIClient()
+        client.force_authenticate(self.author)
+        with self.captureOnCommitCallbacks(execute=True):
+            response = client.patch(
+                f'/api/recipes/{self.milkshake.id}/',
+                {'ingredients': [{'id': self.milk.id, 'amount': 1},
+                                 {'id': self.salt.id, 'amount': 1}]},
+                format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.get_matches(f'ingredients={self.milk.id}'), [
+            (self.milkshake.id, 1, 1), (self.omelette.id, 1, 1)])
+        with self.captureOnCommitCallbacks(execute=True):
+            self.omelette.delete()
+        self.assertEqual(self.get_matches(f'ingredients={self.milk.id}'),
+                         [(self.milkshake.id, 1, 1)])
+
+    def test_changes_are_applied_without_rebuild(self):
+        self.get_matches(f'ingredients={self.milk.id}')
+        with mock.patch.object(PantryIndex, 'build',
+                               side_effect=AssertionError):
+            with self.captureOnCommitCallbacks(execute=True):
+                RecipeIngredient.objects.create(
+                    recipe=self.dough, ingredient=self.milk, amount=1)
+            with self.captureOnCommitCallbacks(execute=True):
+                self.create_recipe('Блины', self.flour, self.milk)
+            blini = Recipe.objects.get(name='Блины')
+            with self.captureOnCommitCallbacks(execute=True):
+                self.milkshake.delete()
+            self.assertEqual(
+                self.get_matches(f'ingredients={self.milk.id}'), [
+                    (blini.id, 1, 1), (self.omelette.id, 1, 1),
+                    (self.dough.id, 1, 2)])
+
+    def test_cascade_delete_updates_index_once(self):
+        recipe_id = self.bread.id
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.bread.delete()
+        updates = [callback for callback in callbacks
+                   if isinstance(callback, PantryUpdate)]
+        self.assertEqual(len(updates), 1)
+        self.assertEqual(updates[0].recipe_ids, {recipe_id})
+
+    def test_invalid_query(self):
+        for query in ('', 'ingredients=', 'ingredients=соль',
+                      f'ingredients={self.salt.id}&max_missing=-1'):
+            with self.subTest(query=query):
+                response = self.client.get(f'{self.url}?{query}')
+                self.assertEqual(response.status_code, 400)
+
+
+class AsyncViewsTest(TestCase):
+    """Асинхронные представления режима ASGI отвечают как синхронные."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Зритель', last_name='Рецептов', password='pass')
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        salt = Ingredient.objects.create(name='Соль', measurement_unit='г')
+        Ingredient.objects.create(name='Сахар', measurement_unit='г')
+        cls.recipes = [Recipe.objects.create(
+            author=cls.author, name=f'Рецепт {index}', text='Текст',
+            cooking_time=10) for index in range(3)]
+        for recipe in cls.recipes:
+            RecipeIngredient.objects.create(
+                recipe=recipe, ingredient=salt, amount=5)
+        Favorite.objects.create(user=cls.viewer, recipe=cls.recipes[0])
+        Follow.objects.create(user=cls.viewer, following=cls.author)
+        cls.viewer_token = Token.objects.create(user=cls.viewer).key
+        cls.author_token = Token.objects.create(user=cls.author).key
+
+    def setUp(self):
+        cache.clear()
+
+    def get_sync(self, path, token):
+        cache.clear()
+        headers = {'Authorization': f'Token {token}'} if token else {}
+        return self.client.get(path, headers=headers)
+
+    @override_settings(ROOT_URLCONF='foodgram.asgi_urls')
+    def get_async(self, path, token):
+        cache.clear()
+        headers = {'Authorization': f'Token {token}'} if token else {}
+        return async_to_sync(self.async_client.get)(path, headers=headers)
+
+    def test_hot_paths_are_async(self):
+        for path in ('/api/recipes/', f'/api/recipes/{self.recipes[0].id}/',
+                     '/api/ingredients/', '/api/users/subscriptions/',
+                     f'/s/{self.recipes[0].id}/'):
+            with self.subTest(path=path):
+                self.assertTrue(iscoroutinefunction(
+                    resolve(path, 'foodgram.asgi_urls').func))
+
+    def test_responses_match_sync_views(self):
+        recipe = self.recipes[0].id
+        for path, token in (
+                ('/api/recipes/', None),
+                ('/api/recipes/', self.viewer_token),
+                ('/api/recipes/?limit=1&page=2', self.viewer_token),
+                ('/api/recipes/?page=5', None),
+                ('/api/recipes/?is_favorited=1', self.viewer_token),
+                ('/api/recipes/?pagination=cursor', None),
+                (f'/api/recipes/{recipe}/', self.viewer_token),
+                ('/api/recipes/0/', None),
+                ('/api/recipes/', 'wrong'),
+                ('/api/ingredients/?name=с', None),
+                ('/api/ingredients/', None),
+                ('/api/users/subscriptions/?recipes_limit=1',
+                 self.viewer_token),
+                (f'/s/{recipe}/', None)):
+            with self.subTest(path=path, token=token):
+                expected = self.get_sync(path, token)
+                with mock.patch('api.async_views.call_sync_view',
+                                wraps=async_views.call_sync_view) as sync:
+                    response = self.get_async(path, token)
+                self.assertEqual(response.status_code, expected.status_code)
+                self.assertEqual(response.content, expected.content)
+                # Курсорную пагинацию обслуживает синхронное представление
+                self.assertEqual(sync.called, 'cursor' in path)
+
+    @mock.patch.dict('recipes.search._fts_available', clear=True)
+    def test_search_checks_index_outside_event_loop(self):
+        path = '/api/recipes/?' + urlencode({'search': 'рецепт', 'limit': 2})
+        expected = self.get_sync(path, None)
+        search._fts_available.clear()
+        response = self.get_async(path, None)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.content, expected.content)
+
+    def test_writes_fall_back_to_sync_views(self):
+        recipe = self.recipes[1]
+        with override_settings(ROOT_URLCONF='foodgram.asgi_urls'):
+            response = async_to_sync(self.async_client.delete)(
+                f'/api/recipes/{recipe.id}/',
+                headers={'Authorization': f'Token {self.author_token}'})
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Recipe.objects.filter(id=recipe.id).exists())
+
+
+@override_settings(DATABASE_REPLICAS=['default'], RECIPE_CACHE_TIMEOUT=0)
+class ReplicaRoutingTest(TestCase):
+    """Реплика в тестах — та же база default: проверяется только выбор
+    базы роутером."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Зритель', last_name='Рецептов', password='pass')
+        author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.recipe = Recipe.objects.create(
+            author=author, name='Рецепт', text='Текст', cooking_time=10)
+        cls.token = Token.objects.create(user=cls.viewer).key
+
+    def setUp(self):
+        cache.clear()
+
+    def get_read_aliases(self, method, path, token=None):
+        aliases = []
+        db_for_read = ReplicaRouter.db_for_read
+
+        def spy(router, model, **hints):
+            alias = db_for_read(router, model, **hints)
+            aliases.append((model, alias))
+            return alias
+
+        headers = {'Authorization': f'Token {token}'} if token else {}
+        with mock.patch.object(ReplicaRouter, 'db_for_read', spy):
+            response = getattr(self.client, method)(path, headers=headers)
+        self.assertLess(response.status_code, 400)
+        return aliases
+
+    def test_safe_requests_read_from_replica(self):
+        aliases = self.get_read_aliases('get', '/api/recipes/')
+        self.assertTrue(aliases)
+        self.assertEqual({alias for _, alias in aliases}, {'default'})
+
+    def test_token_is_read_from_primary(self):
+        aliases = self.get_read_aliases('get', '/api/recipes/', self.token)
+        self.assertIn((Token, None), aliases)
+        self.assertIn((Recipe, 'default'), aliases)
+
+    def test_user_is_pinned_to_primary_after_write(self):
+        aliases = self.get_read_aliases(
+            'post', f'/api/recipes/{self.recipe.id}/favorite/', self.token)
+        self.assertEqual({alias for _, alias in aliases}, {None})
+        aliases = self.get_read_aliases('get', '/api/recipes/', self.token)
+        self.assertEqual({alias for _, alias in aliases}, {None})
+        # Закрепление касается только автора записи
+        aliases = self.get_read_aliases('get', '/api/recipes/')
+        self.assertEqual({alias for _, alias in aliases}, {'default'})
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            cache.clear()
+            aliases = self.get_read_aliases(
+                'get', '/api/recipes/', self.token)
+        self.assertIn((Recipe, 'default'), aliases)
+
+    @override_settings(RECIPE_CACHE_TIMEOUT=None)
+    def test_cache_miss_after_change_reads_primary(self):
+        self.client.get('/api/recipes/')
+        with self.captureOnCommitCallbacks(execute=True):
+            self.recipe.save()
+        aliases = self.get_read_aliases('get', '/api/recipes/')
+        self.assertIn((Recipe, None), aliases)
+        with override_settings(REPLICA_PIN_SECONDS=0):
+            self.recipe.name = 'Новое название'
+            with self.captureOnCommitCallbacks(execute=True):
+                self.recipe.save()
+            aliases = self.get_read_aliases('get', '/api/recipes/')
+        self.assertIn((Recipe, 'default'), aliases)
+
+
+@override_settings(PERF_SAMPLE_RATE=1, PERF_SERVER_TIMING=True)
+class PerformanceMiddlewareTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            email='author@example.com', username='author', password='pass')
+        Recipe.objects.create(
+            author=author, name='Суп', text='Описание', cooking_time=5)
+
+    def get_record(self, logs):
+        return json.loads(logs.records[0].getMessage())
+
+    def test_request_is_profiled(self):
+        with self.assertLogs('foodgram.performance', 'INFO') as logs:
+            response = self.client.get('/api/recipes/')
+        self.assertIn('db;desc=', response['Server-Timing'])
+        self.assertIn('serializer;dur=', response['Server-Timing'])
+        record = self.get_record(logs)
+        self.assertEqual(record['view'], 'recipes-list')
+        self.assertEqual(record['status'], 200)
+        self.assertGreater(record['queries'], 0)
+        self.assertGreater(record['serializer_ms'], 0)
+        self.assertEqual(record['bytes'], len(response.content))
+
+    @override_settings(PERF_SAMPLE_RATE=0)
+    def test_unsampled_request_is_not_profiled(self):
+        with self.assertNoLogs('foodgram.performance'):
+            response = self.client.get('/api/recipes/')
+        self.assertNotIn('Server-Timing', response)
+
+    @override_settings(PERF_N_PLUS_ONE_THRESHOLD=3)
+    def test_repeated_queries_are_flagged(self):
+        def get_response(request):
+            for pk in range(3):
+                list(Recipe.objects.filter(id__in=[pk] * (pk + 1)))
+            return HttpResponse()
+
+        middleware = PerformanceMiddleware(get_response)
+        with self.assertLogs('foodgram.performance', 'INFO') as logs:
+            middleware(RequestFactory().get('/'))
+        record = self.get_record(logs)
+        self.assertEqual(record['queries'], 3)
+        self.assertEqual(record['duplicates'][0]['count'], 3)
+        self.assertEqual(logs.records[1].levelname, 'WARNING')
+
+    def test_async_request_is_profiled(self):
+        async def get_response(request):
+            await Recipe.objects.acount()
+            return HttpResponse('ok')
+
+        middleware = PerformanceMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        with self.assertLogs('foodgram.performance', 'INFO') as logs:
+            response = async_to_sync(middleware)(RequestFactory().get('/'))
+        self.assertEqual(self.get_record(logs)['queries'], 1)
+        self.assertIn('db;desc="1 queries"', response['Server-Timing'])
+
+
+class RequestProfileTest(SimpleTestCase):
+
+    def test_fingerprint_ignores_values(self):
+        profile = RequestProfile()
+        for sql in ('SELECT 1 FROM t WHERE id IN (%s, %s)',
+                    'SELECT 1 FROM t WHERE id IN (%s, %s, %s)',
+                    'SELECT 1 FROM t WHERE id = %s LIMIT 21',
+                    'SELECT 1 FROM t WHERE id = %s LIMIT 1'):
+            profile(lambda *args: None, sql, (), False, {})
+        self.assertEqual(profile.queries, 4)
+        self.assertEqual([item['count'] for item in profile.duplicates()],
+                         [2, 2])
+
+
+class MetricsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            email='author@example.com', username='author', password='pass')
+        Recipe.objects.create(
+            author=author, name='Суп', text='Описание', cooking_time=5)
+
+    def setUp(self):
+        cache.clear()
+
+    def get_value(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_requests_are_counted_per_route(self):
+        labels = {'route': 'recipes-list', 'method': 'GET', 'status': '200'}
+        requests = self.get_value('foodgram_http_requests_total', **labels)
+        queries = self.get_value(
+            'foodgram_db_queries_per_request_sum', route='recipes-list')
+        hits = self.get_value(
+            'foodgram_cache_requests_total', cache='recipes', result='hit')
+        self.client.get('/api/recipes/')
+        self.client.get('/api/recipes/')
+        self.assertEqual(
+            self.get_value('foodgram_http_requests_total', **labels),
+            requests + 2)
+        self.assertGreater(self.get_value(
+            'foodgram_db_queries_per_request_sum', route='recipes-list'),
+            queries)
+        self.assertEqual(self.get_value(
+            'foodgram_cache_requests_total', cache='recipes', result='hit'),
+            hits + 1)
+
+    def test_unknown_paths_share_one_route(self):
+        self.client.get('/no-such-page/')
+        self.assertGreater(self.get_value(
+            'foodgram_http_requests_total', route='unmatched',
+            method='GET', status='404'), 0)
+
+    def test_async_request_queries_are_counted(self):
+        async def get_response(request):
+            await Recipe.objects.acount()
+            await Recipe.objects.acount()
+            return HttpResponse('ok')
+
+        queries = self.get_value(
+            'foodgram_db_queries_per_request_sum', route='unmatched')
+        middleware = MetricsMiddleware(get_response)
+        self.assertTrue(iscoroutinefunction(middleware))
+        async_to_sync(middleware)(RequestFactory().get('/'))
+        # Запросы идут в потоке sync_to_async, счётчик — из контекста
+        self.assertEqual(self.get_value(
+            'foodgram_db_queries_per_request_sum', route='unmatched'),
+            queries + 2)
+
+    def test_metrics_endpoint(self):
+        self.client.get('/api/recipes/')
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response['Content-Type'].startswith('text/plain'))
+        self.assertIn(b'foodgram_http_request_duration_seconds_bucket{',
+                      response.content)
+
+
+class ConnectionModeTest(SimpleTestCase):
+
+    def test_settings_are_restored(self):
+        saved = dict(connection.settings_dict)
+        with connection_mode('per-request', pool_size=1):
+            self.assertEqual(connection.settings_dict['CONN_MAX_AGE'], 0)
+        with connection_mode('persistent', pool_size=1):
+            self.assertIsNone(connection.settings_dict['CONN_MAX_AGE'])
+            self.assertTrue(connection.settings_dict['CONN_HEALTH_CHECKS'])
+        self.assertEqual(connection.settings_dict, saved)
+
+
+class LoadMixTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author', password='pass')
+        ingredient = Ingredient.objects.create(
+            name='соль', measurement_unit='г')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='Суп', text='Описание', cooking_time=5)
+        RecipeIngredient.objects.create(
+            recipe=cls.recipe, ingredient=ingredient, amount=1)
+
+    def test_mix_is_described_in_schema(self):
+        check_mix(MIX, default_schema_path())
+
+    def test_load_users_are_seeded_once(self):
+        tokens = seed_load_users(3)
+        self.assertEqual(len(tokens), 3)
+        self.assertCountEqual(seed_load_users(3), tokens)
+        self.assertEqual(
+            User.objects.filter(email__startswith='load').count(), 3)
+
+    def test_every_operation_gets_expected_status(self):
+        context = load_context(seed_load_users(2))
+        transport = InProcessTransport()
+        for operation in MIX:
+            with self.subTest(operation=operation.name):
+                status = transport.request(
+                    *operation.build(context, random.Random(0)))
+                self.assertIn(status, operation.statuses)
+
+    def test_run_mix_counts_requests(self):
+        class Transport:
+            def request(self, method, path, headers, body):
+                return 500 if method == 'PUT' else 200
+
+            def close(self):
+                pass
+
+        context = load_context(seed_load_users(2))
+        results = run_mix(Transport(), context, requests=300, concurrency=4)
+        self.assertEqual(
+            sum(len(result.durations) for result in results), 300)
+        for result in results:
+            self.assertEqual(sum(result.histogram()), len(result.durations))
+            expected_errors = (len(result.durations)
+                               if result.method == 'PUT' else 0)
+            if result.method in ('GET', 'PUT'):
+                self.assertEqual(result.errors, expected_errors)
+
+    def test_http_retries_only_stale_connections(self):
+        sent = []
+
+        class Connection:
+            # Ошибки по порядку попыток; None — ответ 200
+            outcomes = []
+
+            def __init__(self, netloc, timeout):
+                self.sock = None
+
+            def request(self, method, path, body, headers):
+                error = Connection.outcomes.pop(0)
+                if isinstance(error, BrokenPipeError):
+                    raise error
+                sent.append(method)
+                self.error = error
+
+            def getresponse(self):
+                if self.error is not None:
+                    raise self.error
+                self.sock = 'open'
+                return mock.Mock(status=200)
+
+            def close(self):
+                self.sock = None
+
+        disconnected = http.client.RemoteDisconnected('closed')
+        cases = [
+            ('GET', [disconnected, None], 200, 2),
+            ('GET', [TimeoutError('timed out')], CONNECTION_ERROR, 1),
+            ('POST', [disconnected], CONNECTION_ERROR, 1),
+            ('POST', [BrokenPipeError(), None], 200, 1),
+        ]
+        for method, outcomes, status, requests in cases:
+            with self.subTest(method=method, outcomes=outcomes):
+                transport = HttpTransport('http://localhost:8000')
+                transport.connection_class = Connection
+                Connection.outcomes = [None]
+                transport.request('GET', '/api/recipes/', {}, None)
+                sent.clear()
+                Connection.outcomes = list(outcomes)
+                self.assertEqual(
+                    transport.request(method, '/api/recipes/', {}, b''),
+                    status)
+                self.assertEqual(len(sent), requests)
+                self.assertEqual(Connection.outcomes, [])
+
+        # Новое соединение оборвалось сразу: сервер недоступен
+        transport = HttpTransport('http://localhost:8000')
+        transport.connection_class = Connection
+        Connection.outcomes = [disconnected, None]
+        self.assertEqual(transport.request('GET', '/', {}, None),
+                         CONNECTION_ERROR)
+
+
+class ApiBenchmarkBudgetTest(TestCase):
+    """Число запросов каждого маршрута не превышает бюджет.
+
+    Время и размер ответов проверяет команда benchmark_api на большом
+    наборе данных; здесь данных мало, а число запросов от объёма данных
+    зависеть не должно.
+    """
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.dataset = seed_dataset(users=30, recipes=60)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def test_every_route_has_a_scenario(self):
+        covered = {scenario.route for scenario in SCENARIOS}
+        for path, name in route_names(get_resolver().url_patterns):
+            if path.startswith(('api/', 's/')) and 'format' not in path:
+                with self.subTest(route=name):
+                    self.assertTrue(
+                        name in covered or name in EXCLUDED_ROUTES)
+
+    def test_query_budget(self):
+        results = run_scenarios(self.dataset, iterations=2)
+        failures = check_budget(results, load_budget(), metrics=('queries',))
+        self.assertEqual(failures, [])
@@ -1,43 +1,89 @@
+from functools import partial
+
 from rest_framework import viewsets, permissions, status
 from rest_framework.response import Response
 from django_filters.rest_framework import DjangoFilterBackend
 from django.shortcuts import get_object_or_404
-from django.http import FileResponse, JsonResponse
+from django.http import JsonResponse
+from django.utils.cache import get_conditional_response
 from djoser.views import UserViewSet
 from django.urls import reverse
+from django.conf import settings
 from django.contrib.auth import get_user_model
+from django.contrib.auth.models import AnonymousUser
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Value
+from django.db.models.functions import Greatest
 from rest_framework.decorators import action
 from rest_framework.permissions import (IsAuthenticated,
                                         IsAuthenticatedOrReadOnly)
-import datetime
 
-from .pagination import PageLimitPagination
+from .pagination import CursorPaginationMixin, PageLimitPagination
+from .profiling import SerializerTimingMixin
+from .replicas import ReplicaReadMixin
+from recipes.images import clear_image
 from recipes.models import (
     Recipe, Ingredient, Follow,
-    Favorite, ShoppingList, RecipeIngredient)
+    Favorite, ShoppingList)
 from .serializers import (
     RecipeSerializer, IngredientSerializer, FollowUserSerializer,
-    ShortRecipeSerializer, AvatarSerializer)
+    ShortRecipeSerializer, AvatarSerializer, RecipeBatchSerializer,
+    PantrySerializer)
 from .filters import NameSearchFilter, RecipeShoppingListFilter
+from .cache import recipe_cache
+from .exporters import SHOPPING_LIST_RENDERERS
+from .indexes import ingredient_index, pantry_index
+from .shopping_list import ShoppingListData
 
 User = get_user_model()
 
 
-class IngredientViewSet(viewsets.ReadOnlyModelViewSet):
+class IngredientViewSet(ReplicaReadMixin, SerializerTimingMixin,
+                        viewsets.ReadOnlyModelViewSet):
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     pagination_class = None
     filter_backends = (NameSearchFilter,)
     search_fields = ('^name',)
 
+    def list(self, request, *args, **kwargs):
+        terms = NameSearchFilter().get_search_terms(request)
+        if not terms:
+            return ingredient_index.catalog_response(request)
+        # Поиск по префиксу отвечает индекс в памяти, без запроса к базе
+        return Response(ingredient_index.search(
+            terms, self.get_search_limit(request)))
+
+    def get_search_limit(self, request):
+        limit = request.query_params.get('limit', '')
+        if limit.isdigit() and int(limit) > 0:
+            return int(limit)
+        return settings.INGREDIENT_SEARCH_LIMIT
+
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(ReplicaReadMixin, SerializerTimingMixin,
+                    CursorPaginationMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     pagination_class = PageLimitPagination
     filter_backends = (DjangoFilterBackend,)
     filterset_class = RecipeShoppingListFilter
     permission_classes = (IsAuthenticatedOrReadOnly,)
+    ranking_query_params = ('search',)
+    # True, пока строится общий для всех ответ для кэша
+    anonymous_base = False
+
+    def get_queryset(self):
+        user = AnonymousUser() if self.anonymous_base else self.request.user
+        return Recipe.objects.with_related().with_user_flags(user)
+
+    def list(self, request, *args, **kwargs):
+        return recipe_cache.get_response(
+            self, request, super().list, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return recipe_cache.get_response(
+            self, request, super().retrieve, *args, **kwargs)
 
     def perform_create(self, serializer):
         serializer.save(author=self.request.user)
@@ -90,42 +136,114 @@ class RecipeViewSet(viewsets.ModelViewSet):
         self.delete_from_favorite_or_shopping_list(request, pk, ShoppingList)
         return Response(status=status.HTTP_204_NO_CONTENT)
 
+    def get_batch_ids(self, request):
+        serializer = RecipeBatchSerializer(data=request.data)
+        serializer.is_valid(raise_exception=True)
+        # Порядок как в запросе, без повторов
+        return list(dict.fromkeys(serializer.validated_data['recipes']))
+
+    @transaction.atomic
+    def add_many_to_favorite_or_shopping_list(self, request, db_model):
+        ids = self.get_batch_ids(request)
+        user = request.user
+        found = set(Recipe.objects.filter(id__in=ids).values_list(
+            'id', flat=True))
+        existing = set(db_model.objects.filter(
+            user=user, recipe_id__in=ids).values_list('recipe_id', flat=True))
+        # Параллельный запрос мог добавить те же рецепты после проверки:
+        # считаем добавленными только строки, вставленные этим запросом
+        added = db_model.objects.add_recipes(
+            user, [pk for pk in ids if pk in found and pk not in existing])
+        # Сигналы не отправлялись: счётчик и кэш обновляем сами
+        if db_model is Favorite and added:
+            Recipe.objects.filter(id__in=added).update(
+                favorites_count=F('favorites_count') + 1)
+        transaction.on_commit(
+            partial(recipe_cache.invalidate_viewer, user.id))
+        return Response({'results': [
+            {'id': pk, 'status': 'not_found' if pk not in found
+             else 'added' if pk in added else 'exists'}
+            for pk in ids]})
+
+    @transaction.atomic
+    def delete_many_from_favorite_or_shopping_list(self, request, db_model):
+        ids = self.get_batch_ids(request)
+        user = request.user
+        # Один DELETE без сигналов на каждую строку
+        removed = db_model.objects.remove_recipes(user, ids)
+        if db_model is Favorite and removed:
+            Recipe.objects.filter(id__in=removed).update(
+                favorites_count=Greatest(F('favorites_count') - 1, 0))
+        if removed:
+            transaction.on_commit(
+                partial(recipe_cache.invalidate_viewer, user.id))
+        return Response({'results': [
+            {'id': pk, 'status': 'removed' if pk in removed else 'not_found'}
+            for pk in ids]})
+
+    @action(detail=False, methods=['post'], url_path='batch/favorite',
+            permission_classes=[IsAuthenticated])
+    def add_many_to_favorite(self, request):
+        return self.add_many_to_favorite_or_shopping_list(request, Favorite)
+
+    @add_many_to_favorite.mapping.delete
+    def delete_many_from_favorite(self, request):
+        return self.delete_many_from_favorite_or_shopping_list(
+            request, Favorite)
+
+    @action(detail=False, methods=['post'], url_path='batch/shopping_cart',
+            permission_classes=[IsAuthenticated])
+    def add_many_to_shopping_list(self, request):
+        return self.add_many_to_favorite_or_shopping_list(
+            request, ShoppingList)
+
+    @add_many_to_shopping_list.mapping.delete
+    def delete_many_from_shopping_list(self, request):
+        return self.delete_many_from_favorite_or_shopping_list(
+            request, ShoppingList)
+
+    @action(detail=False, methods=['get'], url_path='pantry')
+    def pantry(self, request):
+        """Рецепты из имеющихся продуктов, самые полные первыми.
+
+        Подбор идёт по индексу в памяти (api/indexes.py), из базы
+        читается только текущая страница.
+        """
+        serializer = PantrySerializer(data=request.query_params)
+        serializer.is_valid(raise_exception=True)
+        matches = pantry_index.match(
+            serializer.validated_data['ingredients'],
+            serializer.validated_data.get('max_missing'))
+        paginator = PageLimitPagination()
+        page = paginator.paginate_queryset(matches, request, view=self)
+        recipes = self.get_queryset().in_bulk(
+            [match.recipe_id for match in page])
+        # Рецепт могли удалить после построения индекса
+        page = [match for match in page if match.recipe_id in recipes]
+        data = self.get_serializer(
+            [recipes[match.recipe_id] for match in page], many=True).data
+        for item, match in zip(data, page):
+            item['matched_count'] = match.matched
+            item['missing_count'] = match.missing
+        return paginator.get_paginated_response(data)
+
     @action(detail=False, methods=['get'], url_path='download_shopping_cart',
             permission_classes=[IsAuthenticated])
     def download_shopping_list(self, request):
-        shopping_list = ShoppingList.objects.filter(user=request.user)
-        ingredients = {}
-        recipes = set()
-        for item in shopping_list:
-            recipe = item.recipe
-            recipe_ingredients = RecipeIngredient.objects.filter(
-                recipe=recipe)
-            recipes.add(recipe)
-            for ingredient in recipe_ingredients.all():
-                if ingredient.ingredient not in ingredients:
-                    ingredients[ingredient.ingredient.name] = {
-                        'amount': ingredient.amount,
-                        'measurement_unit': ingredient.ingredient.measurement_unit
-                    }
-                else:
-                    ingredients[ingredient.name]['amount'] += ingredient.amount
-        ingredients = dict(sorted(ingredients.items()))
-        to_str = []
-        for key in ingredients.keys():
-            to_str.append(f"{key.capitalize()} - {ingredients[key]['amount']} {ingredients[ingredient.ingredient.name]['measurement_unit']}")
-        recipes = [recipe.name for recipe in recipes]
-        output = f'Список покупок от {str(datetime.datetime.now().replace(second=0, microsecond=0))[:-3]}:\n' + '\n'.join(
-            ['Продукты:\n',
-             '\n'.join(to_str), '\n',
-             'Для рецептов:\n',
-             '\n'.join(recipes),
-             ])
-        response = FileResponse(output, content_type='text/plain')
-        # response['Content-Disposition'] = f'attachment; filename="{filename}"'
-        return response
-
-
-class AvatarViewSet(viewsets.ModelViewSet):
+        file_format = request.query_params.get('file_format', 'txt')
+        renderer_class = SHOPPING_LIST_RENDERERS.get(file_format)
+        if renderer_class is None:
+            return Response(
+                {'file_format': 'Доступные форматы: '
+                 + ', '.join(SHOPPING_LIST_RENDERERS)},
+                status=status.HTTP_400_BAD_REQUEST)
+        shopping_list = ShoppingListData.for_user(request.user)
+        response = renderer_class(shopping_list).get_response()
+        return get_conditional_response(
+            request, etag=response['ETag'], response=response)
+
+
+class AvatarViewSet(SerializerTimingMixin, viewsets.ModelViewSet):
     permission_classes = (permissions.IsAuthenticated,)
     serializer_class = AvatarSerializer
     queryset = User.objects.all()
@@ -138,12 +256,17 @@ class AvatarViewSet(viewsets.ModelViewSet):
         serializer.save(user=self.request.user)
 
 
-class CustomUserViewSet(UserViewSet):
+class CustomUserViewSet(ReplicaReadMixin, SerializerTimingMixin,
+                        CursorPaginationMixin, UserViewSet):
     pagination_class = PageLimitPagination
     permission_classes = (permissions.IsAuthenticatedOrReadOnly,)
 
     def get_queryset(self):
-        return User.objects.all()
+        user = self.request.user
+        if not user.is_authenticated:
+            return User.objects.annotate(is_subscribed=Value(False))
+        return User.objects.annotate(is_subscribed=Exists(
+            Follow.objects.filter(user=user, following=OuterRef('pk'))))
 
     @action(detail=False, methods=['put'], url_path='me/avatar')
     def set_avatar(self, request):
@@ -161,8 +284,9 @@ class CustomUserViewSet(UserViewSet):
 
     @set_avatar.mapping.delete
     def delete_avatar(self, request):
-        user = request.user
-        user.avatar.delete(save=True)
+        # Файл может быть общим с другими записями: его удалит
+        # clear_image, только если ссылок на него не останется
+        clear_image(request.user, 'avatar')
         return Response(status=status.HTTP_204_NO_CONTENT)
 
     @action(detail=True, methods=['post'], url_path='subscribe')
@@ -180,6 +304,7 @@ class CustomUserViewSet(UserViewSet):
                 status=status.HTTP_400_BAD_REQUEST)
 
         Follow.objects.create(user=user, following=user_to_follow)
+        user_to_follow.is_subscribed = True
         serializer = FollowUserSerializer(user_to_follow,
                                           context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
@@ -196,11 +321,30 @@ class CustomUserViewSet(UserViewSet):
 
     @action(detail=False, methods=['get'], url_path='subscriptions')
     def follow_list(self, request):
-        followings = Follow.objects.filter(user=request.user)
-        following_user_ids = followings.values_list('following__id', flat=True)
-        queryset = User.objects.filter(id__in=following_user_ids)
-
+        queryset = self.get_subscriptions(request)
         page = self.paginate_queryset(queryset)
         serializer = FollowUserSerializer(page or queryset, many=True,
                                           context={'request': request})
         return self.get_paginated_response(serializer.data)
+
+    def get_subscriptions(self, request):
+        recipes = Recipe.objects.order_by('-id')
+        recipes_limit = self.get_recipes_limit(request)
+        if recipes_limit is not None:
+            # Срез в Prefetch Django выполняет одним запросом
+            # с ROW_NUMBER() OVER (PARTITION BY author_id)
+            recipes = recipes[:recipes_limit]
+        return (
+            User.objects
+            .filter(followings__user=request.user)
+            .annotate(is_subscribed=Value(True))
+            .prefetch_related(Prefetch(
+                'recipes', queryset=recipes, to_attr='recent_recipes'))
+            .order_by('id')
+        )
+
+    def get_recipes_limit(self, request):
+        recipes_limit = request.query_params.get('recipes_limit', '')
+        if recipes_limit.isdigit():
+            return int(recipes_limit)
+        return None
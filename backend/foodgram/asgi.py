@@ -12,5 +12,8 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
+# Горячие пути чтения обслуживают асинхронные представления;
+# ASYNC_VIEWS=0 оставляет под ASGI только синхронные
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
 application = get_asgi_application()
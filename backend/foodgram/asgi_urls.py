@@ -0,0 +1,26 @@
+"""Маршруты режима ASGI.
+
+Горячие пути чтения обслуживают асинхронные представления, они стоят
+раньше маршрутов из foodgram.urls и перекрывают их. Остальные запросы,
+в том числе запись по тем же адресам, идут в синхронные представления.
+Имена маршрутов те же, что у синхронных: по ним подписаны метрики.
+"""
+from django.urls import path
+
+from api import async_views
+from recipes.views import extract_from_short_url_async
+
+from .urls import urlpatterns as sync_urlpatterns
+
+urlpatterns = [
+    path('s/<int:recipe_id>/', extract_from_short_url_async,
+         name='short-link'),
+    path('api/ingredients/', async_views.ingredient_list,
+         name='ingredients-list'),
+    path('api/recipes/', async_views.recipe_list, name='recipes-list'),
+    path('api/recipes/<int:pk>/', async_views.recipe_detail,
+         name='recipes-detail'),
+    path('api/users/subscriptions/', async_views.subscriptions,
+         name='users-follow-list'),
+    *sync_urlpatterns,
+]
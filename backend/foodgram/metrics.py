@@ -0,0 +1,63 @@
+"""Метрики Prometheus.
+
+Метрики процесса общие для приложений api и recipes и для настроек
+gunicorn (gunicorn.conf.py), поэтому живут в пакете проекта. Под
+gunicorn задан PROMETHEUS_MULTIPROC_DIR: каждый воркер пишет значения
+в свои файлы в этом каталоге, а metrics_view собирает их со всех
+воркеров. Без этой переменной (runserver, тесты) метрики хранятся в
+памяти процесса.
+"""
+import os
+
+from django.http import HttpResponse
+from prometheus_client import (CONTENT_TYPE_LATEST, REGISTRY,
+                               CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+# Маршрут запроса, который не нашёлся в urlconf: так у метрик не
+# появляются метки по каждому случайному адресу
+UNMATCHED_ROUTE = 'unmatched'
+
+REQUESTS = Counter(
+    'foodgram_http_requests_total', 'Запросы по маршрутам',
+    ['route', 'method', 'status'])
+REQUEST_DURATION = Histogram(
+    'foodgram_http_request_duration_seconds',
+    'Время ответа по маршрутам', ['route', 'method'])
+REQUESTS_IN_PROGRESS = Gauge(
+    'foodgram_http_requests_in_progress',
+    'Запросы, которые обрабатываются сейчас', multiprocess_mode='livesum')
+DB_QUERIES = Histogram(
+    'foodgram_db_queries_per_request', 'Запросы к базе за один HTTP-запрос',
+    ['route'], buckets=(0, 1, 2, 3, 5, 8, 13, 21, 34, 55, 100))
+DB_DURATION = Histogram(
+    'foodgram_db_duration_seconds',
+    'Время запросов к базе за один HTTP-запрос', ['route'])
+CACHE_REQUESTS = Counter(
+    'foodgram_cache_requests_total',
+    'Обращения к кэшу ответов: hit, miss и bypass', ['cache', 'result'])
+IMAGE_PROCESSING = Histogram(
+    'foodgram_image_processing_seconds',
+    'Обработка изображений: проверка и сохранение (attach), уменьшенные '
+    'копии (variants)', ['stage'],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30))
+GUNICORN_WORKERS = Gauge(
+    'foodgram_gunicorn_workers', 'Воркеров gunicorn',
+    multiprocess_mode='max')
+GUNICORN_WORKER_EXITS = Counter(
+    'foodgram_gunicorn_worker_exits_total',
+    'Завершения воркеров gunicorn, в том числе перезапуски')
+
+
+def get_registry():
+    if 'PROMETHEUS_MULTIPROC_DIR' not in os.environ:
+        return REGISTRY
+    registry = CollectorRegistry()
+    multiprocess.MultiProcessCollector(registry)
+    return registry
+
+
+def metrics_view(request):
+    """Метрики в текстовом формате Prometheus."""
+    return HttpResponse(generate_latest(get_registry()),
+                        content_type=CONTENT_TYPE_LATEST)
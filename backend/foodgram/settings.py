@@ -48,6 +48,9 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # Первыми, чтобы учитывать время всех остальных
+    'api.metrics.MetricsMiddleware',
+    'api.profiling.PerformanceMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -57,7 +60,10 @@ MIDDLEWARE = [
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
 
-ROOT_URLCONF = 'foodgram.urls'
+# ASYNC_VIEWS=1 (так запускает foodgram/asgi.py) подключает асинхронные
+# представления для горячих путей чтения
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', '') == '1'
+ROOT_URLCONF = 'foodgram.asgi_urls' if ASYNC_VIEWS else 'foodgram.urls'
 
 TEMPLATES = [
     {
@@ -80,24 +86,71 @@ WSGI_APPLICATION = 'foodgram.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/5.2/ref/settings/#databases
 
-'''DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': BASE_DIR / 'db.sqlite3',
+# DB_ENGINE=sqlite — локальная разработка и бенчмарки без PostgreSQL
+if os.getenv('DB_ENGINE', 'postgresql') == 'sqlite':
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            'NAME': BASE_DIR / 'db.sqlite3',
+        }
     }
-}'''
-DATABASES = {
-    'default': {
-        # Меняем настройку Django: теперь для работы будет использоваться
-        # бэкенд postgresql
-        'ENGINE': 'django.db.backends.postgresql',
-        'NAME': os.getenv('POSTGRES_DB', 'django'),
-        'USER': os.getenv('POSTGRES_USER', 'django'),
-        'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
-        'HOST': os.getenv('DB_HOST', ''),
-        'PORT': os.getenv('DB_PORT', 5432)
+else:
+    DATABASES = {
+        'default': {
+            # Меняем настройку Django: теперь для работы будет использоваться
+            # бэкенд postgresql
+            'ENGINE': 'django.db.backends.postgresql',
+            'NAME': os.getenv('POSTGRES_DB', 'django'),
+            'USER': os.getenv('POSTGRES_USER', 'django'),
+            'PASSWORD': os.getenv('POSTGRES_PASSWORD', ''),
+            'HOST': os.getenv('DB_HOST', ''),
+            'PORT': os.getenv('DB_PORT', 5432),
+            # Соединение переиспользуется запросами воркера
+            # DB_CONN_MAX_AGE секунд и проверяется перед первым запросом
+            # к базе. В режиме ASGI каждый запрос идёт в своём потоке,
+            # соединения потоков не переиспользуются: там нужен пул
+            'CONN_MAX_AGE': int(os.getenv(
+                'DB_CONN_MAX_AGE', 0 if ASYNC_VIEWS else 60)),
+            'CONN_HEALTH_CHECKS': os.getenv(
+                'DB_CONN_HEALTH_CHECKS', '1') == '1',
+        }
     }
-}
+    # DB_POOL=1 включает пул соединений psycopg: свой в каждом воркере,
+    # поэтому всего соединений до (число воркеров × DB_POOL_MAX_SIZE)
+    if os.getenv('DB_POOL', '') == '1':
+        from psycopg_pool import ConnectionPool
+
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        DATABASES['default']['OPTIONS'] = {
+            'pool': {
+                'min_size': int(os.getenv('DB_POOL_MIN_SIZE', 1)),
+                'max_size': int(os.getenv('DB_POOL_MAX_SIZE', 4)),
+                # Сколько секунд ждать свободного соединения
+                'timeout': float(os.getenv('DB_POOL_TIMEOUT', 10)),
+                # Проверка соединения перед выдачей из пула
+                'check': ConnectionPool.check_connection,
+            },
+        }
+
+# DB_REPLICAS=host1,host2:5433 — реплики PostgreSQL только для чтения.
+# Безопасные запросы вьюсетов API читают с них (api/replicas.py)
+DATABASE_REPLICAS = []
+for index, address in enumerate(
+        filter(None, os.getenv('DB_REPLICAS', '').split(',')), start=1):
+    host, _, port = address.strip().partition(':')
+    alias = f'replica{index}'
+    DATABASES[alias] = {
+        **DATABASES['default'],
+        'HOST': host,
+        'PORT': port or DATABASES['default']['PORT'],
+        'OPTIONS': dict(DATABASES['default'].get('OPTIONS', {})),
+        # В тестах реплика — та же база, что и default
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(alias)
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+# Сколько секунд после записи пользователь читает из основной базы
+REPLICA_PIN_SECONDS = int(os.getenv('REPLICA_PIN_SECONDS', 5))
 
 
 # Password validation
@@ -140,6 +193,67 @@ STATIC_ROOT = BASE_DIR / 'collected_static'
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
+# Кэш: по умолчанию в памяти процесса с вытеснением давно не
+# использованных записей. CACHE_BACKEND и CACHE_LOCATION подключают общий
+# для всех воркеров бэкенд, например
+# django.core.cache.backends.redis.RedisCache и redis://redis:6379/0
+CACHE_BACKEND = os.getenv(
+    'CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache')
+CACHES = {
+    'default': {
+        'BACKEND': CACHE_BACKEND,
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    }
+}
+if CACHE_BACKEND.endswith('LocMemCache'):
+    CACHES['default']['OPTIONS'] = {
+        'MAX_ENTRIES': int(os.getenv('CACHE_MAX_ENTRIES', 5000)),
+    }
+
+# Кэш ответов списка и карточки рецептов; 0 отключает кэширование
+RECIPE_CACHE_ALIAS = 'default'
+RECIPE_CACHE_TIMEOUT = int(os.getenv('RECIPE_CACHE_TIMEOUT', 300))
+
+# Сколько ингредиентов отдавать на поиск по префиксу (None — все);
+# клиент может запросить меньше параметром limit
+INGREDIENT_SEARCH_LIMIT = (
+    int(os.getenv('INGREDIENT_SEARCH_LIMIT'))
+    if os.getenv('INGREDIENT_SEARCH_LIMIT') else None)
+
+# Фоновая обработка загруженных изображений: число потоков и сколько
+# задач может ждать в очереди, прежде чем API начнёт отвечать 503.
+# IMAGE_TASKS_EAGER=1 обрабатывает изображения прямо в запросе
+IMAGE_WORKERS = int(os.getenv('IMAGE_WORKERS', 2))
+IMAGE_QUEUE_SIZE = int(os.getenv('IMAGE_QUEUE_SIZE', 20))
+IMAGE_TASKS_EAGER = os.getenv('IMAGE_TASKS_EAGER', '') == '1'
+
+# TTF-шрифт с кириллицей для PDF-версии списка покупок
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    '/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+# Профилирование запросов (api/profiling.py): доля запросов в выборке
+# от 0 до 1 (0 выключает), заголовок Server-Timing и сколько повторов
+# одного запроса к базе считать признаком N+1
+PERF_SAMPLE_RATE = float(os.getenv('PERF_SAMPLE_RATE', 0))
+PERF_SERVER_TIMING = os.getenv('PERF_SERVER_TIMING', '1') == '1'
+PERF_N_PLUS_ONE_THRESHOLD = int(os.getenv('PERF_N_PLUS_ONE_THRESHOLD', 10))
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {'class': 'logging.StreamHandler'},
+    },
+    'loggers': {
+        'foodgram.performance': {
+            'handlers': ['console'],
+            'level': os.getenv('PERF_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
+    },
+}
+
 # Default primary key field type
 # https://docs.djangoproject.com/en/5.2/ref/settings/#default-auto-field
 
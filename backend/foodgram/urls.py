@@ -1,8 +1,12 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from .metrics import metrics_view
+
 urlpatterns = [
     path('s/', include('recipes.urls')),
     path('admin/', admin.site.urls),
     path('api/', include('api.urls')),
+    # nginx сюда не проксирует: метрики доступны только из сети docker
+    path('metrics', metrics_view, name='metrics'),
 ]
@@ -14,3 +14,8 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'foodgram.settings')
 
 application = get_wsgi_application()
+
+# Индекс ингредиентов строится при старте воркера, а не на первом запросе
+from api.indexes import ingredient_index  # noqa: E402
+
+ingredient_index.warm()
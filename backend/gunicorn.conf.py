@@ -0,0 +1,41 @@
+"""Настройки gunicorn; он читает этот файл из рабочего каталога сам.
+
+Метрики Prometheus собираются со всех воркеров: каждый пишет их в
+файлы в PROMETHEUS_MULTIPROC_DIR, а /metrics суммирует. Каталог
+очищается при старте мастера, файлы завершившихся воркеров помечаются
+мёртвыми, чтобы их счётчики запросов в работе не висели.
+"""
+import os
+import shutil
+
+# Переменная нужна до импорта prometheus_client в мастере и воркерах
+multiproc_dir = os.environ.setdefault(
+    'PROMETHEUS_MULTIPROC_DIR', '/tmp/foodgram-metrics')
+
+
+def on_starting(server):
+    shutil.rmtree(multiproc_dir, ignore_errors=True)
+    os.makedirs(multiproc_dir)
+
+
+def when_ready(server):
+    set_workers(server.num_workers)
+
+
+def nworkers_changed(server, new_value, old_value):
+    # Первый вызов — до on_starting, каталога метрик ещё нет
+    if old_value is not None:
+        set_workers(new_value)
+
+
+def set_workers(count):
+    from foodgram.metrics import GUNICORN_WORKERS
+    GUNICORN_WORKERS.set(count)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    from foodgram.metrics import GUNICORN_WORKER_EXITS
+    GUNICORN_WORKER_EXITS.inc()
+    multiprocess.mark_process_dead(worker.pid)
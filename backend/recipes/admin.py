@@ -1,7 +1,13 @@
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from django.contrib.auth import get_user_model
+from django.db.models import Count, Prefetch
+from django.utils.html import format_html
 from django.utils.safestring import mark_safe
+
+from api.exporters import UsersCsvRenderer
+
+from .images import variant_name
 from .models import (Recipe, Ingredient,
                      RecipeIngredient, Follow, Favorite,
                      ShoppingList)
@@ -9,6 +15,15 @@ from .models import (Recipe, Ingredient,
 User = get_user_model()
 
 
+def thumbnail(field):
+    """Превью из уменьшенной копии вместо оригинала."""
+    if not field:
+        return "-"
+    return format_html(
+        '<img src="{}" width="40" />',
+        field.storage.url(variant_name(field.name, 'thumb', 'jpeg')))
+
+
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
     list_display = (
@@ -17,28 +32,22 @@ class CustomUserAdmin(UserAdmin):
         'full_name',
         'email',
         'avatar',
-        'recipe_count',
+        'recipes_count',
         'followings_count',
         'followers_count',
     )
     search_fields = ('email', 'username')
+    actions = ('export_shopping_lists',)
 
     def full_name(self, user):
         return f'{user.last_name} {user.first_name}'
 
-    def recipe_count(self, user):
-        return user.recipes.count()
-
-    def followings_count(self, user):
-        return user.followings.count()
-
-    def followers_count(self, user):
-        return user.followers.count()
+    @admin.action(description='Выгрузить списки покупок (CSV)')
+    def export_shopping_lists(self, request, queryset):
+        return UsersCsvRenderer(queryset).get_response()
 
     def avatar(self, user):
-        if user.avatar:
-            return mark_safe(f'<img src="{user.avatar.url}" width="40" />')
-        return "-"
+        return thumbnail(user.avatar)
 
 
 @admin.register(Recipe)
@@ -48,23 +57,25 @@ class RecipeAdmin(admin.ModelAdmin):
         'author',
         'name',
         'cooking_time',
-        'favorite_count',
+        'favorites_count',
         'ingredients_display',
         'image',
     )
-    search_fields = ('author', 'name')
+    search_fields = ('name', 'author__username', 'author__email')
     list_filter = ('author',)
+    list_select_related = ('author',)
+    readonly_fields = ('favorites_count',)
 
-    def favorite_count(self, recipe):
-        count = recipe.favorites.count()
-        return count
+    def get_queryset(self, request):
+        return super().get_queryset(request).prefetch_related(Prefetch(
+            'ingredients_in_recipes',
+            queryset=RecipeIngredient.objects.select_related('ingredient')))
 
     def image(self, recipe):
-        return mark_safe(f'<img src="{recipe.image.url}" width="40" />')
+        return thumbnail(recipe.image)
 
     def ingredients_display(self, recipe):
-        html = ''
-        html = '</br>'.join(f'<strong>{ingr.ingredient.name}</strong> — {ingr.amount} {ingr.ingredient.measurement_unit}' for ingr in recipe.ingredients_in_recipes)
+        html = '</br>'.join(f'<strong>{ingr.ingredient.name}</strong> — {ingr.amount} {ingr.ingredient.measurement_unit}' for ingr in recipe.ingredients_in_recipes.all())
         return mark_safe(html)
 
 
@@ -78,6 +89,14 @@ class IngredientAdmin(admin.ModelAdmin):
     search_fields = ('name', 'measurement_unit')
     list_filter = ('measurement_unit',)
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).annotate(
+            recipes_count=Count('recipes'))
+
+    @admin.display(description='Рецептов', ordering='recipes_count')
+    def recipes_count(self, ingredient):
+        return ingredient.recipes_count
+
 
 admin.site.register(RecipeIngredient)
 admin.site.register(Follow)
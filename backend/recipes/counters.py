@@ -0,0 +1,43 @@
+from django.contrib.auth import get_user_model
+from django.db.models import Count, F, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+from .models import Favorite, Follow, Recipe
+
+User = get_user_model()
+
+# (модель со счётчиком, поле счётчика, связанная модель, внешний ключ)
+COUNTERS = (
+    (Recipe, 'favorites_count', Favorite, 'recipe'),
+    (User, 'recipes_count', Recipe, 'author'),
+    (User, 'followers_count', Follow, 'user'),
+    (User, 'followings_count', Follow, 'following'),
+)
+
+
+def count_subquery(model, field):
+    return Coalesce(Subquery(
+        model.objects
+        .filter(**{field: OuterRef('pk')})
+        .order_by()
+        .values(field)
+        .annotate(count=Count('pk'))
+        .values('count')
+    ), 0)
+
+
+def reconcile_counters():
+    """Пересчитывает счётчики одним UPDATE на каждый счётчик.
+
+    Обновляются только разошедшиеся строки; возвращает их число
+    для каждого счётчика.
+    """
+    drifted = {}
+    for model, field, related_model, foreign_key in COUNTERS:
+        drifted[f'{model.__name__}.{field}'] = (
+            model.objects
+            .annotate(actual=count_subquery(related_model, foreign_key))
+            .exclude(**{field: F('actual')})
+            .update(**{field: count_subquery(related_model, foreign_key)})
+        )
+    return drifted
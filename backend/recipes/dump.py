@@ -0,0 +1,364 @@
+"""Выгрузка и загрузка рецептов с авторами, ингредиентами и связями.
+
+Дамп — поток NDJSON (со сжатием gzip, если имя кончается на .gz):
+заголовок, затем ингредиенты, пользователи, рецепты с составом,
+избранное, списки покупок и подписки. Записи ссылаются друг на друга
+по id исходной базы, при загрузке они переводятся в новые id через
+словари в памяти. Картинки вложены в base64 записью image перед первой
+ссылкой на них; одинаковые файлы (имя — sha256 содержимого) выгружаются
+один раз.
+
+Загрузка идёт пачками bulk_create, каждая пачка в своей транзакции.
+После пачки в файл контрольной точки дописываются номер последней
+строки и новые соответствия id, так что прерванную загрузку можно
+продолжить с места остановки. Пачка, зафиксированная в базе перед самым
+сбоем, но не успевшая попасть в контрольную точку, загрузится повторно:
+ингредиенты и пользователи находятся по названию и email, связи не
+дублируются благодаря уникальным ограничениям, а рецепты — благодаря
+таблице ImportedRecipe, которая пишется в той же транзакции. Ключ в ней
+— источник из заголовка дампа и id рецепта в исходной базе.
+"""
+import base64
+import gzip
+import json
+import os
+import uuid
+from collections import Counter
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Exists, OuterRef
+
+from .models import (Favorite, Follow, ImportedRecipe, Ingredient, Recipe,
+                     RecipeIngredient, ShoppingList)
+from .storage import media_storage
+
+User = get_user_model()
+
+FORMAT = 'foodgram-dump'
+VERSION = 1
+
+USER_FIELDS = ('email', 'username', 'first_name', 'last_name', 'password',
+               'date_joined')
+
+
+def open_dump(path, mode='r'):
+    path = str(path)
+    if path.endswith('.gz'):
+        return gzip.open(path, f'{mode}t', encoding='utf-8')
+    return open(path, mode, encoding='utf-8')
+
+
+class DumpWriter:
+
+    def __init__(self, file, storage=media_storage, chunk_size=2000):
+        self.file = file
+        self.storage = storage
+        self.chunk_size = chunk_size
+        self.images = set()
+        self.missing = set()
+        self.counts = Counter()
+
+    def write(self, record):
+        self.file.write(json.dumps(
+            record, ensure_ascii=False, separators=(',', ':'), default=str))
+        self.file.write('\n')
+        self.counts[record['type']] += 1
+
+    def write_image(self, name):
+        """Вкладывает файл, если он ещё не выгружен; None без файла."""
+        if not name or name in self.missing:
+            return None
+        if name not in self.images:
+            if not self.storage.exists(name):
+                self.missing.add(name)
+                self.counts['missing image'] += 1
+                return None
+            with self.storage.open(name, 'rb') as image:
+                data = base64.b64encode(image.read()).decode()
+            self.write({'type': 'image', 'name': name, 'data': data})
+            self.images.add(name)
+        return name
+
+    def rows(self, queryset, *fields):
+        return queryset.order_by('id').values_list(*fields).iterator(
+            chunk_size=self.chunk_size)
+
+    def export(self):
+        # Каждая выгрузка — свой источник для ImportedRecipe
+        self.write({'type': 'header', 'format': FORMAT, 'version': VERSION,
+                    'source': uuid.uuid4().hex})
+        for pk, name, unit in self.rows(
+                Ingredient.objects, 'id', 'name', 'measurement_unit'):
+            self.write({'type': 'ingredient', 'id': pk, 'name': name,
+                        'measurement_unit': unit})
+        # Права администратора между окружениями не переносятся
+        for pk, avatar, *values in self.rows(
+                User.objects, 'id', 'avatar', *USER_FIELDS):
+            self.write({'type': 'user', 'id': pk,
+                        'avatar': self.write_image(avatar),
+                        **dict(zip(USER_FIELDS, values))})
+        self.export_recipes()
+        for model, record_type, fields in (
+                (Favorite, 'favorite', ('user_id', 'recipe_id')),
+                (ShoppingList, 'shopping_cart', ('user_id', 'recipe_id')),
+                (Follow, 'follow', ('user_id', 'following_id'))):
+            for first, second in self.rows(model.objects, *fields):
+                self.write({'type': record_type,
+                            fields[0][:-3]: first, fields[1][:-3]: second})
+        return self.counts
+
+    def export_recipes(self):
+        """Рецепты с составом: два упорядоченных по рецепту потока
+        сливаются без загрузки состава всех рецептов в память."""
+        items = RecipeIngredient.objects.order_by(
+            'recipe_id', 'id').values_list(
+                'recipe_id', 'ingredient_id', 'amount').iterator(
+                    chunk_size=self.chunk_size)
+        item = next(items, None)
+        for pk, author, name, text, cooking_time, image in self.rows(
+                Recipe.objects, 'id', 'author_id', 'name', 'text',
+                'cooking_time', 'image'):
+            ingredients = []
+            while item is not None and item[0] <= pk:
+                if item[0] == pk:
+                    ingredients.append(item[1:])
+                item = next(items, None)
+            self.write({'type': 'recipe', 'id': pk, 'author': author,
+                        'name': name, 'text': text,
+                        'cooking_time': cooking_time,
+                        'image': self.write_image(image),
+                        'ingredients': ingredients})
+
+
+def export_dump(path, **kwargs):
+    """Выгружает базу в path и возвращает число записей каждого типа."""
+    with open_dump(path, 'w') as file:
+        return DumpWriter(file, **kwargs).export()
+
+
+class DumpImporter:
+    """Загружает дамп пачками с контрольными точками.
+
+    maps переводит id исходной базы в id этой базы для ингредиентов,
+    пользователей и рецептов, а имена картинок — в имена в хранилище.
+    """
+
+    MAPS = ('ingredient', 'user', 'recipe', 'image')
+
+    def __init__(self, checkpoint_path, batch_size=1000,
+                 storage=media_storage, progress=None):
+        self.checkpoint_path = checkpoint_path
+        self.batch_size = batch_size
+        self.storage = storage
+        self.progress = progress
+        self.maps = {name: {} for name in self.MAPS}
+        self.delta = {name: {} for name in self.MAPS}
+        self.stats = Counter()
+        self.done_line = 0
+        self.source = None
+
+    def load_checkpoint(self):
+        """Продолжает с последней контрольной точки, если она есть."""
+        if not os.path.exists(self.checkpoint_path):
+            return
+        with open(self.checkpoint_path, 'rb+') as file:
+            offset = 0
+            for line in file:
+                try:
+                    checkpoint = json.loads(line)
+                except json.JSONDecodeError:
+                    # Строка, недописанная при сбое: следующие точки
+                    # допишутся на её место
+                    file.truncate(offset)
+                    break
+                offset += len(line)
+                self.done_line = checkpoint['line']
+                for name, mapping in checkpoint['maps'].items():
+                    self.maps[name].update(
+                        mapping.items() if name == 'image' else
+                        ((int(key), value) for key, value in mapping.items()))
+
+    def save_checkpoint(self, line):
+        with open(self.checkpoint_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps({'line': line, 'maps': self.delta},
+                                  ensure_ascii=False) + '\n')
+            file.flush()
+            os.fsync(file.fileno())
+        self.done_line = line
+        self.delta = {name: {} for name in self.MAPS}
+
+    def map(self, name, source, target):
+        self.maps[name][source] = target
+        self.delta[name][source] = target
+
+    def read_header(self, text):
+        header = json.loads(text) if text else {}
+        if (header.get('type'), header.get('format'),
+                header.get('version')) != ('header', FORMAT, VERSION):
+            raise ValueError(f'Неизвестный формат дампа: {header}')
+        self.source = header['source']
+
+    def run(self, file):
+        self.load_checkpoint()
+        # Заголовок нужен и при продолжении с контрольной точки
+        self.read_header(file.readline())
+        batch, batch_type, line = [], None, 1
+        for line, text in enumerate(file, start=2):
+            if line <= self.done_line:
+                continue
+            record = json.loads(text)
+            record_type = record['type']
+            if record_type == 'image':
+                # Картинки пишутся сразу, запись в хранилище идемпотентна
+                self.import_image(record)
+                continue
+            if batch and (record_type != batch_type
+                          or len(batch) >= self.batch_size):
+                self.flush(batch_type, batch, line - 1)
+                batch = []
+            batch_type = record_type
+            batch.append(record)
+        if batch:
+            self.flush(batch_type, batch, line)
+        elif line > self.done_line:
+            self.save_checkpoint(line)
+        return self.stats
+
+    def flush(self, record_type, batch, line):
+        handler = getattr(self, f'import_{record_type}s', None)
+        if handler is None:
+            raise ValueError(f'Неизвестный тип записи: {record_type}')
+        with transaction.atomic():
+            handler(batch)
+        self.save_checkpoint(line)
+        if self.progress:
+            self.progress(line, self.stats)
+
+    def import_image(self, record):
+        name = self.storage.save(
+            record['name'], ContentFile(base64.b64decode(record['data'])))
+        self.map('image', record['name'], name)
+        self.stats['image'] += 1
+
+    def import_ingredients(self, batch):
+        """Ингредиент определяется названием и единицей измерения."""
+        def lookup(records):
+            return {
+                (name, unit): pk
+                for pk, name, unit in Ingredient.objects.filter(
+                    name__in={record['name'] for record in records}
+                ).values_list('id', 'name', 'measurement_unit')}
+
+        def key(record):
+            return record['name'], record['measurement_unit']
+
+        found = lookup(batch)
+        missing = [record for record in batch if key(record) not in found]
+        if missing:
+            Ingredient.objects.bulk_create(
+                [Ingredient(name=record['name'],
+                            measurement_unit=record['measurement_unit'])
+                 for record in missing], ignore_conflicts=True)
+            found.update(lookup(missing))
+        for record in batch:
+            self.map('ingredient', record['id'], found[key(record)])
+        self.stats['ingredient'] += len(missing)
+        self.stats['ingredient existing'] += len(batch) - len(missing)
+
+    def import_users(self, batch):
+        """Пользователь определяется email; уже существующие не
+        меняются."""
+        def lookup(records):
+            return dict(User.objects.filter(
+                email__in=[record['email'] for record in records]
+            ).values_list('email', 'id'))
+
+        found = lookup(batch)
+        missing = [record for record in batch if record['email'] not in found]
+        if missing:
+            User.objects.bulk_create(
+                [User(avatar=self.maps['image'].get(record['avatar']),
+                      **{field: record[field] for field in USER_FIELDS})
+                 for record in missing], ignore_conflicts=True)
+            found.update(lookup(missing))
+        for record in batch:
+            if record['email'] in found:
+                self.map('user', record['id'], found[record['email']])
+            else:
+                # Занят username: рецепты и связи пользователя пропустятся
+                self.stats['user conflict'] += 1
+        created = sum(record['email'] in found for record in missing)
+        self.stats['user'] += created
+        self.stats['user existing'] += len(batch) - len(missing)
+
+    def import_recipes(self, batch):
+        # Рецепты, загруженные раньше, но не попавшие в контрольную точку
+        imported = dict(ImportedRecipe.objects.filter(
+            Exists(Recipe.objects.filter(pk=OuterRef('recipe_id'))),
+            source=self.source,
+            source_id__in=[record['id'] for record in batch],
+        ).values_list('source_id', 'recipe_id'))
+        recipes, sources = [], []
+        for record in batch:
+            if record['id'] in imported:
+                self.map('recipe', record['id'], imported[record['id']])
+                self.stats['recipe existing'] += 1
+                continue
+            author = self.maps['user'].get(record['author'])
+            if author is None:
+                self.stats['recipe skipped'] += 1
+                continue
+            recipes.append(Recipe(
+                author_id=author, name=record['name'], text=record['text'],
+                cooking_time=record['cooking_time'],
+                image=self.maps['image'].get(record['image'])))
+            sources.append(record)
+        Recipe.objects.bulk_create(recipes)
+        items = []
+        for recipe, record in zip(recipes, sources):
+            self.map('recipe', record['id'], recipe.pk)
+            for ingredient, amount in record['ingredients']:
+                ingredient = self.maps['ingredient'].get(ingredient)
+                if ingredient is not None:
+                    items.append(RecipeIngredient(
+                        recipe=recipe, ingredient_id=ingredient,
+                        amount=amount))
+        RecipeIngredient.objects.bulk_create(items)
+        # Строка удалённого с тех пор рецепта указывает на новый
+        ImportedRecipe.objects.bulk_create(
+            [ImportedRecipe(source=self.source, source_id=record['id'],
+                            recipe=recipe)
+             for recipe, record in zip(recipes, sources)],
+            update_conflicts=True, unique_fields=('source', 'source_id'),
+            update_fields=('recipe',))
+        self.stats['recipe'] += len(recipes)
+
+    def import_relations(self, batch, model, fields):
+        """Связи без собственных данных; fields — поле модели:
+        (ключ записи, словарь id)."""
+        objects = []
+        for record in batch:
+            values = {field: self.maps[map_name].get(record[key])
+                      for field, (key, map_name) in fields.items()}
+            if None in values.values():
+                self.stats[f'{record["type"]} skipped'] += 1
+                continue
+            objects.append(model(**values))
+        # Повторная загрузка пачки не создаст дубликатов
+        model.objects.bulk_create(objects, ignore_conflicts=True)
+        self.stats[batch[0]['type']] += len(objects)
+
+    def import_favorites(self, batch):
+        self.import_relations(batch, Favorite, {
+            'user_id': ('user', 'user'), 'recipe_id': ('recipe', 'recipe')})
+
+    def import_shopping_carts(self, batch):
+        self.import_relations(batch, ShoppingList, {
+            'user_id': ('user', 'user'), 'recipe_id': ('recipe', 'recipe')})
+
+    def import_follows(self, batch):
+        self.import_relations(batch, Follow, {
+            'user_id': ('user', 'user'),
+            'following_id': ('following', 'user')})
@@ -0,0 +1,178 @@
+import hashlib
+import io
+import logging
+import posixpath
+import threading
+from contextlib import contextmanager
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.db import transaction
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from foodgram.metrics import IMAGE_PROCESSING
+
+from .models import Recipe
+from .storage import media_storage
+
+logger = logging.getLogger(__name__)
+
+User = get_user_model()
+
+# Вариант: наибольшие ширина и высота; меньшие изображения не растягиваются
+VARIANTS = {
+    'thumb': (96, 96),
+    'card': (480, 480),
+    'full': (1280, 1280),
+}
+# Формат: (формат Pillow, расширение, параметры сохранения)
+FORMATS = {
+    'jpeg': ('JPEG', 'jpg', {'quality': 82, 'optimize': True,
+                             'progressive': True}),
+    'webp': ('WEBP', 'webp', {'quality': 80, 'method': 4}),
+}
+
+
+def variant_name(name, variant, image_format):
+    """Имя варианта однозначно задаётся именем оригинала.
+
+    recipes/images/pie.png -> recipes/images/variants/pie.thumb.webp
+    """
+    directory, filename = posixpath.split(name)
+    stem = posixpath.splitext(filename)[0]
+    extension = FORMATS[image_format][1]
+    return posixpath.join(
+        directory, 'variants', f'{stem}.{variant}.{extension}')
+
+
+def variant_names(name):
+    return {variant: {image_format: variant_name(name, variant, image_format)
+                      for image_format in FORMATS}
+            for variant in VARIANTS}
+
+
+def variant_urls(name, storage=media_storage):
+    return {variant: {image_format: storage.url(path)
+                      for image_format, path in formats.items()}
+            for variant, formats in variant_names(name).items()}
+
+
+def prepare(image, image_format):
+    """Приводит режим изображения к поддерживаемому форматом."""
+    has_alpha = image.mode in ('RGBA', 'LA') or (
+        image.mode == 'P' and 'transparency' in image.info)
+    if image_format == 'webp' and has_alpha:
+        return image.convert('RGBA')
+    if has_alpha:
+        # В JPEG нет прозрачности: кладём изображение на белый фон
+        image = image.convert('RGBA')
+        background = Image.new('RGB', image.size, 'white')
+        background.paste(image, mask=image.getchannel('A'))
+        return background
+    return image.convert('RGB')
+
+
+def make_variants(name, storage=media_storage, force=False):
+    """Создаёт все варианты изображения name.
+
+    Возвращает False, если варианты уже есть и force не передан.
+    """
+    names = variant_names(name)
+    last = names['full']['webp']
+    if not force and storage.exists(last):
+        return False
+    with IMAGE_PROCESSING.labels('variants').time():
+        with storage.open(name) as file:
+            original = Image.open(file)
+            original = ImageOps.exif_transpose(original)
+            original.load()
+        for variant, size in VARIANTS.items():
+            resized = original.copy()
+            resized.thumbnail(size, Image.Resampling.LANCZOS)
+            for image_format, path in names[variant].items():
+                pillow_format, _, options = FORMATS[image_format]
+                buffer = io.BytesIO()
+                prepare(resized, image_format).save(
+                    buffer, pillow_format, **options)
+                save_variant(storage, path, ContentFile(buffer.getvalue()))
+    return True
+
+
+def save_variant(storage, path, content):
+    """Имя копии детерминированное: перезаписываем, а не получаем
+    новое имя с суффиксом или хэшем от storage."""
+    if hasattr(storage, 'save_as'):
+        return storage.save_as(path, content)
+    if storage.exists(path):
+        storage.delete(path)
+    return storage.save(path, content)
+
+
+# Блокировки процесса по имени файла; имена делят фиксированный набор
+_name_locks = [threading.Lock() for _ in range(64)]
+
+
+@contextmanager
+def image_lock(name):
+    """Блокировка имени файла.
+
+    release_image проверяет ссылки и удаляет файл, attach_image
+    записывает файл и ссылку на него: под одной блокировкой удаление не
+    застанет файл, ссылка на который ещё не зафиксирована. На PostgreSQL
+    это advisory-блокировка до конца транзакции, общая для всех
+    воркеров, на других базах — только внутри процесса.
+    """
+    key = int.from_bytes(
+        hashlib.sha256(name.encode()).digest()[:8], 'big', signed=True)
+    with _name_locks[key % len(_name_locks)]:
+        connection = transaction.get_connection()
+        if connection.vendor != 'postgresql':
+            yield
+            return
+        with transaction.atomic(savepoint=False):
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [key])
+            yield
+
+
+def is_referenced(name):
+    return (Recipe.objects.filter(image=name).exists()
+            or User.objects.filter(avatar=name).exists())
+
+
+def release_image(name, storage):
+    """Удаляет файл и его копии, если на него больше никто не ссылается.
+
+    Одинаковые загрузки хранятся одним файлом, поэтому удалять файл
+    вместе с записью нельзя: счётчиком ссылок служат сами записи.
+    """
+    if not name:
+        return False
+    with image_lock(name):
+        if is_referenced(name):
+            return False
+        storage.delete(name)
+        for formats in variant_names(name).values():
+            for path in formats.values():
+                storage.delete(path)
+    return True
+
+
+def ensure_variants(name, storage=media_storage):
+    """Создаёт недостающие варианты файла, ошибки только пишет в лог."""
+    try:
+        make_variants(name, storage)
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        logger.warning('Не удалось создать варианты %s', name,
+                       exc_info=True)
+
+
+def clear_image(instance, field_name):
+    """Отвязывает изображение и удаляет файл, если он больше не нужен."""
+    field = getattr(instance, field_name)
+    name, storage = field.name, field.storage
+    setattr(instance, field_name, None)
+    instance.save(update_fields=[field_name])
+    if name:
+        transaction.on_commit(partial(release_image, name, storage))
@@ -0,0 +1,265 @@
+"""Потоковый импорт справочников из JSON и CSV.
+
+Файл читается построчно (JSON — по одному объекту массива), строки
+пишутся пачками по batch_size. Память не зависит от размера файла:
+повторы внутри пачки отсекаются в памяти, а с уже загруженными
+строками — запросом к базе по ключу. Повторный импорт того же файла
+ничего не меняет.
+"""
+import csv
+import json
+import time
+from dataclasses import dataclass, field
+from itertools import islice
+from pathlib import Path
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import transaction
+
+from .models import Ingredient
+
+CHUNK_SIZE = 64 * 1024
+MAX_ERRORS = 20
+
+
+def default_ingredients_path():
+    paths = (settings.BASE_DIR.parent / 'data' / 'ingredients.json',
+             settings.BASE_DIR / 'ingredients.json')
+    for path in paths:
+        if path.exists():
+            return path
+    raise FileNotFoundError('Не найден файл ingredients.json: '
+                            + ', '.join(str(path) for path in paths))
+
+
+def read_json(file):
+    """Объекты JSON-массива по одному или строки JSON Lines."""
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    in_array = None
+    eof = False
+    while True:
+        # Пропускаем пробелы и разделители между объектами
+        while True:
+            while position < len(buffer) and buffer[position] in ' \t\r\n,':
+                position += 1
+            if position < len(buffer) or eof:
+                break
+            buffer, position = file.read(CHUNK_SIZE), 0
+            eof = not buffer
+        if position == len(buffer):
+            return
+        if in_array is None:
+            in_array = buffer[position] == '['
+            if in_array:
+                position += 1
+                continue
+        if in_array and buffer[position] == ']':
+            return
+        try:
+            item, end = decoder.raw_decode(buffer, position)
+        except json.JSONDecodeError:
+            if eof:
+                raise
+            # Объект не поместился в буфер: дочитываем
+            chunk = file.read(CHUNK_SIZE)
+            eof = not chunk
+            buffer, position = buffer[position:] + chunk, 0
+            continue
+        yield item
+        position = end
+
+
+def read_csv(file, fieldnames=('name', 'measurement_unit')):
+    """Строки CSV как словари; строка заголовка необязательна."""
+    reader = csv.reader(file)
+    for row in reader:
+        if reader.line_num == 1 and tuple(row) == tuple(fieldnames):
+            continue
+        yield dict(zip(fieldnames, row))
+
+
+READERS = {
+    '.json': read_json,
+    '.jsonl': read_json,
+    '.csv': read_csv,
+}
+
+
+def read_rows(path):
+    reader = READERS.get(Path(path).suffix.lower())
+    if reader is None:
+        raise ValueError(
+            f'Неизвестный формат файла {path}; поддерживаются '
+            + ', '.join(READERS))
+    with open(path, encoding='utf-8', newline='') as file:
+        yield from reader(file)
+
+
+@dataclass
+class ImportStats:
+    rows: int = 0
+    inserted: int = 0
+    updated: int = 0
+    skipped: int = 0
+    invalid: int = 0
+    elapsed: float = 0
+    # Номера и ошибки первых MAX_ERRORS неверных строк
+    errors: list = field(default_factory=list)
+
+    def add_error(self, number, error):
+        self.invalid += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((number, error))
+
+    @property
+    def rate(self):
+        return self.rows / self.elapsed if self.elapsed else 0
+
+
+class UpsertImporter:
+    """Вставляет новые строки и обновляет изменившиеся.
+
+    Строка определяется значениями key_fields (уникальное ограничение
+    модели), update_fields обновляются у уже существующих строк.
+    Строки, которые не прошли проверку полей модели, считаются в invalid,
+    а уже загруженные без изменений и повторы — в skipped.
+    """
+
+    def __init__(self, model, key_fields, update_fields=(), batch_size=1000,
+                 progress=None, progress_every=100000):
+        self.model = model
+        self.key_fields = tuple(key_fields)
+        self.update_fields = tuple(update_fields)
+        self.batch_size = batch_size
+        self.progress = progress
+        self.progress_every = progress_every
+
+    def clean(self, number, row, stats):
+        """Экземпляр модели из строки или None, если строка неверна."""
+        if not isinstance(row, dict):
+            stats.add_error(number, 'ожидался объект с полями')
+            return None
+        values = {}
+        for name in self.key_fields + self.update_fields:
+            value = row.get(name)
+            values[name] = value.strip() if isinstance(value, str) else value
+        instance = self.model(**values)
+        try:
+            instance.clean_fields(exclude=[
+                field.name for field in self.model._meta.fields
+                if field.name not in values])
+        except ValidationError as error:
+            stats.add_error(number, error.message_dict)
+            return None
+        return instance
+
+    def get_key(self, instance):
+        return tuple(getattr(instance, name) for name in self.key_fields)
+
+    def get_existing(self, keys):
+        """Уже загруженные строки пачки.
+
+        Выборка по первому полю ключа идёт по индексу ограничения, а
+        лишние строки отбрасываются здесь: условие OR по каждому ключу
+        упирается в ограничения СУБД на глубину выражения.
+        """
+        first = self.key_fields[0]
+        existing = self.model.objects.filter(
+            **{f'{first}__in': {key[0] for key in keys}})
+        keys = set(keys)
+        return {key: instance for instance in existing
+                if (key := self.get_key(instance)) in keys}
+
+    @transaction.atomic
+    def write_batch(self, batch, stats):
+        existing = self.get_existing(list(batch))
+        to_create, to_update = [], []
+        for key, instance in batch.items():
+            current = existing.get(key)
+            if current is None:
+                to_create.append(instance)
+                continue
+            changed = [name for name in self.update_fields
+                       if getattr(current, name) != getattr(instance, name)]
+            if changed:
+                for name in changed:
+                    setattr(current, name, getattr(instance, name))
+                to_update.append(current)
+            else:
+                stats.skipped += 1
+        inserted = self.insert(to_create)
+        if to_update:
+            self.model.objects.bulk_update(to_update, self.update_fields)
+        stats.inserted += inserted
+        stats.skipped += len(to_create) - inserted
+        stats.updated += len(to_update)
+
+    def has_unique_key(self):
+        meta = self.model._meta
+        if len(self.key_fields) == 1 and meta.get_field(
+                self.key_fields[0]).unique:
+            return True
+        return any(set(constraint.fields) == set(self.key_fields)
+                   for constraint in meta.total_unique_constraints)
+
+    def insert(self, instances):
+        """Вставляет строки, которых не было при проверке, и возвращает
+        число записанных.
+
+        Ту же строку могла успеть вставить параллельная загрузка. Если
+        есть что обновлять, а key_fields — уникальное ограничение, она
+        получает значения из этой загрузки. Иначе конфликтующие строки
+        пропускаются, а записанными считаются строки пачки, которые
+        после вставки есть в базе: INSERT OR IGNORE в SQLite молча
+        пропускает и строки, нарушившие NOT NULL или CHECK.
+        """
+        if not instances:
+            return 0
+        if self.update_fields and self.has_unique_key():
+            self.model.objects.bulk_create(
+                instances, update_conflicts=True,
+                unique_fields=self.key_fields,
+                update_fields=self.update_fields)
+            return len(instances)
+        self.model.objects.bulk_create(instances, ignore_conflicts=True)
+        return len(self.get_existing(
+            [self.get_key(instance) for instance in instances]))
+
+    def run(self, rows):
+        stats = ImportStats()
+        start = time.perf_counter()
+        rows = enumerate(rows, start=1)
+        while True:
+            chunk = list(islice(rows, self.batch_size))
+            if not chunk:
+                break
+            batch = {}
+            for number, row in chunk:
+                instance = self.clean(number, row, stats)
+                if instance is None:
+                    continue
+                if self.get_key(instance) in batch:
+                    stats.skipped += 1
+                else:
+                    batch[self.get_key(instance)] = instance
+            if batch:
+                self.write_batch(batch, stats)
+            previous, stats.rows = stats.rows, stats.rows + len(chunk)
+            stats.elapsed = time.perf_counter() - start
+            if (self.progress
+                    and previous // self.progress_every
+                    != stats.rows // self.progress_every):
+                self.progress(stats)
+        stats.elapsed = time.perf_counter() - start
+        return stats
+
+
+def import_ingredients(rows, **kwargs):
+    """Загружает ингредиенты; ключ — ограничение
+    unique_ingredient_measurement_unit."""
+    return UpsertImporter(
+        Ingredient, key_fields=('name', 'measurement_unit'),
+        **kwargs).run(rows)
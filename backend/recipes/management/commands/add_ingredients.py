@@ -1,17 +1,48 @@
-import json
-from recipes.models import Ingredient
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
+
+from api.indexes import ingredient_index
+from recipes.importers import (default_ingredients_path, import_ingredients,
+                               read_rows)
+
 
 class Command(BaseCommand):
-    help = 'Заполняет базу данных ингредиентами'
+    help = ('Загружает ингредиенты из JSON или CSV: новые добавляются, '
+            'уже загруженные пропускаются. Ключ — название и единица, то '
+            'есть все поля ингредиента, поэтому обновлять нечего')
 
-    def handle(self, *args, **kwargs):
-        filepath = '././ingredients.json'
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', nargs='?',
+            help='Файл .json, .jsonl или .csv, по умолчанию '
+                 'data/ingredients.json')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Строк в одной пачке записи')
 
+    def handle(self, *args, **options):
+        path = options['path']
+        if path is None:
+            try:
+                path = default_ingredients_path()
+            except FileNotFoundError as error:
+                raise CommandError(str(error))
         try:
-            with open(filepath, encoding='utf-8') as f:
-                created_objects = Ingredient.objects.bulk_create(
-                    [Ingredient(**item) for item in json.load(f)], ignore_conflicts=True)
-                self.stdout.write(f'Количество добавленных ингредиентов - {len(created_objects)}')
-        except Exception as e:
-            self.stderr.write(f'Ошибка при обработке файла {filepath}: {e}')
+            stats = import_ingredients(
+                read_rows(path), batch_size=options['batch_size'],
+                progress=self.report_progress)
+        except (OSError, ValueError) as error:
+            raise CommandError(f'Ошибка при обработке файла {path}: {error}')
+        finally:
+            # bulk_create не отправляет сигналы, сбрасываем индекс явно
+            ingredient_index.invalidate()
+        self.stdout.write(
+            f'Строк: {stats.rows}, добавлено: {stats.inserted}, '
+            f'пропущено: {stats.skipped}, '
+            f'с ошибками: {stats.invalid} '
+            f'({stats.elapsed:.1f} с, {stats.rate:.0f} строк/с)')
+        for number, error in stats.errors:
+            self.stderr.write(f'Строка {number}: {error}')
+
+    def report_progress(self, stats):
+        self.stdout.write(
+            f'Обработано строк: {stats.rows} ({stats.rate:.0f} строк/с)')
@@ -0,0 +1,87 @@
+import posixpath
+from datetime import timedelta
+
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from api.cache import recipe_cache
+from recipes.images import is_referenced, make_variants, release_image
+from recipes.models import Recipe
+from recipes.storage import is_content_name, media_storage
+
+User = get_user_model()
+
+# (модель, поле с изображением)
+IMAGE_FIELDS = ((Recipe, 'image'), (User, 'avatar'))
+
+
+class Command(BaseCommand):
+    help = ('Удаляет изображения, на которые не ссылается ни одна запись, '
+            'и переносит старые файлы в хранилище по хэшу содержимого')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--grace', type=float, default=24,
+            help='Не трогать файлы моложе стольких часов: фоновая '
+                 'обработка может ещё не привязать их к записи')
+        parser.add_argument(
+            '--rehash', action='store_true',
+            help='Переименовать файлы со старыми именами по хэшу '
+                 'содержимого, объединив одинаковые')
+        parser.add_argument('--dry-run', action='store_true')
+
+    def handle(self, *args, **options):
+        if options['rehash']:
+            self.rehash(options['dry_run'])
+        deadline = timezone.now() - timedelta(hours=options['grace'])
+        removed = 0
+        for directory in self.get_directories():
+            removed += self.cleanup(directory, deadline, options['dry_run'])
+        self.stdout.write(f'Удалено изображений: {removed}')
+
+    def get_directories(self):
+        return sorted({model._meta.get_field(field_name).upload_to
+                       for model, field_name in IMAGE_FIELDS})
+
+    def rehash(self, dry_run):
+        moved = 0
+        for model, field_name in IMAGE_FIELDS:
+            names = (model.objects.exclude(**{field_name: ''})
+                     .exclude(**{field_name: None})
+                     .values_list(field_name, flat=True).distinct())
+            for name in names:
+                if is_content_name(name) or not media_storage.exists(name):
+                    continue
+                moved += 1
+                if dry_run:
+                    continue
+                with media_storage.open(name) as file:
+                    new_name = media_storage.save(name, file)
+                make_variants(new_name)
+                with transaction.atomic():
+                    for other_model, other_field in IMAGE_FIELDS:
+                        other_model.objects.filter(
+                            **{other_field: name}).update(
+                                **{other_field: new_name})
+                release_image(name, media_storage)
+        if moved and not dry_run:
+            # update() не отправляет сигналы
+            recipe_cache.invalidate_all()
+        self.stdout.write(f'Перенесено по хэшу: {moved}')
+
+    def cleanup(self, directory, deadline, dry_run):
+        if not media_storage.exists(directory):
+            return 0
+        _, files = media_storage.listdir(directory)
+        removed = 0
+        for filename in files:
+            name = posixpath.join(directory, filename)
+            if (media_storage.get_modified_time(name) > deadline
+                    or is_referenced(name)):
+                continue
+            removed += 1
+            if not dry_run:
+                release_image(name, media_storage)
+        return removed
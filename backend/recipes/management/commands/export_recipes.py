@@ -0,0 +1,21 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from recipes.dump import export_dump
+
+
+class Command(BaseCommand):
+    help = ('Выгружает рецепты, пользователей, ингредиенты, избранное, '
+            'списки покупок и подписки в дамп NDJSON вместе с картинками')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'path', help='Файл дампа; .gz в конце включает сжатие')
+
+    def handle(self, *args, **options):
+        start = time.perf_counter()
+        counts = export_dump(options['path'])
+        self.stdout.write(
+            ', '.join(f'{name}: {count}' for name, count in counts.items())
+            + f' ({time.perf_counter() - start:.1f} с)')
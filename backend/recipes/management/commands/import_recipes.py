@@ -0,0 +1,68 @@
+import os
+import time
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+
+from api.cache import recipe_cache
+from api.indexes import ingredient_index, pantry_index
+from recipes.counters import reconcile_counters
+from recipes.dump import DumpImporter, open_dump
+
+
+class Command(BaseCommand):
+    help = ('Загружает дамп export_recipes пачками. Прерванная загрузка '
+            'продолжается с последней контрольной точки')
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='Файл дампа')
+        parser.add_argument(
+            '--batch-size', type=int, default=1000,
+            help='Записей в одной пачке и транзакции')
+        parser.add_argument(
+            '--checkpoint',
+            help='Файл контрольной точки, по умолчанию <дамп>.checkpoint')
+        parser.add_argument(
+            '--restart', action='store_true',
+            help='Начать заново, не используя контрольную точку')
+        parser.add_argument(
+            '--skip-variants', action='store_true',
+            help='Не создавать уменьшенные копии картинок после загрузки')
+
+    def handle(self, *args, **options):
+        checkpoint = (options['checkpoint']
+                      or f'{options["path"]}.checkpoint')
+        if options['restart'] and os.path.exists(checkpoint):
+            os.remove(checkpoint)
+        elif os.path.exists(checkpoint):
+            self.stdout.write(f'Продолжение с контрольной точки {checkpoint}')
+        importer = DumpImporter(
+            checkpoint, batch_size=options['batch_size'],
+            progress=self.report_progress)
+        self.reported = 0
+        start = time.perf_counter()
+        try:
+            with open_dump(options['path']) as file:
+                stats = importer.run(file)
+        except (OSError, ValueError) as error:
+            raise CommandError(
+                f'Ошибка при загрузке {options["path"]}: {error}. '
+                'Повторный запуск продолжит с последней контрольной точки')
+        finally:
+            # bulk_create не отправляет сигналы
+            reconcile_counters()
+            ingredient_index.invalidate()
+            pantry_index.invalidate()
+            recipe_cache.invalidate_all()
+        self.stdout.write(
+            ', '.join(f'{name}: {count}'
+                      for name, count in sorted(stats.items()))
+            + f' ({time.perf_counter() - start:.1f} с)')
+        if not options['skip_variants'] and stats['image']:
+            call_command('make_image_variants', stdout=self.stdout,
+                         stderr=self.stderr)
+
+    def report_progress(self, line, stats):
+        if line - self.reported >= 100000:
+            self.stdout.write(f'Загружено строк дампа: {line}')
+            self.reported = line
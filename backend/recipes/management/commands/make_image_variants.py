@@ -0,0 +1,56 @@
+import os
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+import django
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from PIL import Image, UnidentifiedImageError
+
+from recipes.images import make_variants
+from recipes.models import Recipe
+
+User = get_user_model()
+
+
+def process(name, force):
+    try:
+        return 'created' if make_variants(name, force=force) else 'skipped'
+    except (OSError, UnidentifiedImageError, Image.DecompressionBombError):
+        return 'failed'
+
+
+class Command(BaseCommand):
+    help = ('Создаёт уменьшенные копии JPEG и WebP для уже загруженных '
+            'изображений рецептов и аватаров')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--workers', type=int, default=os.cpu_count(),
+            help='Число процессов')
+        parser.add_argument(
+            '--force', action='store_true',
+            help='Пересоздать уже существующие копии')
+
+    def handle(self, *args, **options):
+        names = sorted(
+            set(Recipe.objects.exclude(image='').exclude(image=None)
+                .values_list('image', flat=True))
+            | set(User.objects.exclude(avatar='').exclude(avatar=None)
+                  .values_list('avatar', flat=True)))
+        self.stdout.write(f'Изображений: {len(names)}')
+        results = Counter()
+        # Воркеры работают только с файлами; django.setup() нужен
+        # там, где процессы запускаются через spawn, а не fork
+        with ProcessPoolExecutor(options['workers'],
+                                 initializer=django.setup) as executor:
+            for name, result in zip(names, executor.map(
+                    process, names, [options['force']] * len(names),
+                    chunksize=16)):
+                results[result] += 1
+                if result == 'failed':
+                    self.stderr.write(f'Не удалось обработать {name}')
+        self.stdout.write(
+            f'Создано: {results["created"]}, '
+            f'уже были: {results["skipped"]}, '
+            f'с ошибками: {results["failed"]}')
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+from recipes.models import Recipe
+from recipes.search import create_search_index
+
+
+class Command(BaseCommand):
+    help = ('Пересоздаёт индексы полнотекстового поиска рецептов, '
+            'например после миграции, пересобравшей таблицу в SQLite')
+
+    def handle(self, *args, **kwargs):
+        with connection.schema_editor() as schema_editor:
+            create_search_index(schema_editor, Recipe)
+        self.stdout.write(f'Индекс поиска пересоздан ({connection.vendor})')
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.counters import reconcile_counters
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает счётчики избранного, рецептов и подписок'
+
+    def handle(self, *args, **kwargs):
+        with transaction.atomic():
+            drifted = reconcile_counters()
+        for counter, count in drifted.items():
+            self.stdout.write(f'{counter}: исправлено строк - {count}')
@@ -0,0 +1,24 @@
+# Generated by Django 5.2.1 on 2026-10-18 05:54
+
+import recipes.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0003_counters'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='recipe',
+            name='image',
+            field=models.ImageField(null=True, storage=recipes.storage.get_media_storage, upload_to='recipes/images/', verbose_name='Изображение'),
+        ),
+        migrations.AlterField(
+            model_name='recipeuser',
+            name='avatar',
+            field=models.ImageField(null=True, storage=recipes.storage.get_media_storage, upload_to='media/users/', verbose_name='Аватар'),
+        ),
+    ]
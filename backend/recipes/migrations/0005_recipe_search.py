@@ -0,0 +1,22 @@
+from django.db import migrations
+
+from recipes.search import create_search_index, drop_search_index
+
+
+def create_index(apps, schema_editor):
+    create_search_index(schema_editor, apps.get_model('recipes', 'Recipe'))
+
+
+def drop_index(apps, schema_editor):
+    drop_search_index(schema_editor, apps.get_model('recipes', 'Recipe'))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0004_content_addressed_media'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,28 @@
+# Generated by Django 5.2.1 on 2026-10-18 06:51
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0005_recipe_search'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ImportedRecipe',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.CharField(max_length=64, verbose_name='Источник дампа')),
+                ('source_id', models.PositiveBigIntegerField(verbose_name='id в исходной базе')),
+                ('recipe', models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.DO_NOTHING, related_name='+', to='recipes.recipe', verbose_name='Рецепт')),
+            ],
+            options={
+                'verbose_name': 'загруженный рецепт',
+                'verbose_name_plural': 'Загруженные рецепты',
+                'constraints': [models.UniqueConstraint(fields=('source', 'source_id'), name='unique_imported_recipe_source')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2.1 on 2026-10-18 07:11
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('auth', '0012_alter_user_first_name_max_length'),
+        ('recipes', '0006_imported_recipe'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['image'], name='recipe_image_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='recipeuser',
+            index=models.Index(fields=['avatar'], name='user_avatar_idx'),
+        ),
+    ]
@@ -1,12 +1,39 @@
-from django.db import models
+from django.db import connections, models, router
 from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.core.validators import RegexValidator, MinValueValidator
 
+from .storage import get_media_storage
 
-class RecipeUser(AbstractUser):
+
+class CountersModel(models.Model):
+    """Модель со счётчиками, которые меняются только атомарным UPDATE.
+
+    Полное сохранение уже существующей строки (без update_fields) не
+    записывает счётчики: в загруженном раньше экземпляре они могли
+    устареть и затёрли бы изменения, сделанные с тех пор.
+    """
+
+    counter_fields = ()
+
+    class Meta:
+        abstract = True
+
+    def save(self, *args, **kwargs):
+        if (not self._state.adding and not args
+                and kwargs.get('update_fields') is None
+                and not kwargs.get('force_insert')):
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key
+                and field.name not in self.counter_fields]
+        super().save(*args, **kwargs)
+
+
+class RecipeUser(CountersModel, AbstractUser):
     avatar = models.ImageField(
         upload_to='media/users/',
+        storage=get_media_storage,
         null=True,
         verbose_name='Аватар'
     )
@@ -24,6 +51,16 @@ class RecipeUser(AbstractUser):
                                   verbose_name='Имя пользователя')
     last_name = models.CharField(max_length=150,
                                  verbose_name='Фамилия пользователя')
+    # Счётчики поддерживаются сигналами из recipes/signals.py,
+    # расхождения исправляет команда recount_counters
+    recipes_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name='Рецептов')
+    followers_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name='Подписок')
+    followings_count = models.PositiveIntegerField(
+        default=0, editable=False, verbose_name='Подписчиков')
+
+    counter_fields = ('recipes_count', 'followers_count', 'followings_count')
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
@@ -32,6 +69,8 @@ class RecipeUser(AbstractUser):
         verbose_name = 'пользователь'
         verbose_name_plural = 'Пользователи'
         ordering = ('username',)
+        # По файлу ищутся ссылки перед удалением изображения
+        indexes = [models.Index(fields=['avatar'], name='user_avatar_idx')]
 
     def __str__(self):
         return f'{self.username} ({self.first_name} {self.last_name})'
@@ -56,7 +95,35 @@ class Ingredient(models.Model):
         return self.name
 
 
-class Recipe(models.Model):
+class RecipeQuerySet(models.QuerySet):
+
+    def with_related(self):
+        return self.select_related('author').prefetch_related(
+            models.Prefetch(
+                'ingredients_in_recipes',
+                queryset=RecipeIngredient.objects.select_related('ingredient')
+            )
+        )
+
+    def with_user_flags(self, user):
+        """Флаги избранного, корзины и подписки на автора для зрителя."""
+        if not user.is_authenticated:
+            return self.annotate(
+                is_favorited=models.Value(False),
+                is_in_shopping_cart=models.Value(False),
+                is_author_subscribed=models.Value(False),
+            )
+        return self.annotate(
+            is_favorited=models.Exists(Favorite.objects.filter(
+                user=user, recipe=models.OuterRef('pk'))),
+            is_in_shopping_cart=models.Exists(ShoppingList.objects.filter(
+                user=user, recipe=models.OuterRef('pk'))),
+            is_author_subscribed=models.Exists(Follow.objects.filter(
+                user=user, following=models.OuterRef('author'))),
+        )
+
+
+class Recipe(CountersModel):
     author = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name='recipes',
         verbose_name='Автор рецепта'
@@ -65,6 +132,7 @@ class Recipe(models.Model):
     text = models.CharField(verbose_name='Описание действий')
     image = models.ImageField(
         upload_to='recipes/images/',
+        storage=get_media_storage,
         null=True,
         verbose_name='Изображение'
     )
@@ -77,10 +145,20 @@ class Recipe(models.Model):
     cooking_time = models.PositiveIntegerField(
         validators=[MinValueValidator(1)],
         verbose_name='Время приготовления')
+    favorites_count = models.PositiveIntegerField(
+        default=0, editable=False, db_index=True,
+        verbose_name='В избранном')
+
+    counter_fields = ('favorites_count',)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         verbose_name = 'рецепт'
         verbose_name_plural = 'Рецепты'
+        # Индекс, а не db_index: AlterField в SQLite пересобрал бы
+        # таблицу вместе с триггерами поиска
+        indexes = [models.Index(fields=['image'], name='recipe_image_idx')]
 
     def __str__(self):
         return self.name
@@ -151,6 +229,42 @@ class Follow(models.Model):
         ]
 
 
+class UserRecipeQuerySet(models.QuerySet):
+    """Пакетное добавление и удаление рецептов пользователя.
+
+    Запросы INSERT ... ON CONFLICT DO NOTHING и DELETE с RETURNING
+    возвращают только строки, которые изменил именно этот запрос, даже
+    если параллельный запрос успел добавить или удалить те же рецепты.
+    Сигналы не отправляются: счётчики и кэш обновляет вызывающий код.
+    """
+
+    def execute_returning(self, sql, params):
+        connection = connections[router.db_for_write(self.model)]
+        with connection.cursor() as cursor:
+            cursor.execute(sql.format(
+                table=connection.ops.quote_name(self.model._meta.db_table)),
+                params)
+            return {recipe_id for recipe_id, in cursor.fetchall()}
+
+    def add_recipes(self, user, recipe_ids):
+        """Добавляет рецепты, возвращает id действительно добавленных."""
+        if not recipe_ids:
+            return set()
+        values = ', '.join(['(%s, %s)'] * len(recipe_ids))
+        return self.execute_returning(
+            f'INSERT INTO {{table}} (user_id, recipe_id) VALUES {values} '
+            'ON CONFLICT DO NOTHING RETURNING recipe_id',
+            [param for pk in recipe_ids for param in (user.pk, pk)])
+
+    def remove_recipes(self, user, recipe_ids):
+        """Удаляет рецепты, возвращает id действительно удалённых."""
+        placeholders = ', '.join(['%s'] * len(recipe_ids))
+        return self.execute_returning(
+            f'DELETE FROM {{table}} WHERE user_id = %s '
+            f'AND recipe_id IN ({placeholders}) RETURNING recipe_id',
+            [user.pk, *recipe_ids])
+
+
 class Favorite(models.Model):
     user = models.ForeignKey(
         settings.AUTH_USER_MODEL, on_delete=models.CASCADE,
@@ -162,6 +276,8 @@ class Favorite(models.Model):
         verbose_name='Рецепт'
     )
 
+    objects = UserRecipeQuerySet.as_manager()
+
     def __str__(self):
         return f'Рецепт {self.recipe} в избранном пользователя {self.user}'
 
@@ -190,6 +306,8 @@ class ShoppingList(models.Model):
         verbose_name='Рецепты в списке',
     )
 
+    objects = UserRecipeQuerySet.as_manager()
+
     def __str__(self):
         return f'Рецепт {self.recipe} в списке покупок пользователя {self.user}'
 
@@ -201,3 +319,31 @@ class ShoppingList(models.Model):
                 fields=['user', 'recipe'],
                 name='unique_shopping_list_user_recipe')
         ]
+
+
+class ImportedRecipe(models.Model):
+    """Рецепт, загруженный из дампа: id в исходной базе -> рецепт.
+
+    Пишется в той же транзакции, что и сам рецепт, поэтому повторная
+    загрузка того же дампа пропускает уже загруженные рецепты. Удаление
+    рецепта строку не трогает (лишний запрос на каждое удаление), её
+    перезапишет следующая загрузка.
+    """
+    source = models.CharField(max_length=64, verbose_name='Источник дампа')
+    source_id = models.PositiveBigIntegerField(
+        verbose_name='id в исходной базе')
+    recipe = models.ForeignKey(
+        Recipe, on_delete=models.DO_NOTHING, db_constraint=False,
+        related_name='+', verbose_name='Рецепт')
+
+    class Meta:
+        verbose_name = 'загруженный рецепт'
+        verbose_name_plural = 'Загруженные рецепты'
+        constraints = [
+            models.UniqueConstraint(
+                fields=['source', 'source_id'],
+                name='unique_imported_recipe_source')
+        ]
+
+    def __str__(self):
+        return f'{self.source}:{self.source_id} -> {self.recipe_id}'
@@ -0,0 +1,214 @@
+"""Полнотекстовый поиск рецептов по названию и описанию.
+
+Бэкенд выбирается по СУБД базы, из которой читает queryset:
+
+- PostgreSQL: полнотекстовый поиск с русской морфологией по
+  GIN-индексу выражения search_vector() и триграммы по названию, чтобы
+  находить рецепты и с опечатками. Результаты упорядочены по рангу,
+  совпадения только по триграммам идут последними;
+- SQLite: таблица FTS5 recipes_recipe_fts, которую поддерживают
+  триггеры; сначала рецепты, где запрос найден в названии;
+- остальные СУБД (и SQLite без FTS5 или без её триггеров): icontains
+  по названию и описанию.
+
+Индексы, таблицу и триггеры создаёт миграция 0005_recipe_search
+функцией create_search_index.
+"""
+import re
+
+from asgiref.sync import sync_to_async
+from django.db import connections
+from django.db.models import BooleanField, ExpressionWrapper, F, Q, Value
+from django.db.models.expressions import RawSQL
+
+SEARCH_CONFIG = 'russian'
+SEARCH_INDEX = 'recipes_recipe_search_idx'
+TRIGRAM_INDEX = 'recipes_recipe_name_trgm_idx'
+FTS_TABLE = 'recipes_recipe_fts'
+FTS_TRIGGERS = tuple(
+    f'{FTS_TABLE}_{event}' for event in ('insert', 'delete', 'update'))
+
+WORD_RE = re.compile(r'\w+')
+
+
+def search_vector():
+    """Документ рецепта для PostgreSQL.
+
+    Запрос и индекс строятся из одного выражения, иначе планировщик не
+    узнает индекс.
+    """
+    from django.contrib.postgres.search import SearchVector
+    return (SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('text', weight='B', config=SEARCH_CONFIG))
+
+
+class PostgresSearch:
+
+    def search(self, queryset, query):
+        from django.contrib.postgres.lookups import TrigramWordSimilar
+        from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                                    TrigramWordSimilarity)
+        search_query = SearchQuery(
+            query, config=SEARCH_CONFIG, search_type='websearch')
+        return queryset.alias(
+            search_document=search_vector(),
+        ).filter(
+            Q(search_document=search_query)
+            # word_similarity(запрос, name) выше порога pg_trgm
+            | Q(TrigramWordSimilar(Value(query), F('name')))
+        ).annotate(
+            search_rank=SearchRank(F('search_document'), search_query),
+            name_similarity=TrigramWordSimilarity(query, 'name'),
+        ).order_by('-search_rank', '-name_similarity', '-id')
+
+
+class SQLiteSearch:
+
+    def get_match(self, query):
+        """Выражение MATCH: все слова запроса как префиксы.
+
+        Слова берутся в кавычки, поэтому операторы FTS5 в запросе
+        пользователя не действуют.
+        """
+        return ' AND '.join(
+            f'"{word}"*' for word in WORD_RE.findall(query))
+
+    def search(self, queryset, query):
+        match = self.get_match(query)
+        if not match:
+            return queryset.none()
+        sql = f'SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s'
+        # Подзапросы не зависят от строки и выполняются один раз
+        return queryset.filter(
+            id__in=RawSQL(sql, [match]),
+        ).annotate(
+            search_rank=ExpressionWrapper(
+                Q(id__in=RawSQL(sql, [f'name : ({match})'])),
+                output_field=BooleanField()),
+        ).order_by('-search_rank', '-id')
+
+
+class BasicSearch:
+
+    def search(self, queryset, query):
+        words = WORD_RE.findall(query)
+        if not words:
+            return queryset.none()
+        condition = Q()
+        in_name = Q()
+        for word in words:
+            condition &= Q(name__icontains=word) | Q(text__icontains=word)
+            in_name &= Q(name__icontains=word)
+        return queryset.filter(condition).annotate(
+            search_rank=ExpressionWrapper(
+                in_name, output_field=BooleanField()),
+        ).order_by('-search_rank', '-id')
+
+
+# Есть ли таблица FTS5 с триггерами в базе с данным alias
+_fts_available = {}
+
+
+def has_fts_index(alias):
+    """Таблица FTS5 есть и её поддерживают все триггеры.
+
+    Пересборка таблицы рецептов при миграциях SQLite удаляет триггеры,
+    и без них индекс перестаёт видеть новые и изменённые рецепты.
+    """
+    if alias not in _fts_available:
+        names = (FTS_TABLE, *FTS_TRIGGERS)
+        placeholders = ', '.join(['%s'] * len(names))
+        with connections[alias].cursor() as cursor:
+            cursor.execute(
+                'SELECT COUNT(*) FROM sqlite_master '
+                f'WHERE name IN ({placeholders})', names)
+            _fts_available[alias] = cursor.fetchone()[0] == len(names)
+    return _fts_available[alias]
+
+
+async def acheck_search_index(alias):
+    """Проверяет индекс SQLite из асинхронного кода, в потоке.
+
+    has_fts_index() при первом вызове обращается к базе, а в цикле
+    событий это запрещено; дальше ответ берётся из _fts_available.
+    """
+    if connections[alias].vendor == 'sqlite' and alias not in _fts_available:
+        await sync_to_async(has_fts_index)(alias)
+
+
+def get_search_backend(alias):
+    vendor = connections[alias].vendor
+    if vendor == 'postgresql':
+        return PostgresSearch()
+    if vendor == 'sqlite' and has_fts_index(alias):
+        return SQLiteSearch()
+    return BasicSearch()
+
+
+def search_recipes(queryset, query):
+    """Рецепты queryset, подходящие под запрос, лучшие первыми."""
+    return get_search_backend(queryset.db).search(queryset, query)
+
+
+def create_search_index(schema_editor, model):
+    """Создаёт индексы поиска для СУБД schema_editor.
+
+    Повторный вызов безопасен; для SQLite он заново заполняет FTS5 и
+    пересоздаёт триггеры (их удаляет пересборка таблицы при миграциях).
+    """
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        from django.contrib.postgres.indexes import GinIndex
+        schema_editor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        schema_editor.execute(f'DROP INDEX IF EXISTS {SEARCH_INDEX}')
+        schema_editor.execute(f'DROP INDEX IF EXISTS {TRIGRAM_INDEX}')
+        schema_editor.add_index(model, GinIndex(
+            search_vector(), name=SEARCH_INDEX))
+        schema_editor.add_index(model, GinIndex(
+            fields=['name'], opclasses=['gin_trgm_ops'],
+            name=TRIGRAM_INDEX))
+    elif vendor == 'sqlite':
+        table = model._meta.db_table
+        with schema_editor.connection.cursor() as cursor:
+            cursor.execute(
+                "SELECT 1 FROM pragma_compile_options "
+                "WHERE compile_options = 'ENABLE_FTS5'")
+            if cursor.fetchone() is None:
+                return
+        drop_search_index(schema_editor, model)
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {FTS_TABLE} USING fts5('
+            f"name, text, content='{table}', content_rowid='id', "
+            "tokenize='unicode61 remove_diacritics 2')")
+        # Счётчики меняют строку рецепта часто, а документ — только
+        # название и описание
+        schema_editor.execute(
+            f'CREATE TRIGGER {FTS_TABLE}_insert AFTER INSERT ON {table} '
+            f'BEGIN INSERT INTO {FTS_TABLE}(rowid, name, text) '
+            'VALUES (new.id, new.name, new.text); END')
+        schema_editor.execute(
+            f'CREATE TRIGGER {FTS_TABLE}_delete AFTER DELETE ON {table} '
+            f'BEGIN INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, text) '
+            "VALUES ('delete', old.id, old.name, old.text); END")
+        schema_editor.execute(
+            f'CREATE TRIGGER {FTS_TABLE}_update '
+            f'AFTER UPDATE OF name, text ON {table} '
+            f'BEGIN INSERT INTO {FTS_TABLE}({FTS_TABLE}, rowid, name, text) '
+            "VALUES ('delete', old.id, old.name, old.text); "
+            f'INSERT INTO {FTS_TABLE}(rowid, name, text) '
+            'VALUES (new.id, new.name, new.text); END')
+        schema_editor.execute(
+            f"INSERT INTO {FTS_TABLE}({FTS_TABLE}) VALUES ('rebuild')")
+    _fts_available.pop(schema_editor.connection.alias, None)
+
+
+def drop_search_index(schema_editor, model):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(f'DROP INDEX IF EXISTS {SEARCH_INDEX}')
+        schema_editor.execute(f'DROP INDEX IF EXISTS {TRIGRAM_INDEX}')
+    elif vendor == 'sqlite':
+        for trigger in FTS_TRIGGERS:
+            schema_editor.execute(f'DROP TRIGGER IF EXISTS {trigger}')
+        schema_editor.execute(f'DROP TABLE IF EXISTS {FTS_TABLE}')
+    _fts_available.pop(schema_editor.connection.alias, None)
@@ -0,0 +1,81 @@
+from functools import partial
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import F
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .images import release_image
+from .models import Favorite, Follow, Recipe
+from .tasks import schedule_variants
+
+User = get_user_model()
+
+
+def change_counter(model, pk, field, delta):
+    """Атомарно меняет счётчик в базе, не опускаясь ниже нуля."""
+    model.objects.filter(pk=pk).update(
+        **{field: Greatest(F(field) + delta, 0)})
+
+
+@receiver(post_save, sender=Favorite)
+def favorite_created(instance, created, **kwargs):
+    if created:
+        change_counter(Recipe, instance.recipe_id, 'favorites_count', 1)
+
+
+@receiver(post_delete, sender=Favorite)
+def favorite_deleted(instance, **kwargs):
+    change_counter(Recipe, instance.recipe_id, 'favorites_count', -1)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_created(instance, created, **kwargs):
+    if created:
+        change_counter(User, instance.author_id, 'recipes_count', 1)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_deleted(instance, **kwargs):
+    change_counter(User, instance.author_id, 'recipes_count', -1)
+
+
+@receiver(post_save, sender=Follow)
+def follow_created(instance, created, **kwargs):
+    if created:
+        change_counter(User, instance.user_id, 'followers_count', 1)
+        change_counter(User, instance.following_id, 'followings_count', 1)
+
+
+@receiver(post_delete, sender=Follow)
+def follow_deleted(instance, **kwargs):
+    change_counter(User, instance.user_id, 'followers_count', -1)
+    change_counter(User, instance.following_id, 'followings_count', -1)
+
+
+@receiver(post_save, sender=Recipe)
+def recipe_image_saved(instance, update_fields=None, **kwargs):
+    if not update_fields or 'image' in update_fields:
+        schedule_variants(instance.image)
+
+
+@receiver(post_save, sender=User)
+def avatar_saved(instance, update_fields=None, **kwargs):
+    if not update_fields or 'avatar' in update_fields:
+        schedule_variants(instance.avatar)
+
+
+@receiver(post_delete, sender=Recipe)
+def recipe_image_released(instance, **kwargs):
+    if instance.image:
+        transaction.on_commit(partial(
+            release_image, instance.image.name, instance.image.storage))
+
+
+@receiver(post_delete, sender=User)
+def avatar_released(instance, **kwargs):
+    if instance.avatar:
+        transaction.on_commit(partial(
+            release_image, instance.avatar.name, instance.avatar.storage))
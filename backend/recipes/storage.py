@@ -0,0 +1,65 @@
+import hashlib
+import posixpath
+import re
+
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.core.files.utils import validate_file_name
+
+CONTENT_NAME = re.compile(r'^[0-9a-f]{64}$')
+
+
+def content_name(name, digest):
+    """Имя файла по хэшу содержимого в той же папке и с тем же расширением."""
+    directory, filename = posixpath.split(name)
+    extension = posixpath.splitext(filename)[1].lower()
+    return posixpath.join(directory, f'{digest}{extension}')
+
+
+def is_content_name(name):
+    stem = posixpath.splitext(posixpath.basename(name))[0]
+    return bool(CONTENT_NAME.match(stem))
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    """Хранит файлы под именем sha256 их содержимого.
+
+    Одинаковые файлы записываются один раз: повторная загрузка
+    возвращает уже существующее имя. Содержимое файла по имени никогда
+    не меняется, поэтому его можно кэшировать навсегда. Удалять файл
+    можно только когда на него не ссылается ни одна запись
+    (см. recipes.images.release_image).
+    """
+
+    def __init__(self, **kwargs):
+        # Два параллельных сохранения одного содержимого пишут одно и то
+        # же, поэтому перезапись безопасна и не плодит суффиксы
+        kwargs.setdefault('allow_overwrite', True)
+        super().__init__(**kwargs)
+
+    def save(self, name, content, max_length=None):
+        if name is None:
+            name = content.name
+        if not hasattr(content, 'chunks'):
+            content = File(content, name)
+        digest = hashlib.sha256()
+        for chunk in content.chunks():
+            digest.update(chunk)
+        name = content_name(
+            validate_file_name(name, allow_relative_path=True),
+            digest.hexdigest())
+        if self.exists(name):
+            return name
+        content.seek(0)
+        return self._save(name, content)
+
+    def save_as(self, name, content):
+        """Сохраняет файл под заданным именем, например уменьшенную копию."""
+        return self._save(name, content)
+
+
+media_storage = ContentAddressedStorage()
+
+
+def get_media_storage():
+    return media_storage
@@ -0,0 +1,150 @@
+import hashlib
+import io
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import connections, transaction
+from PIL import Image, UnidentifiedImageError
+
+from foodgram.metrics import IMAGE_PROCESSING
+
+from .images import ensure_variants, image_lock, release_image
+
+logger = logging.getLogger(__name__)
+
+
+class BoundedExecutor:
+    """Пул потоков с ограниченной очередью.
+
+    Вместо того чтобы копить задачи без предела, пул сообщает о
+    переполнении: is_full() проверяется до записи в базу, и запрос
+    получает отказ, пока никакие данные ещё не изменены. Между проверкой
+    и submit() очередь могут занять параллельные запросы; тогда submit()
+    выполняет задачу в вызывающем потоке, а не теряет её.
+    """
+
+    def __init__(self, max_workers, queue_size, name):
+        self.max_workers = max_workers
+        self.capacity = max_workers + queue_size
+        self.name = name
+        self._executor = None
+        self._lock = threading.Lock()
+        self._pending = 0
+
+    @property
+    def pending(self):
+        return self._pending
+
+    def is_full(self):
+        return self._pending >= self.capacity
+
+    def submit(self, function, *args):
+        with self._lock:
+            full = self.is_full()
+            if not full:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(
+                        self.max_workers, thread_name_prefix=self.name)
+                self._pending += 1
+        if full:
+            logger.warning('Очередь %s заполнена, задача %s выполняется '
+                           'в текущем потоке', self.name, function.__name__)
+            self.call(function, *args)
+            return
+        self._executor.submit(self.run, function, *args)
+
+    def call(self, function, *args):
+        try:
+            function(*args)
+        except Exception:
+            logger.exception('Ошибка фоновой задачи %s', function.__name__)
+
+    def run(self, function, *args):
+        try:
+            self.call(function, *args)
+        finally:
+            # У потока пула своё соединение с базой
+            connections.close_all()
+            with self._lock:
+                self._pending -= 1
+
+
+image_executor = BoundedExecutor(
+    settings.IMAGE_WORKERS, settings.IMAGE_QUEUE_SIZE, 'images')
+
+
+def is_valid_image(content):
+    """Проверка Pillow без декодирования пикселей: структура файла и
+    размеры, которые не должны быть бомбой распаковки."""
+    try:
+        with Image.open(io.BytesIO(content)) as image:
+            image.verify()
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError,
+            SyntaxError, ValueError):
+        return False
+    return True
+
+
+@IMAGE_PROCESSING.labels('attach').time()
+def attach_image(model, pk, field_name, name, content):
+    """Сохраняет проверенное изображение и привязывает к объекту."""
+    instance = model.objects.filter(pk=pk).first()
+    if instance is None:
+        return
+    field = getattr(instance, field_name)
+    old_name = field.name
+    with image_lock(name):
+        field.name = field.storage.save(name, ContentFile(content))
+        # post_save поставит в очередь уменьшенные копии и сбросит кэши
+        instance.save(update_fields=[field_name])
+    if old_name != field.name:
+        release_image(old_name, field.storage)
+
+
+def schedule_image(instance, field_name, extension, content):
+    """Ставит обработку изображения в очередь после фиксации транзакции.
+
+    Имя файла — хэш содержимого, как в ContentAddressedStorage, поэтому
+    ответ уже содержит ссылку, по которой изображение появится.
+    С IMAGE_TASKS_EAGER (тесты, бенчмарк) работа выполняется сразу
+    в текущем потоке.
+    """
+    field = getattr(instance, field_name)
+    name = field.field.generate_filename(
+        instance, f'{hashlib.sha256(content).hexdigest()}.{extension}')
+    args = (type(instance), instance.pk, field_name, name, content)
+    if settings.IMAGE_TASKS_EAGER:
+        attach_image(*args)
+    else:
+        transaction.on_commit(
+            lambda: image_executor.submit(attach_image, *args))
+    field.name = name
+
+
+def submit_variants(name, storage):
+    if image_executor.is_full():
+        # Недостающие копии создаст make_image_variants
+        logger.warning('Очередь %s заполнена, варианты %s не созданы',
+                       image_executor.name, name)
+        return
+    image_executor.submit(ensure_variants, name, storage)
+
+
+def schedule_variants(field):
+    """Ставит создание уменьшенных копий в очередь после фиксации.
+
+    Любое полное сохранение записывает и поле изображения, поэтому
+    задача сначала проверяет, есть ли копии; ресайз и кодирование в
+    запросе не выполняются. С IMAGE_TASKS_EAGER копии создаются сразу.
+    """
+    if not field:
+        return
+    if settings.IMAGE_TASKS_EAGER:
+        ensure_variants(field.name, field.storage)
+    else:
+        transaction.on_commit(
+            partial(submit_variants, field.name, field.storage))
@@ -0,0 +1,580 @@
+import hashlib
+import io
+import json
+import shutil
+import tempfile
+import threading
+from pathlib import Path
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connections
+from django.test import SimpleTestCase, TestCase, override_settings
+from PIL import Image
+
+from recipes.counters import reconcile_counters
+from recipes.dump import DumpImporter, export_dump, open_dump
+from recipes.images import (ensure_variants, image_lock, release_image,
+                            variant_name)
+from recipes.importers import (UpsertImporter, default_ingredients_path,
+                               import_ingredients, read_csv, read_json)
+from recipes.models import (Favorite, Follow, Ingredient, Recipe,
+                            RecipeIngredient, ShoppingList)
+from recipes.search import (FTS_TABLE, BasicSearch, SQLiteSearch,
+                            get_search_backend, search_recipes)
+from recipes.storage import media_storage
+from recipes.tasks import BoundedExecutor, image_executor
+
+User = get_user_model()
+
+
+class CountersTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.reader = User.objects.create_user(
+            email='reader@example.com', username='reader',
+            first_name='Читатель', last_name='Рецептов', password='pass')
+
+    def create_recipe(self):
+        return Recipe.objects.create(
+            author=self.author, name='Рецепт', text='Текст', cooking_time=5)
+
+    def test_counters_follow_changes(self):
+        recipe = self.create_recipe()
+        favorite = Favorite.objects.create(user=self.reader, recipe=recipe)
+        follow = Follow.objects.create(user=self.reader, following=self.author)
+        recipe.refresh_from_db()
+        self.author.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+        self.assertEqual(self.author.recipes_count, 1)
+        self.assertEqual(self.author.followings_count, 1)
+        self.assertEqual(self.reader.followers_count, 1)
+
+        favorite.delete()
+        follow.delete()
+        recipe.delete()
+        self.author.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertEqual(self.author.recipes_count, 0)
+        self.assertEqual(self.author.followings_count, 0)
+        self.assertEqual(self.reader.followers_count, 0)
+
+    def test_full_save_keeps_counters(self):
+        recipe = self.create_recipe()
+        author = User.objects.get(pk=self.author.pk)
+        Favorite.objects.create(user=self.reader, recipe=recipe)
+        Follow.objects.create(user=self.reader, following=self.author)
+        # Экземпляры загружены до изменений, их счётчики устарели
+        recipe.name = 'Новое название'
+        recipe.save()
+        author.first_name = 'Новое имя'
+        author.save()
+        recipe.refresh_from_db()
+        author.refresh_from_db()
+        self.assertEqual(recipe.name, 'Новое название')
+        self.assertEqual(recipe.favorites_count, 1)
+        self.assertEqual(author.first_name, 'Новое имя')
+        self.assertEqual(author.recipes_count, 1)
+        self.assertEqual(author.followings_count, 1)
+
+    def test_reconcile_fixes_only_drifted_rows(self):
+        recipe = self.create_recipe()
+        Favorite.objects.bulk_create([Favorite(user=self.reader,
+                                               recipe=recipe)])
+        User.objects.filter(pk=self.reader.pk).update(followers_count=7)
+        drifted = reconcile_counters()
+        self.assertEqual(drifted['Recipe.favorites_count'], 1)
+        self.assertEqual(drifted['RecipeUser.followers_count'], 1)
+        self.assertEqual(drifted['RecipeUser.recipes_count'], 0)
+        recipe.refresh_from_db()
+        self.reader.refresh_from_db()
+        self.assertEqual(recipe.favorites_count, 1)
+        self.assertEqual(self.reader.followers_count, 0)
+
+
+@override_settings(IMAGE_TASKS_EAGER=True)
+class ImageVariantsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+
+    def make_image(self, size=(2000, 1000)):
+        buffer = io.BytesIO()
+        Image.new('RGBA', size, (200, 100, 50, 128)).save(buffer, 'PNG')
+        return ContentFile(buffer.getvalue(), name='pie.png')
+
+    def open_variant(self, name, variant, image_format):
+        return Image.open(default_storage.open(
+            variant_name(name, variant, image_format)))
+
+    def test_variants_are_created_on_upload(self):
+        recipe = Recipe(author=self.author, name='Пирог', text='Текст',
+                        cooking_time=5)
+        recipe.image.save('pie.png', self.make_image())
+        name = recipe.image.name
+        for variant, size, image_format, pillow_format in (
+                ('thumb', (96, 48), 'jpeg', 'JPEG'),
+                ('card', (480, 240), 'webp', 'WEBP'),
+                ('full', (1280, 640), 'jpeg', 'JPEG')):
+            with self.open_variant(name, variant, image_format) as image:
+                self.assertEqual(image.size, size)
+                self.assertEqual(image.format, pillow_format)
+
+    def test_small_images_are_not_upscaled(self):
+        self.author.avatar.save('avatar.png', self.make_image((60, 60)))
+        with self.open_variant(
+                self.author.avatar.name, 'full', 'webp') as image:
+            self.assertEqual(image.size, (60, 60))
+
+    @override_settings(IMAGE_TASKS_EAGER=False)
+    def test_save_queues_variants(self):
+        name = default_storage.save('recipes/images/old.png',
+                                    self.make_image((300, 300)))
+        Recipe.objects.bulk_create([Recipe(
+            author=self.author, name='Старый', text='Текст',
+            cooking_time=5, image=name)])
+        recipe = Recipe.objects.get(image=name)
+        recipe.name = 'Новое название'
+        with mock.patch.object(image_executor, 'submit') as submit:
+            with self.captureOnCommitCallbacks(execute=True):
+                recipe.save()
+            # Копии создаёт пул, а не поток запроса
+            self.assertFalse(default_storage.exists(
+                variant_name(name, 'thumb', 'webp')))
+            submit.assert_called_once_with(
+                ensure_variants, name, recipe.image.storage)
+            with mock.patch.object(image_executor, 'is_full',
+                                   return_value=True):
+                with self.captureOnCommitCallbacks(execute=True):
+                    recipe.save()
+            submit.assert_called_once()
+
+    def test_backfill_command(self):
+        name = default_storage.save('recipes/images/old.png',
+                                    self.make_image((300, 300)))
+        Recipe.objects.bulk_create([Recipe(
+            author=self.author, name='Старый', text='Текст',
+            cooking_time=5, image=name)])
+        default_storage.save('recipes/images/broken.png',
+                             ContentFile(b'not an image'))
+        Recipe.objects.bulk_create([Recipe(
+            author=self.author, name='Битый', text='Текст',
+            cooking_time=5, image='recipes/images/broken.png')])
+        output = io.StringIO()
+        call_command('make_image_variants', workers=2, stdout=output,
+                     stderr=io.StringIO())
+        self.assertIn('Создано: 1, уже были: 0, с ошибками: 1',
+                      output.getvalue())
+        self.assertTrue(default_storage.exists(
+            variant_name(name, 'thumb', 'webp')))
+
+
+class ContentAddressedMediaTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        buffer = io.BytesIO()
+        Image.new('RGB', (200, 100), 'orange').save(buffer, 'PNG')
+        self.content = buffer.getvalue()
+
+    def create_recipe(self, name='Пирог'):
+        recipe = Recipe(author=self.author, name=name, text='Текст',
+                        cooking_time=5)
+        recipe.image.save('pie.png', ContentFile(self.content))
+        return recipe
+
+    def test_same_content_is_stored_once(self):
+        first = self.create_recipe()
+        second = self.create_recipe('Ещё пирог')
+        self.assertEqual(first.image.name, second.image.name)
+        self.assertEqual(
+            first.image.name,
+            f'recipes/images/{hashlib.sha256(self.content).hexdigest()}.png')
+        self.assertEqual(
+            media_storage.listdir('recipes/images')[1], [
+                first.image.name.rsplit('/', 1)[1]])
+
+    def test_file_is_removed_with_last_reference(self):
+        first = self.create_recipe()
+        second = self.create_recipe('Ещё пирог')
+        name = first.image.name
+        thumb = variant_name(name, 'thumb', 'webp')
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(media_storage.exists(name))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(media_storage.exists(name))
+        self.assertFalse(media_storage.exists(thumb))
+
+    def test_references_are_looked_up_by_index(self):
+        for queryset, index in (
+                (Recipe.objects.filter(image='pie.png'), 'recipe_image_idx'),
+                (User.objects.filter(avatar='pie.png'), 'user_avatar_idx')):
+            with self.subTest(index=index):
+                self.assertIn(index, queryset.explain())
+
+    def test_release_waits_for_attach_of_same_file(self):
+        name = media_storage.save('recipes/images/pie.png',
+                                  ContentFile(self.content))
+        referenced = []
+        released = []
+
+        def release():
+            try:
+                released.append(release_image(name, media_storage))
+            finally:
+                connections.close_all()
+
+        with mock.patch('recipes.images.is_referenced',
+                        side_effect=lambda name: bool(referenced)):
+            with image_lock(name):
+                thread = threading.Thread(target=release)
+                thread.start()
+                thread.join(0.2)
+                # Удаление ждёт, пока загрузка не запишет ссылку
+                self.assertTrue(thread.is_alive())
+                referenced.append(name)
+            thread.join(5)
+        self.assertEqual(released, [False])
+        self.assertTrue(media_storage.exists(name))
+
+    def test_cleanup_removes_orphans_and_rehashes_legacy_names(self):
+        recipe = self.create_recipe()
+        orphan = media_storage.save_as(
+            'recipes/images/orphan.png', ContentFile(b'orphan'))
+        legacy = media_storage.save_as(
+            'recipes/images/legacy.png', ContentFile(self.content))
+        Recipe.objects.bulk_create([Recipe(
+            author=self.author, name='Старый', text='Текст',
+            cooking_time=5, image=legacy)])
+        output = io.StringIO()
+        call_command('cleanup_media', grace=0, rehash=True, stdout=output)
+        self.assertIn('Перенесено по хэшу: 1', output.getvalue())
+        self.assertIn('Удалено изображений: 1', output.getvalue())
+        self.assertFalse(media_storage.exists(orphan))
+        self.assertFalse(media_storage.exists(legacy))
+        self.assertTrue(media_storage.exists(recipe.image.name))
+        self.assertEqual(
+            Recipe.objects.get(name='Старый').image.name, recipe.image.name)
+
+
+class RecipeSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.soup = Recipe.objects.create(
+            author=author, name='Борщ украинский',
+            text='Свёкла, капуста и картофель', cooking_time=60)
+        cls.salad = Recipe.objects.create(
+            author=author, name='Винегрет',
+            text='Отварная свёкла и квашеная капуста', cooking_time=30)
+        cls.pie = Recipe.objects.create(
+            author=author, name='Пирог с капустой', text='Тесто и начинка',
+            cooking_time=90)
+
+    def search(self, query):
+        return list(search_recipes(Recipe.objects.all(), query))
+
+    def test_sqlite_backend_is_used(self):
+        self.assertIsInstance(get_search_backend('default'), SQLiteSearch)
+
+    def test_name_matches_go_first(self):
+        self.assertEqual(self.search('капуст'),
+                         [self.pie, self.salad, self.soup])
+        self.assertEqual(self.search('СВЁКЛА'), [self.salad, self.soup])
+        self.assertEqual(self.search('свёкла борщ'), [self.soup])
+
+    def test_index_follows_changes(self):
+        self.pie.name = 'Кулебяка'
+        self.pie.save()
+        self.salad.delete()
+        self.assertEqual(self.search('кулеб'), [self.pie])
+        self.assertEqual(self.search('винегрет'), [])
+
+    def test_query_operators_are_ignored(self):
+        self.assertEqual(self.search('борщ -("'), [self.soup])
+        self.assertEqual(self.search('*'), [])
+
+    def test_basic_backend(self):
+        found = BasicSearch().search(Recipe.objects.all(), 'Тесто')
+        self.assertEqual(list(found), [self.pie])
+
+    @mock.patch.dict('recipes.search._fts_available', clear=True)
+    def test_missing_trigger_disables_fts(self):
+        # Так триггеры теряются при пересборке таблицы рецептов
+        with connections['default'].cursor() as cursor:
+            cursor.execute(f'DROP TRIGGER {FTS_TABLE}_update')
+        self.assertIsInstance(get_search_backend('default'), BasicSearch)
+        self.assertEqual(self.search('Тесто'), [self.pie])
+
+
+class IngredientImportTest(TestCase):
+
+    def test_json_is_read_in_chunks(self):
+        with open(default_ingredients_path(), encoding='utf-8') as file:
+            expected = json.load(file)
+        lines = '\n'.join(json.dumps(item, ensure_ascii=False)
+                          for item in expected[:50])
+        with mock.patch('recipes.importers.CHUNK_SIZE', 7):
+            with open(default_ingredients_path(), encoding='utf-8') as file:
+                self.assertEqual(list(read_json(file)), expected)
+            self.assertEqual(list(read_json(io.StringIO(lines))),
+                             expected[:50])
+            self.assertEqual(list(read_json(io.StringIO(' [ ] '))), [])
+            with self.assertRaises(json.JSONDecodeError):
+                list(read_json(io.StringIO('[{"name": "соль"')))
+
+    def test_import_is_idempotent(self):
+        csv_path = default_ingredients_path().with_suffix('.csv')
+        with open(csv_path, encoding='utf-8', newline='') as file:
+            stats = import_ingredients(read_csv(file), batch_size=500)
+        self.assertEqual(stats.inserted, Ingredient.objects.count())
+        self.assertEqual((stats.updated, stats.skipped, stats.invalid),
+                         (0, 0, 0))
+        out = io.StringIO()
+        call_command('add_ingredients', batch_size=300, stdout=out)
+        self.assertIn(f'Строк: {stats.rows}, добавлено: 0, '
+                      f'пропущено: {stats.rows}', out.getvalue())
+
+    def test_missing_default_file(self):
+        base_dir = Path(tempfile.mkdtemp()) / 'backend'
+        self.addCleanup(shutil.rmtree, base_dir.parent)
+        with override_settings(BASE_DIR=base_dir):
+            with self.assertRaisesMessage(
+                    CommandError, str(base_dir / 'ingredients.json')):
+                call_command('add_ingredients', stdout=io.StringIO())
+
+    def test_duplicate_and_invalid_rows(self):
+        rows = [
+            {'name': 'соль', 'measurement_unit': 'г'},
+            {'name': ' соль ', 'measurement_unit': 'г'},
+            {'name': 'соль', 'measurement_unit': 'щепотка'},
+            {'name': '', 'measurement_unit': 'г'},
+            {'name': 'х' * 200, 'measurement_unit': 'г'},
+            ['сахар', 'г'],
+        ]
+        stats = import_ingredients(rows, batch_size=2)
+        self.assertEqual(
+            (stats.rows, stats.inserted, stats.skipped, stats.invalid),
+            (6, 2, 1, 3))
+        self.assertEqual([number for number, _ in stats.errors], [4, 5, 6])
+
+    def test_update_fields(self):
+        Ingredient.objects.create(name='соль', measurement_unit='г')
+        stats = UpsertImporter(
+            Ingredient, key_fields=('name',),
+            update_fields=('measurement_unit',)).run([
+                {'name': 'соль', 'measurement_unit': 'кг'},
+                {'name': 'сахар', 'measurement_unit': 'г'}])
+        self.assertEqual((stats.inserted, stats.updated), (1, 1))
+        self.assertEqual(Ingredient.objects.get(name='соль').measurement_unit,
+                         'кг')
+
+    def test_row_inserted_concurrently_gets_new_values(self):
+        importer = UpsertImporter(User, key_fields=('email',),
+                                  update_fields=('first_name',))
+        get_existing = importer.get_existing
+
+        def racing_get_existing(keys):
+            existing = get_existing(keys)
+            # Параллельная загрузка успела между проверкой и вставкой
+            User.objects.create(email='cook@example.com', username='cook',
+                                first_name='Старое')
+            return existing
+
+        with mock.patch.object(importer, 'get_existing',
+                               racing_get_existing):
+            stats = importer.run([{'email': 'cook@example.com',
+                                   'first_name': 'Новое'}])
+        self.assertEqual((stats.inserted, stats.updated), (1, 0))
+        self.assertEqual(
+            User.objects.get(email='cook@example.com').first_name, 'Новое')
+
+
+class RecipeDumpTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.author = User.objects.create_user(
+            email='author@example.com', username='author',
+            first_name='Автор', last_name='Рецептов', password='pass')
+        cls.viewer = User.objects.create_user(
+            email='viewer@example.com', username='viewer',
+            first_name='Зритель', last_name='Рецептов', password='pass')
+        salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+        sugar = Ingredient.objects.create(name='сахар', measurement_unit='г')
+        cls.recipe = Recipe.objects.create(
+            author=cls.author, name='Пирог', text='Текст', cooking_time=5)
+        RecipeIngredient.objects.create(
+            recipe=cls.recipe, ingredient=salt, amount=1)
+        RecipeIngredient.objects.create(
+            recipe=cls.recipe, ingredient=sugar, amount=200)
+        Recipe.objects.create(
+            author=cls.viewer, name='Чай', text='Текст', cooking_time=3)
+        Favorite.objects.create(user=cls.viewer, recipe=cls.recipe)
+        ShoppingList.objects.create(user=cls.viewer, recipe=cls.recipe)
+        Follow.objects.create(user=cls.viewer, following=cls.author)
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        settings_override = override_settings(MEDIA_ROOT=media_root)
+        settings_override.enable()
+        self.addCleanup(settings_override.disable)
+        buffer = io.BytesIO()
+        Image.new('RGB', (20, 10), 'orange').save(buffer, 'PNG')
+        self.image = media_storage.save('recipes/images/pie.png',
+                                        ContentFile(buffer.getvalue()))
+        Recipe.objects.filter(id=self.recipe.id).update(image=self.image)
+        self.path = f'{media_root}/dump.ndjson.gz'
+        export_dump(self.path)
+        Recipe.objects.all().delete()
+        User.objects.all().delete()
+        Ingredient.objects.all().delete()
+        media_storage.delete(self.image)
+
+    def snapshot(self):
+        return {
+            'recipes': sorted(
+                (recipe.author.email, recipe.name, recipe.image.name or '',
+                 recipe.favorites_count,
+                 tuple(sorted(recipe.ingredients_in_recipes.values_list(
+                     'ingredient__name', 'amount'))))
+                for recipe in Recipe.objects.all()),
+            'favorites': list(Favorite.objects.values_list(
+                'user__email', 'recipe__name')),
+            'carts': list(ShoppingList.objects.values_list(
+                'user__email', 'recipe__name')),
+            'follows': list(Follow.objects.values_list(
+                'user__email', 'following__email')),
+        }
+
+    def assert_imported(self):
+        self.assertEqual(self.snapshot(), {
+            'recipes': [
+                ('author@example.com', 'Пирог', self.image, 1,
+                 (('сахар', 200), ('соль', 1))),
+                ('viewer@example.com', 'Чай', '', 0, ()),
+            ],
+            'favorites': [('viewer@example.com', 'Пирог')],
+            'carts': [('viewer@example.com', 'Пирог')],
+            'follows': [('viewer@example.com', 'author@example.com')],
+        })
+
+    def test_round_trip(self):
+        call_command('import_recipes', self.path, skip_variants=True,
+                     stdout=io.StringIO())
+        self.assert_imported()
+        self.assertTrue(media_storage.exists(self.image))
+        self.assertTrue(User.objects.get(
+            email='viewer@example.com').check_password('pass'))
+
+    def test_interrupted_import_resumes(self):
+        checkpoint = f'{self.path}.checkpoint'
+        with mock.patch.object(DumpImporter, 'import_favorites',
+                               side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError), open_dump(
+                    self.path) as file:
+                DumpImporter(checkpoint, batch_size=1).run(file)
+        self.assertEqual(Recipe.objects.count(), 2)
+        # Точка, недописанная при сбое
+        with open(checkpoint, 'a', encoding='utf-8') as file:
+            file.write('{"line": 1')
+        call_command('import_recipes', self.path, batch_size=1,
+                     skip_variants=True, stdout=io.StringIO())
+        self.assert_imported()
+        # Загруженный дамп повторно ничего не добавляет
+        call_command('import_recipes', self.path, skip_variants=True,
+                     stdout=io.StringIO())
+        self.assertEqual(Recipe.objects.count(), 2)
+
+    def test_crash_before_checkpoint_does_not_duplicate_recipes(self):
+        checkpoint = f'{self.path}.checkpoint'
+        save_checkpoint = DumpImporter.save_checkpoint
+
+        def crash_after_recipes(importer, line):
+            # Пачка рецептов зафиксирована, контрольная точка не записана
+            if importer.stats['recipe']:
+                raise RuntimeError
+            save_checkpoint(importer, line)
+
+        with mock.patch.object(DumpImporter, 'save_checkpoint',
+                               crash_after_recipes):
+            with self.assertRaises(RuntimeError), open_dump(
+                    self.path) as file:
+                DumpImporter(checkpoint).run(file)
+        self.assertEqual(Recipe.objects.count(), 2)
+        call_command('import_recipes', self.path, skip_variants=True,
+                     stdout=io.StringIO())
+        self.assert_imported()
+        call_command('import_recipes', self.path, restart=True,
+                     skip_variants=True, stdout=io.StringIO())
+        self.assert_imported()
+        self.assertEqual(RecipeIngredient.objects.count(), 2)
+
+
+class BoundedExecutorTest(SimpleTestCase):
+
+    def test_reports_full_queue_until_tasks_finish(self):
+        executor = BoundedExecutor(1, 1, 'test')
+        release = threading.Event()
+        finished = threading.Semaphore(0)
+
+        def task():
+            release.wait(5)
+            finished.release()
+
+        executor.submit(task)
+        self.assertFalse(executor.is_full())
+        executor.submit(task)
+        self.assertTrue(executor.is_full())
+        release.set()
+        for _ in range(2):
+            self.assertTrue(finished.acquire(timeout=5))
+        executor._executor.shutdown(wait=True)
+        self.assertEqual(executor.pending, 0)
+
+    def test_full_queue_runs_task_in_caller_thread(self):
+        executor = BoundedExecutor(1, 0, 'test')
+        release = threading.Event()
+        threads = []
+        executor.submit(release.wait, 5)
+        self.assertTrue(executor.is_full())
+        # Очередь заняли после проверки is_full(): задача не теряется
+        executor.submit(lambda: threads.append(threading.current_thread()))
+        self.assertEqual(threads, [threading.current_thread()])
+        release.set()
+        executor._executor.shutdown(wait=True)
+        self.assertEqual(executor.pending, 0)
@@ -1,8 +1,13 @@
 from django.shortcuts import redirect
-from django.shortcuts import get_object_or_404
+from django.shortcuts import aget_object_or_404, get_object_or_404
 from .models import Recipe
 
 
 def extract_from_short_url(request, recipe_id):
     get_object_or_404(Recipe, id=recipe_id)
     return redirect(f'/recipes/{recipe_id}/')
+
+
+async def extract_from_short_url_async(request, recipe_id):
+    await aget_object_or_404(Recipe, id=recipe_id)
+    return redirect(f'/recipes/{recipe_id}/')